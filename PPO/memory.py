@@ -1,4 +1,5 @@
 from config import *
+from base_agent.advantage import vtargets_adv
 from collections import deque
 import utils
 import numpy as np
@@ -109,24 +110,14 @@ class ReplayMemory(object):
         return mini_batch
         
     def compute_vtargets_adv(self, gamma, lam, frame_next_val):
-        N = len(self)
+        rewards = np.array([row[2] for row in self.memory])
+        dones = np.array([row[3] for row in self.memory])
+        values = np.array([row[4] for row in self.memory])
+        advantages, returns = vtargets_adv(rewards, values, dones, gamma, lam, last_value=frame_next_val)
         
-        prev_gae_t = 0
-       
-        
-        for i in reversed(range(N)):
-            
-            if i+1 == N:
-                vnext = frame_next_val
-                nonterminal = 1
-            else:
-                vnext = self.memory[i+1][4]
-                nonterminal = 1 - self.memory[i+1][3]    # 1 - done
-            delta = self.memory[i][2] + gamma * vnext * nonterminal - self.memory[i][4]
-            gae_t = delta + gamma * lam * nonterminal * prev_gae_t
-            self.memory[i][6] = gae_t    # advantage
-            self.memory[i][5] = gae_t + self.memory[i][4]  # advantage + value
-            prev_gae_t = gae_t
+        for row, adv, ret in zip(self.memory, advantages, returns):
+            row[6] = adv    # advantage
+            row[5] = ret    # advantage + value
         
 
     def __len__(self):
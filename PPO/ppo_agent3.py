@@ -9,6 +9,9 @@
 # based on code from https://github.com/wooridle/DeepRL-PPO-tutorial/blob/master/ppo.py
 
 
+import sys
+sys.path.insert(0, "../interface/")
+
 import numpy as np
 from custom_env import MinigameEnvironment
 from modified_state_space import state_modifier
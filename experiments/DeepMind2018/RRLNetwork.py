@@ -3,13 +3,13 @@ import torch.nn as nn
 import torch.nn.functional as F
 torch.backends.cudnn.benchmarks = True
 import numpy as np
-import time
 
 from base_agent.Network import BaseNetwork
 import matplotlib.pyplot as plt
 
-from base_agent.sc2env_utils import generate_embeddings, multi_embed, valid_args, get_action_args, batch_get_action_args, is_spatial_arg, env_config, processed_feature_dim, full_action_space
-from base_agent.net_utils import ConvLSTM, ResnetBlock, SelfAttentionBlock, Downsampler, SpatialUpsampler, Unsqueeze, Squeeze, FastEmbedding, RelationalModule, Flatten
+from base_agent.sc2env_utils import generate_embeddings, spatial_action_planes, valid_args, env_config, processed_feature_dim, full_action_space
+from base_agent.net_utils import ConvLSTM, ResnetBlock, SelfAttentionBlock, Downsampler, SpatialUpsampler, Unsqueeze, Squeeze, RelationalModule, Flatten
+from base_agent.action_tables import spatial_arg_mask, nonspatial_arg_mask
 
 class RRLModel(BaseNetwork):
 
@@ -53,36 +53,14 @@ class RRLModel(BaseNetwork):
             nn.Linear(128, net_config["inputs2d_size"])
         )
 
-        """
         self.attention_blocks = nn.Sequential(
-            SelfAttentionBlock(net_config['LSTM_hidden_size'] + self.LSTM_in_size,
-                                net_config['relational_features'],
-                                net_config['relational_heads'])
-        )
-        for i in range(net_config['relational_depth']-1):
-            self.attention_blocks.add_module("Block"+str(i+2),
-                                                SelfAttentionBlock(
-                                                    net_config['relational_heads'] * net_config['relational_features'],
-                                                    net_config['relational_features'],
-                                                    net_config['relational_heads']
-                                                )
-                                            )
-        """
-
-
-        self.attention_blocks = nn.Sequential(
-            RelationalModule(self.LSTM_in_size,
-                                net_config['relational_features'],
-                                net_config['relational_heads'])
+            self.relational_block(self.LSTM_in_size, net_config)
         )
 
         for i in range(net_config['relational_depth']-1):
             self.attention_blocks.add_module(
                 "Block"+str(i+2),
-                RelationalModule(net_config['relational_features'],
-                                net_config['relational_features'],
-                                net_config['relational_heads'],
-                                encode=False)
+                self.relational_block(net_config['relational_features'], net_config, encode=False)
             )
 
         """
@@ -136,8 +114,6 @@ class RRLModel(BaseNetwork):
         x, y = np.meshgrid(np.linspace(-1,1,net_config["inputs3d_width"]), np.linspace(-1,1,net_config["inputs3d_width"]))
         coordinates = np.stack([x,y])
         self.coordinates = torch.from_numpy(coordinates).float().to(self.device).detach().unsqueeze(0)
-        self.minimap_action = torch.zeros((1, 1, env_config["minimap_width"], env_config["minimap_width"])).float().to(self.device)
-        self.screen_action = torch.zeros((1, 2, env_config["screen_width"], env_config["minimap_width"])).float().to(self.device)
 
 
         self.arg_depth = env_config["arg_depth"]
@@ -146,6 +122,7 @@ class RRLModel(BaseNetwork):
         self.spatial_size = env_config["spatial_action_size"]
 
         self.valid_args = torch.from_numpy(valid_args).float().to(self.device)
+        self.lazy_heads = net_config.get("lazy_heads", True)
         self.call_count = 0
 
     """
@@ -155,7 +132,8 @@ class RRLModel(BaseNetwork):
         last_action: (N, D)
         hidden: (N, 2, D, H, W)
         curr_action: (N, D) (curr_action is not None if and only if training)
-        choosing: True if sampling an action, False otherwise
+        choosing: True if sampling an action, False otherwise. choice is then
+            [action, args, spatial], or a list of N of them if N > 1.
 
         D is a placeholder for feature dimensions.
     """
@@ -165,181 +143,170 @@ class RRLModel(BaseNetwork):
         if (not choosing and not unrolling):
             assert (curr_action is not None)
 
-        N = len(minimap)
-
         if choosing:
             minimap = torch.from_numpy(minimap).to(self.device).float()
             screen = torch.from_numpy(screen).to(self.device).float()
             player = torch.from_numpy(player).to(self.device).float()
             last_action = torch.from_numpy(last_action).to(self.device).long()
             hidden = torch.from_numpy(hidden).to(self.device).float()
-            avail_actions = torch.from_numpy(avail_actions).to(self.device).byte()
+            if not torch.is_tensor(avail_actions):
+                avail_actions = torch.from_numpy(avail_actions).to(self.device).byte()
             last_spatials = torch.from_numpy(last_spatials).to(self.device).long()
 
-        t1 = time.time()
-        inputs = [minimap, screen]
-
         if process_inputs:
             if format_inputs:
-                # process_states(self, minimaps, screens, players, last_actions, last_spatial_actions, sequential=True, embeddings_only=False)
-                #[minimap, screen] = self.embed_inputs(inputs)
-                #[minimap, screen] = [minimap.to(self.device), screen.to(self.device)]
-                #[minimap, screen] = self.concat_spatial([minimap, screen], last_action, last_spatials)
                 [minimap, screen, _] = self.process_states(minimap, screen, player, last_action, last_spatials, sequential=False, embeddings_only=True)
-                #print(last_spatials)
-                """
-                if (np.random.random() < 0.0001):
-                    print(last_action, last_spatials, len(minimap[0]))
-                    for i in range(len(minimap[0])):
-                        print(i)
-                        plt.imshow(minimap[0,i].cpu().data.numpy())
-                        plt.show()
-                """
-
-
-            processed_minimap = self.down_layers_minimap(minimap)
-            processed_screen = self.down_layers_screen(screen)
+            processed_minimap, processed_screen, inputs2d = self.encode(minimap, screen, player, last_action)
         else:
             processed_minimap = minimap
             processed_screen = screen
 
-        curr_coordinates = self.coordinates.expand((N,) + self.coordinates.shape[1:])
-
-        t2 = time.time()
-        inputs3d = torch.cat([processed_minimap, processed_screen, curr_coordinates], dim=1)
-        t3 = time.time()
-        if process_inputs:
-            embedded_last_action = self.action_embedding(last_action).to(self.device)
-            nonspatial_concat = torch.cat([player, embedded_last_action], dim=-1)
-            inputs2d = self.inputs2d_MLP(nonspatial_concat)
-
-        t4 = time.time()
-
-        expanded_inputs2d = inputs2d.unsqueeze(2).unsqueeze(3).expand(inputs2d.shape + (self.net_config["inputs3d_width"], self.net_config["inputs3d_width"]))
-        outputs2d = torch.cat([inputs3d, expanded_inputs2d], dim=1)
-
         #outputs2d, hidden = self.convLSTM(LSTM_in, hidden)
         #outputs2d = torch.cat([outputs2d, LSTM_in], dim=1)
-        t5 = time.time()
         if unrolling:
-            #print("Unrolling times\n embedding: %f, down layers: %f, inputs2dmlp: %f, lstm: %f. Total: %f" % (t2-t1,t3-t2,t4-t3,t5-t4,t5-t1))
             return hidden
 
+        shared_features, relational_spatial, value, action_logits_in = self.core(processed_minimap, processed_screen, inputs2d)
+        action_logits = self.action_policy(action_logits_in, avail_actions)
+        choice = [curr_action, None, None]
+        if (choosing):
+            processed_action = self.sample_actions(action_logits)
+        else:
+            processed_action = curr_action
+
+        if (choosing and self.lazy_heads):
+            arg_logits, spatial_logits = self.lazy_conditioned_heads(shared_features, relational_spatial, processed_action)
+        else:
+            arg_logits, spatial_logits = self.conditioned_heads(shared_features, relational_spatial, processed_action)
+
+        if (choosing):
+            args, spatial = self.sample_action_args(arg_logits, spatial_logits, processed_action)
+            choices = self.choices_to_host(processed_action, args, spatial)
+            choice = choices[0] if len(choices) == 1 else choices
+
+        return action_logits, arg_logits, spatial_logits, hidden, value, choice
+
+
+    """
+        Down-sampled minimap and screen and the non-spatial inputs, from the
+        embedded (N, history_size * D, H, W) minimap and screen.
+    """
+    def encode(self, minimap, screen, player, last_action):
+        processed_minimap = self.down_layers_minimap(minimap)
+        processed_screen = self.down_layers_screen(screen)
+        embedded_last_action = self.action_embedding(last_action)
+        inputs2d = self.inputs2d_MLP(torch.cat([player, embedded_last_action], dim=-1))
+        return processed_minimap, processed_screen, inputs2d
+
+    """
+        Relational core shared by all heads. Returns the shared features,
+        the relational spatial features, the value and the unmasked action
+        logits.
+    """
+    def core(self, processed_minimap, processed_screen, inputs2d):
+        N = processed_minimap.shape[0]
+        width = self.net_config["inputs3d_width"]
+        curr_coordinates = self.coordinates.expand((N,) + self.coordinates.shape[1:])
+        inputs3d = torch.cat([processed_minimap, processed_screen, curr_coordinates], dim=1)
+        expanded_inputs2d = inputs2d.unsqueeze(2).unsqueeze(3).expand(inputs2d.shape + (width, width))
+        outputs2d = torch.cat([inputs3d, expanded_inputs2d], dim=1)
+
         relational_spatial = self.attention_blocks(outputs2d)
-        #relational_spatial = self.baseline_layers(outputs2d)
         relational_nonspatial = self.relational_processor(relational_spatial)
-
-        t6 = time.time()
         shared_features = torch.cat([inputs2d, relational_nonspatial], dim=-1)
         value = self.value_MLP(shared_features)
         action_logits_in = self.action_MLP(shared_features)
-        action_logits_in = action_logits_in.masked_fill((1-avail_actions*self.action_space).bool(), float('-inf'))
-        #print("actions: ", torch.max(action_logits_in, dim=-1))
-        action_logits = F.softmax(action_logits_in)
-        #action_logits = action_logits / torch.sum(action_logits, axis=-1)
-        choice = None
-        if (choosing):
-            action = self.sample_action(action_logits)
-            processed_action = torch.from_numpy(np.array(action)).unsqueeze(0).long().to(self.device)
-        else:
-            action = curr_action
-            processed_action = action
-            #processed_action = torch.from_numpy(action).long().to(self.device)
+        return shared_features, relational_spatial, value, action_logits_in
 
-        embedded_action = self.action_embedding(processed_action)
-        t7 = time.time()
+    def action_policy(self, action_logits_in, avail_actions):
+        action_logits_in = action_logits_in.masked_fill((avail_actions & self.action_space) == 0, float('-inf'))
+        return F.softmax(action_logits_in, dim=-1, dtype=torch.float32)
+
+    """
+        Argument and spatial argument probabilities given the base action
+    """
+    def conditioned_heads(self, shared_features, relational_spatial, action):
+        N = shared_features.shape[0]
+        embedded_action = self.action_embedding(action)
         shared_conditioned = torch.cat([shared_features, embedded_action], dim=-1)
         arg_logit_inputs = self.arg_MLP(shared_conditioned)
         arg_logit_inputs = arg_logit_inputs.reshape((N, self.arg_depth, self.arg_size))
         arg_logits = self.generate_arg_logits(arg_logit_inputs)
-        #print("args: ", torch.sum(arg_logit_inputs, dim=-1))
-
-        args = None
-        if (choosing):
-            args = self.sample_arg(arg_logits, action)
 
         w = relational_spatial.shape[-1]
-
         embedded_action = embedded_action.unsqueeze(2).unsqueeze(3).expand(embedded_action.shape + (w,w))
         spatial_input = torch.cat([relational_spatial, embedded_action], dim=1)
         spatial_logits_in = self.spatial_upsampler(spatial_input)
         spatial_logits = self.generate_spatial_logits(spatial_logits_in)
-        #print("spatial: ", torch.sum(spatial_logits_in, dim=(-1,-2)))
-
-
-        spatial = None
-        if (choosing):
-            spatial = self.sample_spatial(spatial_logits, action)
-
-        choice = [action, args, spatial]
-        t8 = time.time()
-
-        #print("full forward times\n embedding: %f, down layers: %f, inputs2dmlp: %f, lstm: %f. relational: %f. value: %f. Selection: %f. Total: %f" % (t2-t1,t3-t2,t4-t3,t5-t4, t6-t5, t7-t6, t8-t7, t8-t1))
+        return arg_logits, spatial_logits
 
+    """
+        conditioned_heads for action selection. Only the argument rows and
+        spatial channels taken by some sampled action are computed, and only
+        for the environments whose action takes any; a batch of no_op or
+        Stop_quick skips both heads. Everything not computed is left at
+        zero, so the probabilities keep the shapes of conditioned_heads and
+        agree with it wherever the choice reads them.
+    """
+    def lazy_conditioned_heads(self, shared_features, relational_spatial, action):
+        N = shared_features.shape[0]
+        (_, _, w, _) = relational_spatial.shape
+        out_width = 4 * w  # two stride-2 transposed convolutions
+        arg_logits = torch.zeros((N, self.arg_depth, self.arg_size), device=shared_features.device)
+        spatial_logits = torch.zeros((N, self.spatial_depth, out_width, out_width), device=shared_features.device)
+
+        actions = action.cpu().numpy()
+        arg_mask = nonspatial_arg_mask[actions]
+        spatial_mask = spatial_arg_mask[actions]
+        embedded_action = self.action_embedding(action)
+
+        envs = np.flatnonzero(arg_mask.any(axis=1))
+        if len(envs) > 0:
+            types = torch.from_numpy(np.flatnonzero(arg_mask[envs].any(axis=0))).to(action.device)
+            rows = torch.from_numpy(envs).to(action.device)
+            shared_conditioned = torch.cat([shared_features[rows], embedded_action[rows]], dim=-1)
+            weight = self.arg_MLP.weight.view(self.arg_depth, self.arg_size, -1)[types].flatten(0, 1)
+            bias = self.arg_MLP.bias.view(self.arg_depth, self.arg_size)[types].flatten()
+            arg_logit_inputs = F.linear(shared_conditioned, weight, bias).view(len(envs), len(types), self.arg_size)
+            arg_logits[rows.unsqueeze(1), types] = self.generate_arg_logits(arg_logit_inputs, types)
+
+        envs = np.flatnonzero(spatial_mask.any(axis=1))
+        if len(envs) > 0:
+            channels = torch.from_numpy(np.flatnonzero(spatial_mask[envs].any(axis=0))).to(action.device)
+            rows = torch.from_numpy(envs).to(action.device)
+            embedded = embedded_action[rows].unsqueeze(2).unsqueeze(3).expand((len(envs), embedded_action.shape[1], w, w))
+            spatial_input = torch.cat([relational_spatial[rows], embedded], dim=1)
+            spatial_logits_in = self.spatial_upsampler(spatial_input, channels)
+            spatial_logits[rows.unsqueeze(1), channels] = self.generate_spatial_logits(spatial_logits_in)
+
+        return arg_logits, spatial_logits
 
-        return action_logits, arg_logits, spatial_logits, hidden, value, choice
-
+    """
+        One block of the relational core. net_config["relational_block"]
+        selects the packed multi-head SelfAttentionBlock ("attention") or
+        the TransformerEncoderLayer based RelationalModule ("transformer",
+        the default). With encode=False the input already has
+        relational_heads * relational_features channels.
+    """
+    def relational_block(self, in_size, net_config, encode=True):
+        if net_config.get("relational_block", "transformer") == "attention":
+            if not encode:
+                in_size = net_config['relational_heads'] * net_config['relational_features']
+            return SelfAttentionBlock(in_size,
+                                        net_config['relational_features'],
+                                        net_config['relational_heads'])
+        return RelationalModule(in_size,
+                                net_config['relational_features'],
+                                net_config['relational_heads'],
+                                encode=encode)
 
+    """
+        Appends the last action's spatial arguments to the embedded inputs:
+        argument 1 as one minimap plane, arguments 0 and 2 as two screen planes.
+    """
     def concat_spatial(self, inputs, last_action, last_spatials):
         [minimap, screen] = inputs
-        N = minimap.shape[0]
-        """
-        if (N == 1):
-            minimap_action = self.minimap_action.clone()
-            screen_action = self.screen_action.clone()
-            ids = get_action_args(last_action)
-            if 0 in ids:
-                idx = 2*last_spatials[0]
-                screen_action[:,0,idx[0], idx[1]] = 1
-            if 1 in ids:
-                idx = 2*last_spatials[1]
-                minimap_action[:,0,idx[0],idx[1]] = 1
-            if 2 in ids:
-                idx = 2*last_spatials[2]
-                screen_action[:,1,idx[0],idx[1]] = 1
-            print(minimap.shape, minimap_action.shape)
-            minimap = torch.cat([minimap, minimap_action], dim=1)
-            screen = torch.cat([screen, screen_action], dim=1)
-
-
-        else:
-        """
-        minimap_action = self.minimap_action.expand((N,) + self.minimap_action.shape[1:])
-        screen_action = self.screen_action.expand((N,) + self.screen_action.shape[1:])
-        #ids = batch_get_action_args(last_action)
-        ### @TODO: Finish this garbage
-        valid_spatial = last_spatials[:,:,0] >= 0
-        indices = valid_spatial.nonzero()
-
-        batch_inds = indices[:,0]
-        #hist_inds = indices[:,1]
-        arg_inds = indices[:,1]
-
-        for i in range(len(batch_inds)):
-            b = batch_inds[i]
-            a = arg_inds[i]
-            idx = 2*last_spatials[b,a]
-            arr = [screen_action, minimap_action][a==1]
-            ind = a // 2
-            arr[b,ind,idx[0],idx[1]] = 1
-
-            """
-            if 0 in ids[i]:
-                idx = 2*last_spatials[i,0]
-                print(idx, last_spatials.shape)
-                screen_action[i,0, idx[0], idx[1]] = 1
-            if 1 in ids[i]:
-                idx = 2*last_spatials[i,1]
-                print(idx, last_spatials.shape)
-                minimap_action[i,0,idx[0],idx[1]] = 1
-            if 2 in ids[i]:
-                idx = 2*last_spatials[i,2]
-                print(idx, last_spatials.shape)
-                screen_action[i,1,idx[0],idx[1]] = 1
-            """
-
-        minimap = torch.cat([minimap, minimap_action], dim=1)
-        screen = torch.cat([screen, screen_action], dim=1)
-
-
+        planes = spatial_action_planes(last_spatials, minimap.shape[-2:], scale=2, dtype=minimap.dtype)
+        minimap = torch.cat([minimap, planes[:,1:2]], dim=1)
+        screen = torch.cat([screen, planes[:,0::2]], dim=1)
         return [minimap, screen]
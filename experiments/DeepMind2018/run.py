@@ -8,6 +8,7 @@ from abstract_core import Experiment, RunSettings
 from base_agent.memory import ReplayMemory, SequentialMemory
 from agent import AgentSettings
 from base_agent.sc2env_utils import env_config, full_action_space
+from base_agent.data_parallel import init_data_parallel, launch
 import torch
 import argparse
 import numpy as np
@@ -16,7 +17,13 @@ import numpy as np
 device = "cuda:0" if torch.cuda.is_available() else "cpu"
 torch.backends.cudnn.benchmarks = True
 
-def main():
+def main(rank=0, world_size=1, resume=False):
+
+    if world_size > 1:
+        init_data_parallel(rank, world_size)
+        torch.set_num_threads(max(1, torch.get_num_threads() // world_size))
+        torch.manual_seed(rank)
+        np.random.seed(rank)
 
     map_name = "DefeatRoaches"
     render = False
@@ -60,6 +67,8 @@ def main():
         "relational_features": 32,
         "relational_depth": 3,
         "relational_heads": 3,
+        "relational_block": "transformer",
+        "lazy_heads": True,
         "spatial_out_depth": 64,
         "channels3": 16,
         "history_size": history_size,
@@ -112,11 +121,20 @@ def main():
         "clip_decay": 10000,
         "c2_decay": 10000,
         "map": map_name,
-        "history_size": history_size
+        "history_size": history_size,
+        "bf16": False,
+        "num_minibatches": None,
+        "micro_batch_size": None,
+        "measure_activations": False,
+        "verbose": False,
+        "traced_inference": False,
+        "data_parallel": world_size > 1
     }
 
     agent = BaseAgent(model, agent_settings, memory, train_settings)
     #agent.load()
+    if resume and not agent.resume():
+        print("No checkpoint found, starting from scratch")
     experiment = Experiment([agent], env, run_settings)
 
     #experiment.test()
@@ -124,4 +142,13 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1,
+                        help="data-parallel learner processes, each with its own environment and memory")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the newest checkpoint of this map")
+    args = parser.parse_args()
+    if args.workers > 1:
+        launch(main, args.workers, args.resume)
+    else:
+        main(resume=args.resume)
@@ -8,7 +8,7 @@ import time
 from base_agent.Network import BaseNetwork
 import matplotlib.pyplot as plt
 
-from base_agent.sc2env_utils import generate_embeddings, multi_embed, valid_args, get_action_args, batch_get_action_args, is_spatial_arg, env_config, processed_feature_dim, full_action_space
+from base_agent.sc2env_utils import generate_embeddings, spatial_action_planes, valid_args, env_config, processed_feature_dim, full_action_space
 from base_agent.net_utils import ConvLSTM, ResnetBlock, SelfAttentionBlock, Downsampler, SpatialUpsampler, Unsqueeze, Squeeze, FastEmbedding, RelationalModule, Flatten
 
 
@@ -77,8 +77,6 @@ class ConvNet(BaseNetwork):
         x, y = np.meshgrid(np.linspace(-1,1,net_config["inputs3d_width"]), np.linspace(-1,1,net_config["inputs3d_width"]))
         coordinates = np.stack([x,y])
         self.coordinates = torch.from_numpy(coordinates).float().to(self.device).detach().unsqueeze(0)
-        self.minimap_action = torch.zeros((1, 1, env_config["minimap_width"], env_config["minimap_width"])).float().to(self.device)
-        self.screen_action = torch.zeros((1, 2, env_config["screen_width"], env_config["minimap_width"])).float().to(self.device)
 
         self.valid_args = torch.from_numpy(valid_args).float().to(self.device)
 
@@ -133,79 +131,25 @@ class ConvNet(BaseNetwork):
         arg_logits = self.generate_arg_logits(arg_policy)
         spatial_logits = self.generate_spatial_logits(spatial_policy)
 
-        action, args, spatial = None, None, None
+        choice = [None, None, None]
         if (choosing):
-            action = self.sample_action(action_logits)
-            args = self.sample_arg(arg_logits, action)
-            spatial = self.sample_spatial(spatial_logits, action)
-
-        choice = [action, args, spatial]
+            actions = self.sample_actions(action_logits)
+            args, spatial = self.sample_action_args(arg_logits, spatial_logits, actions)
+            choices = self.choices_to_host(actions, args, spatial)
+            choice = choices[0] if len(choices) == 1 else choices
 
         return action_logits, arg_logits, spatial_logits, hidden, value, choice
 
 
+    """
+        Appends the last action's spatial arguments to the embedded inputs:
+        argument 1 as one minimap plane, arguments 0 and 2 as two screen planes.
+    """
     def concat_spatial(self, inputs, last_action, last_spatials):
         [minimap, screen] = inputs
-        N = minimap.shape[0]
-        """
-        if (N == 1):
-            minimap_action = self.minimap_action.clone()
-            screen_action = self.screen_action.clone()
-            ids = get_action_args(last_action)
-            if 0 in ids:
-                idx = 2*last_spatials[0]
-                screen_action[:,0,idx[0], idx[1]] = 1
-            if 1 in ids:
-                idx = 2*last_spatials[1]
-                minimap_action[:,0,idx[0],idx[1]] = 1
-            if 2 in ids:
-                idx = 2*last_spatials[2]
-                screen_action[:,1,idx[0],idx[1]] = 1
-            print(minimap.shape, minimap_action.shape)
-            minimap = torch.cat([minimap, minimap_action], dim=1)
-            screen = torch.cat([screen, screen_action], dim=1)
-
-
-        else:
-        """
-        minimap_action = self.minimap_action.expand((N,) + self.minimap_action.shape[1:])
-        screen_action = self.screen_action.expand((N,) + self.screen_action.shape[1:])
-        #ids = batch_get_action_args(last_action)
-        ### @TODO: Finish this garbage
-        valid_spatial = last_spatials[:,:,0] >= 0
-        indices = valid_spatial.nonzero()
-
-        batch_inds = indices[:,0]
-        #hist_inds = indices[:,1]
-        arg_inds = indices[:,1]
-
-        for i in range(len(batch_inds)):
-            b = batch_inds[i]
-            a = arg_inds[i]
-            idx = last_spatials[b,a]
-            arr = [screen_action, minimap_action][a==1]
-            ind = a // 2
-            arr[b,ind,idx[0],idx[1]] = 1
-
-            """
-            if 0 in ids[i]:
-                idx = 2*last_spatials[i,0]
-                print(idx, last_spatials.shape)
-                screen_action[i,0, idx[0], idx[1]] = 1
-            if 1 in ids[i]:
-                idx = 2*last_spatials[i,1]
-                print(idx, last_spatials.shape)
-                minimap_action[i,0,idx[0],idx[1]] = 1
-            if 2 in ids[i]:
-                idx = 2*last_spatials[i,2]
-                print(idx, last_spatials.shape)
-                screen_action[i,1,idx[0],idx[1]] = 1
-            """
-
-        minimap = torch.cat([minimap, minimap_action], dim=1)
-        screen = torch.cat([screen, screen_action], dim=1)
-
-
+        planes = spatial_action_planes(last_spatials, minimap.shape[-2:], dtype=minimap.dtype)
+        minimap = torch.cat([minimap, planes[:,1:2]], dim=1)
+        screen = torch.cat([screen, planes[:,0::2]], dim=1)
         return [minimap, screen]
 
 
@@ -16,7 +16,7 @@ import numpy as np
 device = "cuda:0" if torch.cuda.is_available() else "cpu"
 torch.backends.cudnn.benchmarks = True
 
-def main():
+def main(resume=False):
 
     map_name = "DefeatRoaches"
     render = False
@@ -118,6 +118,8 @@ def main():
 
     agent = BaseAgent(model, agent_settings, memory, train_settings)
     #agent.load()
+    if resume and not agent.resume():
+        print("No checkpoint found, starting from scratch")
     experiment = Experiment([agent], env, run_settings)
 
     #experiment.test()
@@ -125,4 +127,8 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the newest checkpoint of this map")
+    args = parser.parse_args()
+    main(resume=args.resume)
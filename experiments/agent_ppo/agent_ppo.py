@@ -2,6 +2,7 @@ from agent import Agent, Model, Memory, AgentSettings
 from config import GraphConvConfigMinigames
 from modified_state_space import state_modifier
 import utils
+from base_agent.prefetch import Prefetcher, PinnedStager
 
 import torch
 import torch.nn as nn
@@ -31,6 +32,7 @@ class PPOAgent(Agent):
         self.config = GraphConvConfigMinigames
         self.value = 0
         self.loss = nn.MSELoss().to(PPO_settings['device'])
+        self.stager = PinnedStager(PPO_settings['device'], 4)
     
     def _forward(self, agent_state, choosing=False):
         (G, X, avail_actions) = agent_state
@@ -68,23 +70,31 @@ class PPOAgent(Agent):
         num_iters = int(len(self.memory) / batch_size)
         epochs = run_settings.num_epochs
         
+        prefetcher = Prefetcher(self.load_batch, epochs * num_iters, self.stager)
+        
         for i in range(epochs):
         
             pol_loss = 0
             vf_loss = 0
             ent_total = 0
+            trained = 0
         
             for j in range(num_iters):
                 
-                d_pol, d_vf, d_ent = self.train_step(batch_size)
+                batch = prefetcher.get()
+                if batch is None:
+                    continue
+                d_pol, d_vf, d_ent = self.train_step(batch_size, batch)
                 pol_loss += d_pol
                 vf_loss += d_vf
                 ent_total += d_ent
+                trained += 1
             
             self.epochs_trained += 1
-            pol_loss /= num_iters
-            vf_loss /= num_iters
-            ent_total /= num_iters
+            trained = max(trained, 1)
+            pol_loss /= trained
+            vf_loss /= trained
+            ent_total /= trained
             print("Epoch %d: Policy loss: %f. Value loss: %f. Entropy %f" % 
                             (self.epochs_trained, 
                             pol_loss, 
@@ -96,50 +106,75 @@ class PPOAgent(Agent):
         print("\n\n ------- Training sequence ended ------- \n\n")
     
     
-    def train_step(self, batch_size):
-    
+    """
+        Samples and stacks the next minibatch and moves the training targets
+        to the device through self.stager. Runs on the Prefetcher worker
+        thread during training. Returns None if no window could be sampled.
+    """
+    def load_batch(self):
         hist_size = self.PPO_settings['hist_size']
-        device = self.PPO_settings['device']
-        eps_denom = self.PPO_settings['eps_denom']
-        c1 = self.PPO_settings['c1']
-        c2 = self.PPO_settings['c2']
-        clip_param = self.PPO_settings['clip_param']
-        
+        stage = self.stager.stage
         
         mini_batch = self.memory.sample_mini_batch(self.frame_count,
                                                     hist_size)
+        if len(mini_batch) == 0:
+            return None
         mini_batch = np.array(mini_batch).transpose()
         
         states = np.stack(mini_batch[0], axis=0)
-        G_states = np.stack(states[:,0], axis=0)
-        X_states = np.stack(states[:,1], axis=0)
-        avail_states = np.stack(states[:,2], axis=0)
-        hidden_states = np.concatenate(states[:,3], axis=2)
-        prev_actions = np.stack(states[:,4], axis=0)
-        relevant_states = np.stack(states[:,5], axis=0)
-        
-        n = states.shape[0]
-                
         actions = np.array(list(mini_batch[1]))
         spatial_actions = np.stack(actions[:,0],0)
-        first_spatials = spatial_actions[:,0]
-        second_spatials = spatial_actions[:,1]
         nonspatial_acts = np.array(actions[:,1]).astype(np.int64)
         
-        rewards = np.array(list(mini_batch[2]))
-        dones = mini_batch[3]
-        v_returns = mini_batch[5].astype(np.float32)
-        advantages = mini_batch[6].astype(np.float32)
-                
-        first_spatials = torch.from_numpy(first_spatials).to(device)
-        second_spatials = torch.from_numpy(second_spatials).to(device)
-        nonspatial_acts = torch.from_numpy(nonspatial_acts).to(device)
-        nonspatial_acts = nonspatial_acts.unsqueeze(1)
-                
-        rewards = torch.from_numpy(rewards).to(device)
-        dones = torch.from_numpy(np.uint8(dones)).to(device)
-        v_returns = torch.from_numpy(v_returns).to(device)
-        advantages = torch.from_numpy(advantages).to(device)
+        return {
+            "G_states": np.stack(states[:,0], axis=0),
+            "X_states": np.stack(states[:,1], axis=0),
+            "avail_states": np.stack(states[:,2], axis=0),
+            "hidden_states": np.concatenate(states[:,3], axis=2),
+            "prev_actions": np.stack(states[:,4], axis=0),
+            "relevant_states": np.stack(states[:,5], axis=0),
+            "first_spatials": stage("first_spatials", spatial_actions[:,0]),
+            "second_spatials": stage("second_spatials", spatial_actions[:,1]),
+            "nonspatial_acts": stage("nonspatial_acts", nonspatial_acts).unsqueeze(1),
+            "rewards": stage("rewards", np.array(list(mini_batch[2]))),
+            "dones": stage("dones", np.uint8(mini_batch[3])),
+            "v_returns": stage("v_returns", mini_batch[5].astype(np.float32)),
+            "advantages": stage("advantages", mini_batch[6].astype(np.float32))
+        }
+    
+    """
+        batch: minibatch from load_batch, sampled here if None
+    """
+    def train_step(self, batch_size, batch=None):
+    
+        device = self.PPO_settings['device']
+        eps_denom = self.PPO_settings['eps_denom']
+        c1 = self.PPO_settings['c1']
+        c2 = self.PPO_settings['c2']
+        clip_param = self.PPO_settings['clip_param']
+        burn_in = self.PPO_settings.get('burn_in', 0)
+        unroll_chunk = self.PPO_settings.get('unroll_chunk', None)
+        
+        if batch is None:
+            batch = Prefetcher(self.load_batch, 1, self.stager).get()
+        
+        G_states = batch["G_states"]
+        X_states = batch["X_states"]
+        avail_states = batch["avail_states"]
+        hidden_states = batch["hidden_states"]
+        prev_actions = batch["prev_actions"]
+        relevant_states = batch["relevant_states"]
+        
+        n = G_states.shape[0]
+        
+        first_spatials = batch["first_spatials"]
+        second_spatials = batch["second_spatials"]
+        nonspatial_acts = batch["nonspatial_acts"]
+        
+        rewards = batch["rewards"]
+        dones = batch["dones"]
+        v_returns = batch["v_returns"]
+        advantages = batch["advantages"]
                 
         advantages = (advantages - advantages.mean()) 
         advantages = advantages / (torch.clamp(advantages.std(), eps_denom))
@@ -150,7 +185,9 @@ class PPOAgent(Agent):
                                                     avail_states,
                                                     hidden_states,
                                                     prev_actions,
-                                                    relevant_frames=relevant_states
+                                                    relevant_frames=relevant_states,
+                                                    burn_in=burn_in,
+                                                    unroll_chunk=unroll_chunk
                                                     )
                                                     
         old_spatial_probs, old_nonspatial_probs, old_values, _, _ = self.target_model(
@@ -159,7 +196,9 @@ class PPOAgent(Agent):
                                                     avail_states,
                                                     hidden_states,
                                                     prev_actions,
-                                                    relevant_frames=relevant_states
+                                                    relevant_frames=relevant_states,
+                                                    burn_in=burn_in,
+                                                    unroll_chunk=unroll_chunk
                                                     )
         
         gathered_nonspatials = nonspatial_probs.gather(1, nonspatial_acts).squeeze(1)
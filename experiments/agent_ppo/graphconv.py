@@ -103,7 +103,7 @@ class GraphConvModel(nn.Module, Model):
                                         
     
 
-    def forward(self, G, X, avail_actions, LSTM_hidden, prev_actions, relevant_frames=np.array([[1]]), epsilon=0.0, choosing=False):
+    def forward(self, G, X, avail_actions, LSTM_hidden, prev_actions, relevant_frames=np.array([[1]]), epsilon=0.0, choosing=False, burn_in=0, unroll_chunk=None):
     
         self.curr_LSTM_val = LSTM_hidden
     
@@ -118,7 +118,7 @@ class GraphConvModel(nn.Module, Model):
         prev_actions = torch.from_numpy(prev_actions).to(self.device).float()
         relevant_frames = torch.from_numpy(relevant_frames).to(self.device).float()
         
-        LSTM_graph_out, LSTM_hidden = self.graph_LSTM_forward(G, X, LSTM_hidden, prev_actions, relevant_frames)
+        LSTM_graph_out, LSTM_hidden = self.graph_LSTM_forward(G, X, LSTM_hidden, prev_actions, relevant_frames, burn_in, unroll_chunk)
         
         
         
@@ -151,30 +151,66 @@ class GraphConvModel(nn.Module, Model):
         return spatial_policy, nonspatial_policy, value, LSTM_hidden, choice
 
 
-    def graph_LSTM_forward(self, G, X, LSTM_hidden, prev_actions, relevant_frames):
+    """
+        Sequence-level unroll over the D history frames. The graph convolution
+        and LSTM input layer run once over all N * D frames; only the LSTM
+        itself is stepped through time.
+
+        burn_in: number of leading frames that only warm up the hidden state,
+            without gradients
+        chunk_size: if set, the hidden state is detached every chunk_size
+            frames (truncated backpropagation through time)
+    """
+    def graph_LSTM_forward(self, G, X, LSTM_hidden, prev_actions, relevant_frames, burn_in=0, chunk_size=None):
         batch_size, D = G.shape[0], G.shape[1]
-        graph_out_actions = None
-        for i in range(D):
-            G_curr = G[:,i,:,:]
-            X_curr = X[:,i,:,:]
-            relevance = relevant_frames[:,i]
-            
-            graph_out = self.graph_forward(G_curr, X_curr)
-            graph_out_actions = torch.cat([graph_out, prev_actions[:,i,:]], dim=1)
+        keep = relevant_frames.t().reshape((D, 1, batch_size, 1))
+        hidden = (LSTM_hidden[0], LSTM_hidden[1])
 
-            embedded_graph = self.activation(self.LSTM_embed_in(graph_out_actions).reshape((1, batch_size, self.hidden_size)))
-            
+        burn_in = min(burn_in, D-1)
+        if burn_in > 0:
+            with torch.no_grad():
+                embedded, _ = self.embed_frames(G[:,:burn_in], X[:,:burn_in], prev_actions[:,:burn_in])
+                _, hidden = self.recur(embedded, hidden, keep[:burn_in], 0, burn_in)
 
-            output, LSTM_hidden = self.hidden_layer(embedded_graph, tuple(LSTM_hidden))
-            LSTM_hidden = torch.stack(LSTM_hidden)
-            
-            irrelevant_mask = relevance == 0
-            if (irrelevant_mask.size() != torch.Size([0]) and torch.sum(irrelevant_mask) > 0):
+        embedded, graph_out_actions = self.embed_frames(G[:,burn_in:], X[:,burn_in:], prev_actions[:,burn_in:])
+        keep = keep[burn_in:]
+        T = D - burn_in
+        if chunk_size is None:
+            chunk_size = T
+        for start in range(0, T, chunk_size):
+            if start > 0:
+                hidden = (hidden[0].detach(), hidden[1].detach())
+            output, hidden = self.recur(embedded, hidden, keep, start, min(start+chunk_size, T))
 
-                LSTM_hidden[:,:,irrelevant_mask,:] = self.init_hidden(torch.sum(irrelevant_mask), device=self.device)
+        output = torch.cat([output[-1], graph_out_actions[-1]], dim=1)
+        return output, torch.stack(hidden)
 
-        output = torch.cat([output.squeeze(0), graph_out_actions], dim=1)
-        return output, LSTM_hidden
+    """
+        G, X, prev_actions: (N, T, ...) frames
+
+        returns: LSTM inputs (T, N, hidden_size) and the graph features
+            they were computed from, (T, N, fc3_size + action_size)
+    """
+    def embed_frames(self, G, X, prev_actions):
+        N, T = G.shape[0], G.shape[1]
+        graph_out = self.graph_forward(G.flatten(0, 1), X.flatten(0, 1)).reshape((N, T, -1))
+        graph_out_actions = torch.cat([graph_out, prev_actions], dim=2).transpose(0, 1)
+        embedded = self.activation(self.LSTM_embed_in(graph_out_actions))
+        return embedded, graph_out_actions
+
+    """
+        Runs the LSTM over embedded[start:stop]. keep[i] is 0 for the batch
+        entries whose state is reset after frame i, so runs of frames
+        without any reset go through nn.LSTM in a single call.
+    """
+    def recur(self, embedded, hidden, keep, start, stop):
+        resets = (keep[start:stop] == 0).flatten(1).any(1).nonzero().flatten().tolist()
+        ends = sorted(set([start + r + 1 for r in resets] + [stop]))
+        for end in ends:
+            output, hidden = self.hidden_layer(embedded[start:end], hidden)
+            hidden = (hidden[0] * keep[end-1], hidden[1] * keep[end-1])
+            start = end
+        return output, hidden
 
     def graph_forward(self, G, X):
     
@@ -1,13 +1,25 @@
 from config import *
+from base_agent.advantage import vtargets_adv
 from collections import deque
 import utils
 import numpy as np
 import random
 import copy
 
+"""
+    Graphs are kept sparse: per frame only the edge list of G and the rows of
+    X that hold real units, everything past them is graph_n padding. Dense
+    (batch, hist_size, graph_n, graph_n) and (batch, hist_size, graph_n, W)
+    arrays are rebuilt for the whole minibatch in one scatter.
+"""
 class ReplayMemory(object):
-    def __init__(self, mem_cap, hist_size, batch_size):
+    def __init__(self, mem_cap, hist_size, batch_size, min_relevant=0.0):
         self.memory = deque(maxlen=mem_cap)
+        # Episode of every stored frame, a ring indexed like the deque
+        self.episode_ids = np.zeros(mem_cap, dtype=np.int64)
+        self.push_count = 0
+        self.episode_count = 0
+        self.min_relevant = min_relevant
         self.nonspatial_action_space = GraphConvConfigMinigames.action_space
         self.spatial_action_width = GraphConvConfigMinigames.spatial_width
         self.access_num = 0
@@ -16,11 +28,18 @@ class ReplayMemory(object):
         self.indices = []
         self.Memory_capacity = mem_cap
         self.history_size = hist_size
+        self.resample_rounds = 10
         self.update_indices()
     
     def push(self, history, action, reward, done, vtarg, ret, adv, step):
         # history, action, reward, done, vtarg, adv
+        G, X, avail, hidden = history
+        history = [SparseGraph(G[0], X[0]), avail, hidden]
         self.memory.append([history, action, reward, done, vtarg, ret, adv, step])
+        self.episode_ids[self.push_count % self.Memory_capacity] = self.episode_count
+        self.push_count += 1
+        if done:
+            self.episode_count += 1
         
         
     def update_indices(self):
@@ -44,60 +63,30 @@ class ReplayMemory(object):
         lower = self.batch_size*self.access_num
         upper = min((self.batch_size*(self.access_num+1)), sample_range)
 
-        idx_sample = self.indices[lower:upper]
-        states = []
-        for i in idx_sample:
-            sample = []
-            G_samp = []
-            X_samp = []
-            avail_samp = []
-            hidden_samp = []
-            prev_action_samp = []
-            
-            # Boolean array, corresponds to 1 if frame is valid, 0 if frame is from previous episode that ends between i and i+self.history_size
-            relevant_frame = []
-            
-            
-            for j in range(self.history_size):
-                sample.append(self.memory[i + j])
-                #print("\n", self.memory[i+j], "\n")
-                if (self.memory[i+j][-1] == 1):
-                    for k in range(j):
-                    
-                        G_samp[k] = np.zeros(G_samp[k].shape)
-                        X_samp[k] = np.zeros(X_samp[k].shape)
-                        avail_samp[k] = np.zeros(avail_samp[k].shape)
-                        hidden_samp[k] = np.zeros(hidden_samp[k].shape)
-                        action_arr[k] = np.zeros(action_arr[k].shape)
-                        relevant_frame[k] = 0
-                        
-                    
-                G_samp.append(self.memory[i+j][0][0][0])
-                X_samp.append(self.memory[i+j][0][1][0])
-                avail_samp.append(self.memory[i+j][0][2])
-                hidden_samp.append(self.memory[i+j][0][3])
-                
-                #print("avail_actions here: ", self.memory[i+j][0][2].shape)
-                
-                action_arr = utils.action_to_onehot(self.memory[i+j][1], self.nonspatial_action_space, self.spatial_action_width)[0]
-                        
-                prev_action_samp.append(action_arr)
-                
-                relevant_frame.append(1)
-                
-                
-            G_samp = np.array(G_samp)
-            X_samp = np.array(X_samp)
-            avail_samp = np.array(avail_samp)
-            hidden_samp = np.array(hidden_samp)
-            prev_action_samp = np.array(prev_action_samp)
-            relevant_frame = np.array(relevant_frame)
+        idx_sample, relevant_frames = self.relevant_windows(np.array(self.indices[lower:upper], dtype=np.int64))
+        
+        # Windows dropped by min_relevant are replaced with random ones, so
+        # every minibatch holds batch_size windows
+        high = len(self.memory) - self.history_size + 1
+        for _ in range(self.resample_rounds):
+            missing = self.batch_size - len(idx_sample)
+            if missing <= 0 or high <= 1:
+                break
+            extra, extra_frames = self.relevant_windows(np.random.randint(1, high, missing))
+            idx_sample = np.concatenate([idx_sample, extra])
+            relevant_frames = np.concatenate([relevant_frames, extra_frames])
+        
+        samples = [[self.memory[i + j] for j in range(self.history_size)] for i in idx_sample]
+        G_batch, X_batch = densify_graphs([[row[0][0] for row in sample] for sample in samples], relevant_frames)
+        
+        for sample, relevant_frame, G_samp, X_samp in zip(samples, relevant_frames, G_batch, X_batch):
+            avail_samp = np.array([row[0][1] for row in sample])
+            hidden_samp = mask_frames(np.array([row[0][2] for row in sample]), relevant_frame)
+            prev_action_samp = np.array([utils.action_to_onehot(row[1], self.nonspatial_action_space, self.spatial_action_width)[0]
+                                            for row in sample])
+            prev_action_samp = mask_frames(prev_action_samp, relevant_frame)
             
-            #sample = np.array(sample)
             row = copy.deepcopy(sample[self.history_size-1])
-            #print(row)
-            #print(sample.shape, row.shape, sample[:,0].shape, sample[0,:].shape, sample[:,0][0].shape, sample[0].shape, type(sample[:,0]), type(sample[:,0][0]))
-            #print(avail_samp.shape)
             row[0] = np.array([G_samp, X_samp, avail_samp[-1], hidden_samp[0], prev_action_samp, relevant_frame])
             mini_batch.append(row)
 
@@ -108,22 +97,87 @@ class ReplayMemory(object):
 
         return mini_batch
         
+    """
+        Windows starting at idx_sample that pass the min_relevant filter, and
+        their relevant flags: 1 where the frame is in the same episode as the
+        window's last frame, 0 where it belongs to an earlier episode.
+    """
+    def relevant_windows(self, idx_sample):
+        window = idx_sample[:,None] + np.arange(self.history_size)
+        oldest = self.push_count - len(self.memory)
+        episodes = self.episode_ids[(oldest + window) % self.Memory_capacity]
+        relevant_frames = (episodes == episodes[:,-1:]).astype(np.uint8)
+        keep = relevant_frames.sum(axis=1) >= self.min_relevant * self.history_size
+        return idx_sample[keep], relevant_frames[keep]
+
     def compute_vtargets_adv(self, gamma, lam):
-        N = len(self)
+        rewards = np.array([row[2] for row in self.memory])
+        dones = np.array([row[3] for row in self.memory])
+        values = np.array([row[4] for row in self.memory])
+        advantages, returns = vtargets_adv(rewards, values, dones, gamma, lam)
         
-        prev_gae_t = 0
-       
-        
-        for i in reversed(range(N-1)):
-            
-            vnext = self.memory[i+1][4]
-            nonterminal = 1 - self.memory[i+1][3]    # 1 - done
-            delta = self.memory[i][2] + gamma * vnext * nonterminal - self.memory[i][4]
-            gae_t = delta + gamma * lam * nonterminal * prev_gae_t
-            self.memory[i][6] = gae_t    # advantage
-            self.memory[i][5] = gae_t + self.memory[i][4]  # advantage + value
-            prev_gae_t = gae_t
+        for row, adv, ret in zip(self.memory, advantages, returns):
+            row[6] = adv    # advantage
+            row[5] = ret    # advantage + value
         
 
     def __len__(self):
         return len(self.memory)
+
+
+"""
+    Zeroes the frames of x (history on the first axis) whose relevant flag is 0.
+"""
+def mask_frames(x, relevant):
+    return x * relevant.reshape((-1,) + (1,) * (x.ndim - 1)).astype(x.dtype)
+
+
+"""
+    G: (graph_n, graph_n) adjacency, X: (graph_n, W) unit features, both
+    zero past the last real unit
+"""
+class SparseGraph(object):
+    def __init__(self, G, X):
+        self.graph_n = G.shape[0]
+        self.edges = np.array(np.nonzero(G), dtype=np.uint8)
+        self.weights = G[tuple(self.edges)].astype(np.float32)
+        nonzero_rows = np.flatnonzero(np.any(X != 0, axis=1))
+        self.num_units = nonzero_rows[-1] + 1 if len(nonzero_rows) > 0 else 0
+        self.units = X[:self.num_units].astype(np.float32)
+
+
+"""
+    Rebuilds dense adjacency and feature matrices for a minibatch of windows
+    of sparse graphs. Frames whose relevant flag is 0 are left as zeros.
+
+    windows: N lists of H SparseGraphs
+    relevant: (N, H) relevant flags
+
+    returns: G (N, H, graph_n, graph_n), X (N, H, graph_n, W)
+"""
+def densify_graphs(windows, relevant):
+    if len(windows) == 0:
+        return np.zeros((0,), dtype=np.float32), np.zeros((0,), dtype=np.float32)
+    N, H = len(windows), len(windows[0])
+    graph_n = windows[0][0].graph_n
+    width = windows[0][0].units.shape[1]
+    G = np.zeros((N, H, graph_n, graph_n), dtype=np.float32)
+    X = np.zeros((N, H, graph_n, width), dtype=np.float32)
+
+    frames = [(n, h) for n, h in zip(*np.nonzero(relevant))]
+    if len(frames) == 0:
+        return G, X
+    graphs = [windows[n][h] for n, h in frames]
+
+    edge_counts = [g.edges.shape[1] for g in graphs]
+    edge_batch = np.repeat([n for n, _ in frames], edge_counts)
+    edge_frames = np.repeat([h for _, h in frames], edge_counts)
+    edges = np.concatenate([g.edges for g in graphs], axis=1)
+    G[edge_batch, edge_frames, edges[0], edges[1]] = np.concatenate([g.weights for g in graphs])
+
+    unit_counts = [g.num_units for g in graphs]
+    unit_batch = np.repeat([n for n, _ in frames], unit_counts)
+    unit_frames = np.repeat([h for _, h in frames], unit_counts)
+    unit_rows = np.concatenate([np.arange(count) for count in unit_counts])
+    X[unit_batch, unit_frames, unit_rows] = np.concatenate([g.units for g in graphs])
+    return G, X
@@ -75,6 +75,8 @@ def main():
         "discount_factor": 0.99,
         "lambda": 0.95,
         "hist_size": 8,
+        "burn_in": 0,
+        "unroll_chunk": None,
         "device": device,
         "eps_denom": 1e-6,
         "c1": 1.0,
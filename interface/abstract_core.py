@@ -89,6 +89,10 @@ class Experiment:
                     and e % self.run_settings.graph_every == 0):
                 self.plot_results(averages_history)
 
+        for agent in self.agents:
+            if hasattr(agent, 'finish'):
+                agent.finish()
+
     def test(self):
         """
         Tests the agents using the custom environment
@@ -7,7 +7,8 @@ import time
 
 from agent import Model
 
-from base_agent.sc2env_utils import generate_embeddings, multi_embed, valid_args, get_action_args, is_spatial_arg, env_config, processed_feature_dim
+from base_agent.sc2env_utils import generate_embeddings, multi_embed, valid_args, env_config, processed_feature_dim
+from base_agent.action_tables import spatial_arg_ids, nonspatial_arg_ids, tables_on
 from base_agent.net_utils import ConvLSTM, ResnetBlock, SelfAttentionBlock, Downsampler, SpatialUpsampler, Unsqueeze, Squeeze, FastEmbedding
 
 class BaseNetwork(nn.Module, Model):
@@ -242,7 +243,7 @@ class BaseNetwork(nn.Module, Model):
         return self.convLSTM.init_hidden_state(batch_size=batch_size, use_torch=use_torch, device=device)
 
     def embed_inputs(self, inputs):
-        return multi_embed(inputs, self.state_embeddings, self.state_embedding_indices)
+        return multi_embed(inputs, self.state_embeddings)
 
 
     def sample_func(self, probs):
@@ -278,9 +279,69 @@ class BaseNetwork(nn.Module, Model):
                                             arg_index % self.spatial_size])
         return spatial_arg_out
 
-    def generate_arg_logits(self, arg_logit_inputs):
+    """
+        Draws one index per row of probs (..., K) on the device by inverting
+        the cumulative sum; rows need not be normalized. One cumsum and one
+        searchsorted cover every row, which is much cheaper than
+        torch.multinomial for many short rows.
+    """
+    @staticmethod
+    def sample_categorical(probs):
+        cdf = probs.float().cumsum(dim=-1)
+        total = cdf[..., -1:]
+        # rand * total can round up to total; staying strictly below it keeps
+        # searchsorted off the zero probability entries after the last positive one
+        u = torch.minimum(torch.rand_like(total) * total, torch.nextafter(total, torch.zeros_like(total)))
+        return torch.searchsorted(cdf, u, right=True).clamp_(max=cdf.shape[-1] - 1).squeeze(-1)
+
+    """
+        Draws one base action per environment on the device.
+
+        action_probs: (N, num_actions) probabilities
+        Returns an (N,) int64 tensor on the same device.
+    """
+    def sample_actions(self, action_probs):
+        return self.sample_categorical(action_probs)
+
+    """
+        Draws the arguments of the sampled actions for N environments on the
+        device, with one draw over every non-spatial arg row and one over
+        every flattened spatial map. Arguments the action does not take
+        are 0 (non-spatial) or -1 (spatial), as in sample_arg and
+        sample_spatial.
+
+        arg_probs: (N, arg_depth, max_arg_size)
+        spatial_probs: (N, spatial_depth, H, W)
+        actions: (N,) int64, on the same device
+        Returns args (N, arg_depth) and spatial (N, spatial_depth, 2).
+    """
+    def sample_action_args(self, arg_probs, spatial_probs, actions):
+        N, _, H, W = spatial_probs.shape
+        tables = tables_on(actions.device)
+        args = self.sample_categorical(arg_probs) * tables["nonspatial_arg_mask"][actions]
+
+        spatial_index = self.sample_categorical(spatial_probs.flatten(2))
+        spatial = torch.stack([spatial_index // W, spatial_index % W], dim=-1)
+        spatial = spatial.masked_fill(tables["spatial_arg_mask"][actions].unsqueeze(-1) == 0, -1)
+        return args, spatial
+
+    """
+        Copies sampled actions to the host in a single transfer and splits
+        them into one [action, args, spatial] choice per environment.
+    """
+    def choices_to_host(self, actions, args, spatial):
+        packed = torch.cat([actions.unsqueeze(1), args, spatial.flatten(1)], dim=1).cpu().numpy()
+        arg_depth = args.shape[1]
+        return [[int(row[0]), row[1:1+arg_depth], row[1+arg_depth:].reshape((-1, 2))] for row in packed]
+
+    """
+        arg_types: optional indices into the arg_depth rows, when arg_logit_inputs
+        holds only those rows
+    """
+    def generate_arg_logits(self, arg_logit_inputs, arg_types=None):
+        valid = self.valid_args if arg_types is None else self.valid_args[:, arg_types]
         #initial_logits = F.softmax(arg_logit_inputs * self.valid_args, dim=-1)
-        initial_logits = F.softmax(arg_logit_inputs.masked_fill((1-self.valid_args).bool(), float('-inf')), dim=-1)
+        initial_logits = F.softmax(arg_logit_inputs.masked_fill((1-valid).bool(), float('-inf')), dim=-1, dtype=torch.float32)
         final_logits = initial_logits
         #final_logits = initial_logits / torch.sum(initial_logits, dim=-1).unsqueeze(2)
         #print(list(initial_logits[0,0].cpu().data.numpy()), list(final_logits[0,0].cpu().data.numpy()))
@@ -289,20 +350,16 @@ class BaseNetwork(nn.Module, Model):
     def generate_spatial_logits(self, spatial_logits_in):
         (N, D, H, W) = spatial_logits_in.shape
         x = spatial_logits_in.flatten(start_dim=-2, end_dim=-1)
-        logits = F.softmax(x, dim=-1)
+        logits = F.softmax(x, dim=-1, dtype=torch.float32)
         #print(list(logits.cpu().data.numpy()[0,0]))
         logits = logits.view((N, D, H, W))
         return logits
 
     def action_to_nonspatial_args(self, action):
-        args = get_action_args(action)
-        args = [i for i in args if not is_spatial_arg(i)]
-        return args
+        return nonspatial_arg_ids[action]
 
     def action_to_spatial_args(self, action):
-        args = get_action_args(action)
-        args = [i for i in args if is_spatial_arg(i)]
-        return args
+        return spatial_arg_ids[action]
 
 
 
@@ -0,0 +1,80 @@
+"""
+    Bit-packed available action masks.
+
+    pysc2 exposes availability as a list of action ids, which state_processor
+    turns into a length action_space vector. Stored as bits, one mask takes
+    ceil(action_space / 8) bytes instead of action_space floats, and only
+    ever gets unpacked on the training device.
+
+    Most maps only ever show a handful of distinct masks, so MaskCache keeps
+    every mask it has seen unpacked on the device and turns a batch of packed
+    masks into a single gather.
+"""
+
+import numpy as np
+import torch
+
+from base_agent.sc2env_utils import env_config
+
+
+packed_mask_size = (env_config["action_space"] + 7) // 8
+
+"""
+    avail: (..., action_space), nonzero where an action is available
+
+    returns: (..., packed_mask_size) uint8, little endian bit order
+"""
+def pack_masks(avail):
+    return np.packbits(np.asarray(avail) != 0, axis=-1, bitorder="little")
+
+"""
+    Device side inverse of pack_masks.
+
+    packed: (..., packed_mask_size) uint8 tensor
+
+    returns: (..., num_actions) uint8 tensor of 0/1 on the same device
+"""
+def unpack_masks(packed, num_actions=env_config["action_space"]):
+    shifts = torch.arange(8, dtype=torch.uint8, device=packed.device)
+    bits = (packed.unsqueeze(-1) >> shifts) & 1
+    return bits.reshape(packed.shape[:-1] + (-1,))[..., :num_actions]
+
+
+class MaskCache(object):
+    def __init__(self, device, num_actions=env_config["action_space"], capacity=4096):
+        self.device = device
+        self.num_actions = num_actions
+        self.capacity = capacity
+        self.clear()
+
+    def clear(self):
+        self.ids = {}
+        self.table = torch.zeros((0, self.num_actions), dtype=torch.uint8, device=self.device)
+
+    """
+        packed: (N, packed_mask_size) uint8 array, see pack_masks
+
+        returns: (N, num_actions) uint8 tensor on device
+    """
+    def lookup(self, packed):
+        packed = np.asarray(packed, dtype=np.uint8)
+        keys = [row.tobytes() for row in packed]
+        unique_keys = list(dict.fromkeys(keys))
+        if len(unique_keys) > self.capacity:
+            # More distinct masks than the cache can hold, unpack the batch directly
+            return unpack_masks(torch.from_numpy(packed).to(self.device), self.num_actions)
+
+        new_keys = [k for k in unique_keys if k not in self.ids]
+        if len(self.ids) + len(new_keys) > self.capacity:
+            self.clear()
+            new_keys = unique_keys
+
+        if new_keys:
+            new_packed = np.stack([np.frombuffer(k, dtype=np.uint8) for k in new_keys])
+            new_masks = unpack_masks(torch.from_numpy(new_packed).to(self.device), self.num_actions)
+            for k in new_keys:
+                self.ids[k] = len(self.ids)
+            self.table = torch.cat([self.table, new_masks], dim=0)
+
+        ids = torch.tensor([self.ids[k] for k in keys], dtype=torch.long, device=self.device)
+        return self.table[ids]
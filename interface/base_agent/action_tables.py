@@ -0,0 +1,53 @@
+"""
+    Dense lookup tables compiled from pysc2's FUNCTIONS at import, so that
+    sampling, the PPO loss and action_to_pysc2 index arrays instead of
+    walking FUNCTIONS._func_list[...].args every step.
+
+    Argument types follow pysc2's TYPES: ids 0-2 are the spatial arguments
+    (screen, minimap, screen2), ids 3-12 are the non-spatial ones, stored by
+    the networks at position id - 3.
+"""
+
+import numpy as np
+import torch
+from pysc2.lib.actions import FUNCTIONS, TYPES
+
+
+num_functions = len(FUNCTIONS)
+num_arg_types = len(TYPES)
+num_spatial_args = 3
+
+"""
+    arg_ids[a]: argument type ids of function a, in pysc2's call order
+    arg_type_mask[a, t]: 1 if function a takes an argument of type t
+    spatial_arg_mask, nonspatial_arg_mask: the two halves of arg_type_mask
+    spatial_arg_ids[a], nonspatial_arg_ids[a]: type ids of each kind
+    arg_sizes[t]: number of values argument type t can take (0 for the
+        spatial types, whose size depends on the resolution)
+"""
+arg_ids = [np.array([arg.id for arg in func.args], dtype=np.int64) for func in FUNCTIONS]
+arg_type_mask = np.zeros((num_functions, num_arg_types), dtype=np.uint8)
+for func in FUNCTIONS:
+    arg_type_mask[func.id, arg_ids[func.id]] = 1
+spatial_arg_mask = arg_type_mask[:, :num_spatial_args]
+nonspatial_arg_mask = arg_type_mask[:, num_spatial_args:]
+spatial_arg_ids = [ids[ids < num_spatial_args] for ids in arg_ids]
+nonspatial_arg_ids = [ids[ids >= num_spatial_args] for ids in arg_ids]
+arg_sizes = np.array([arg_type.sizes[0] for arg_type in TYPES], dtype=np.int64)
+
+
+device_tables = {}
+
+"""
+    The mask and size tables as tensors on device, built once per device.
+"""
+def tables_on(device):
+    key = str(device)
+    if key not in device_tables:
+        device_tables[key] = {
+            "arg_type_mask": torch.from_numpy(arg_type_mask).to(device),
+            "spatial_arg_mask": torch.from_numpy(np.ascontiguousarray(spatial_arg_mask)).to(device),
+            "nonspatial_arg_mask": torch.from_numpy(np.ascontiguousarray(nonspatial_arg_mask)).to(device),
+            "arg_sizes": torch.from_numpy(arg_sizes).to(device)
+        }
+    return device_tables[key]
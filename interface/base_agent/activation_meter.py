@@ -0,0 +1,43 @@
+"""
+    Activation memory accounting for training steps.
+
+    What limits the batch size is the activation memory: the tensors autograd
+    keeps alive between a forward pass and its backward pass. ActivationMeter
+    records them through saved tensor hooks while a forward pass runs, so it
+    works the same on the CPU and on CUDA. Tensors sharing a storage are
+    counted once, and model parameters are not counted.
+"""
+
+import torch
+
+
+class ActivationMeter(object):
+    def __init__(self, model):
+        self.parameters = set(p.data_ptr() for p in model.parameters())
+        self.storages = {}
+        self.hooks = None
+
+    def __enter__(self):
+        self.storages = {}
+        self.hooks = torch.autograd.graph.saved_tensors_hooks(self.pack, self.unpack)
+        self.hooks.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.hooks.__exit__(*exc_info)
+        self.hooks = None
+
+    def pack(self, tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in self.parameters:
+            self.storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    def unpack(self, tensor):
+        return tensor
+
+    """
+        Bytes saved for backward by the forward passes run inside the context
+    """
+    def nbytes(self):
+        return sum(self.storages.values())
@@ -0,0 +1,84 @@
+"""
+    Vectorized generalized advantage estimation shared by the replay memories.
+
+    Every function works on NumPy arrays or torch tensors (on any device) laid
+    out with time on the first axis, either (T,) for a single rollout or (T, N)
+    for N rollouts/environments computed at once.
+
+    The reverse discounted scan
+
+        x[t] = b[t] + a[t] * x[t+1],    x[T] = 0
+
+    is evaluated with log2(T) doubling passes over whole arrays instead of a
+    Python loop over T. Coefficients are products of gamma, lambda and episode
+    masks, so they stay in [0, 1] and the scan is numerically stable.
+"""
+
+import numpy as np
+import torch
+
+
+def reverse_scan(coeffs, values):
+    if torch.is_tensor(values):
+        x = values.clone()
+        a = coeffs.to(x.dtype).clone()
+    else:
+        dtype = np.result_type(values, np.float32)
+        x = np.array(values, dtype=dtype)
+        a = np.array(coeffs, dtype=dtype)
+
+    T = len(x)
+    shift = 1
+    while shift < T:
+        x[:-shift] = x[:-shift] + a[:-shift] * x[shift:]
+        a[:-shift] = a[:-shift] * a[shift:]
+        shift *= 2
+    return x
+
+
+"""
+    rewards, values, next_values, nonterminals: (T,) or (T, N)
+
+    nonterminals[t] is 0 where the bootstrap from step t to next_values[t]
+    crosses an episode boundary, 1 otherwise.
+
+    returns: advantages, value targets (advantages + values)
+"""
+def gae(rewards, values, next_values, nonterminals, gamma, lam):
+    deltas = rewards + gamma * next_values * nonterminals - values
+    advantages = reverse_scan(gamma * lam * nonterminals, deltas)
+    return advantages, advantages + values
+
+
+"""
+    Matches the convention of the memories in this repository: step t
+    bootstraps from values[t+1], masked by 1 - dones[t+1].
+
+    If last_value is None the final step has no successor and gets an
+    advantage of 0, otherwise it bootstraps from last_value unmasked.
+"""
+def vtargets_adv(rewards, values, dones, gamma, lam, last_value=None):
+    if torch.is_tensor(values):
+        values = values.float()
+        rewards = rewards.to(values.dtype)
+        nonterminals = 1 - dones.to(values.dtype)
+        next_values = torch.zeros_like(values)
+        next_nonterminals = torch.zeros_like(values)
+    else:
+        values = np.asarray(values, dtype=np.result_type(values, np.float32))
+        rewards = np.asarray(rewards, dtype=values.dtype)
+        nonterminals = 1 - np.asarray(dones, dtype=values.dtype)
+        next_values = np.zeros_like(values)
+        next_nonterminals = np.zeros_like(values)
+
+    next_values[:-1] = values[1:]
+    next_nonterminals[:-1] = nonterminals[1:]
+    if last_value is not None:
+        next_values[-1] = last_value
+        next_nonterminals[-1] = 1
+
+    deltas = rewards + gamma * next_values * next_nonterminals - values
+    if last_value is None:
+        deltas[-1] = 0
+    advantages = reverse_scan(gamma * lam * next_nonterminals, deltas)
+    return advantages, advantages + values
@@ -20,7 +20,15 @@
 
 
 from agent import Agent, Model, Memory, AgentSettings
-from base_agent.sc2env_utils import batch_get_action_args, is_spatial_arg, env_config
+from checkpoint import Checkpointer, rng_state, set_rng_state
+from base_agent.sc2env_utils import env_config
+from base_agent.action_tables import tables_on
+from base_agent.memory import widen_planes
+from base_agent.prefetch import Prefetcher, PinnedStager
+from base_agent.action_masks import MaskCache, pack_masks
+from base_agent.activation_meter import ActivationMeter
+from base_agent.inference import InferencePolicy
+from base_agent.data_parallel import DataParallelLearner
 
 import torch
 import torch.nn as nn
@@ -30,6 +38,7 @@ import torch.optim as optim
 import numpy as np
 import time
 import math
+import contextlib
 import matplotlib.pyplot as plt
 import sys
 import copy
@@ -43,15 +52,26 @@ class BaseAgent(Agent):
         self.frame_count = 0
         self.epochs_trained = 0
         self.train_settings = train_settings
-        self.target_model = copy.deepcopy(model)
         self.hidden_state = self.model.init_hidden(use_torch=False)
         self.prev_hidden_state = None
+        self.log_prob = 0.0
+        self.peak_activation_bytes = 0
         self.action = [0, np.zeros(10), np.zeros((3,2))]
         self.device = train_settings["device"]
+        self.mask_cache = MaskCache(self.device)
+        self.action_tables = tables_on(self.device)
+        self.stager = PinnedStager(self.device, 4)
         self.loss = nn.MSELoss()
         self.map = train_settings["map"]
         self.history_size = train_settings["history_size"]
         self.history = self.init_history()
+        self.checkpointer = Checkpointer(self.model_path(), keep_last=train_settings.get("keep_checkpoints", 3))
+        self.learner = None
+        if train_settings.get("data_parallel", False):
+            self.learner = DataParallelLearner(self.model)
+        self.policy = None
+        if train_settings.get("traced_inference", False):
+            self.policy = InferencePolicy(self.model, autocast=self.autocast)
 
     def init_history(self):
         """
@@ -70,26 +90,56 @@ class BaseAgent(Agent):
 
 
 
+    """
+        Context every model forward pass runs in. With train_settings["bf16"]
+        set, convolutions and matmuls run in bfloat16 under autocast. The
+        networks return policies in float32, and the log-probabilities and
+        losses are computed outside the context in float32.
+    """
+    def autocast(self):
+        return torch.autocast(torch.device(self.device).type, dtype=torch.bfloat16,
+                                enabled=self.train_settings.get("bf16", False))
+
     def _forward(self, agent_state, choosing=True):
         (curr_minimap, curr_screen, curr_player, avail_actions) = agent_state
         #[curr_minimap, curr_screen] = self.model.embed_inputs([curr_minimap, curr_screen])
         #m_depth, s_depth, p_depth = curr_minimap.shape[1], curr_screen.shape[1], p_depth.shape[1]
         minimap, screen, spatial_actions = self.history
         #### @TODO: Rework history to be of (1, history_size, depth, width, height)
-        minimap[0,1:] = minimap[0,:-1]
-        minimap[0,0] = curr_minimap
-        screen[0,1:] = screen[0,:-1]
-        screen[0,0] = curr_screen
+        # Oldest frame first, each paired with the spatial arguments of the
+        # action taken before it: the window ReplayMemory.gather rebuilds
+        # for training, so the stored log-probability scores the same input
+        minimap[0,:-1] = minimap[0,1:]
+        minimap[0,-1] = curr_minimap
+        screen[0,:-1] = screen[0,1:]
+        screen[0,-1] = curr_screen
+        spatial_actions[0,:-1] = spatial_actions[0,1:]
+        spatial_actions[0,-1] = self.action[2]
         self.prev_hidden_state = copy.deepcopy(self.hidden_state)
-        _, _, _, self.hidden_state, value, action = self.model(minimap,
-                                                            screen,
-                                                            curr_player,
-                                                            avail_actions,
-                                                            np.array([self.action[0]]),
-                                                            spatial_actions,
-                                                            self.hidden_state,
-                                                            choosing=choosing)
-        return _, _, value.cpu().data.numpy().item(), self.hidden_state.cpu().data.numpy(), action
+        avail_actions = self.mask_cache.lookup(pack_masks(np.reshape(avail_actions, (1, -1))))
+        if choosing and self.policy is not None:
+            action_probs, arg_probs, spatial_probs, self.hidden_state, value, action = self.policy(minimap,
+                                                                screen,
+                                                                curr_player,
+                                                                avail_actions,
+                                                                np.array([self.action[0]]),
+                                                                spatial_actions,
+                                                                self.hidden_state)
+        else:
+            with self.autocast():
+                action_probs, arg_probs, spatial_probs, self.hidden_state, value, action = self.model(minimap,
+                                                                    screen,
+                                                                    curr_player,
+                                                                    avail_actions,
+                                                                    np.array([self.action[0]]),
+                                                                    spatial_actions,
+                                                                    self.hidden_state,
+                                                                    choosing=choosing)
+        value = value.float()
+        self.hidden_state = self.hidden_state.float()
+        if choosing:
+            self.log_prob = self.behaviour_log_prob(action_probs, arg_probs, spatial_probs, action)
+        return action_probs, arg_probs, value.cpu().data.numpy().item(), self.hidden_state.cpu().data.numpy(), action
 
     def _sample(self, agent_state):
         _, _, self.value, self.hidden_state, self.action = self._forward(agent_state, choosing=True)
@@ -104,13 +154,24 @@ class BaseAgent(Agent):
         return personal_action
 
     def train(self, run_settings):
+        if self.learner is not None and not self.learner.agree_to_train():
+            return
         self.memory.compute_vtargets_adv(self.train_settings['discount_factor'],
                                             self.train_settings['lambda'])
         self.model.train()
         batch_size = run_settings.batch_size
-        num_iters = int(len(self.memory) / batch_size)
         epochs = run_settings.num_epochs
 
+        # Every epoch visits each stored window exactly once
+        epoch_plans = [self.memory.epoch(batch_size, self.train_settings.get("num_minibatches")) for _ in range(epochs)]
+        num_iters = len(epoch_plans[0])
+        if self.learner is not None:
+            # Data-parallel ranks must take the same number of steps
+            num_iters = self.learner.agree_min(num_iters)
+        plan = iter([indices for epoch_plan in epoch_plans for indices in epoch_plan[:num_iters]])
+
+        prefetcher = Prefetcher(lambda: self.load_batch(next(plan)), epochs * num_iters, self.stager)
+
         for i in range(epochs):
 
             pol_loss = 0
@@ -119,14 +180,13 @@ class BaseAgent(Agent):
 
             for j in range(num_iters):
 
-                d_pol, d_vf, d_ent = self.train_step(batch_size)
+                d_pol, d_vf, d_ent = self.train_step(batch_size, prefetcher.get())
                 if (math.isnan(d_pol) or math.isnan(d_vf) or math.isnan(d_ent)):
                     print("Canceling training -- NaN's encountered")
                     print("Reloading model from previous save")
                     sys.exit(0)
                     """
                     self.load()
-                    self.update_target_net()
                     return
                     """
                 pol_loss += d_pol
@@ -143,182 +203,197 @@ class BaseAgent(Agent):
                             vf_loss,
                             ent_total)
                             )
-        self.update_target_net()
         self.model.eval()
+        self.update_policy()
 
         print("\n\n ------- Training sequence ended ------- \n\n")
 
-    def train_step(self, batch_size):
-
-        with torch.autograd.detect_anomaly():
-            t1 = time.time()
-
-            device = self.train_settings['device']
-            eps_denom = self.train_settings['eps_denom']
-            c1 = self.train_settings['c1']
-            c2 = self.train_settings['c2']
-            c3 = self.train_settings['c3']
-            c4 = self.train_settings['c4']
-            clip_param = self.train_settings['clip_param']
-
-            mini_batch = self.memory.sample_mini_batch(self.frame_count)
-            t2 = time.time()
-            n = len(mini_batch)
-            mini_batch = np.array(mini_batch).transpose()
-
-            states = np.stack(mini_batch[0], axis=0)
-            actions = np.stack(np.array(mini_batch[1]), axis=0)
-            minimaps = np.stack(states[:,0], axis=0).squeeze(2)
-            screens = np.stack(states[:,1], axis=0).squeeze(2)
-            hiddens = np.concatenate(states[:,4], axis=0)
-            spatial_args = np.stack(actions[:,2], 0).astype(np.int64)
-
-            T = minimaps.shape[1]
-            prev_actions = np.stack(states[:,6], 0).squeeze(1)
-            stacked_prev = prev_actions.reshape((n * T,) + prev_actions.shape[2:])
-            prev_base_actions = torch.from_numpy(np.stack(stacked_prev[:,0], 0).astype(np.int64)).to(self.device)
-            prev_spatial_actions = np.stack(stacked_prev[:,2], 0).astype(np.int64)
-            prev_base_actions = prev_base_actions.reshape((n, T) + prev_base_actions.shape[1:])
-            prev_spatial_actions = prev_spatial_actions.reshape((n, T) + prev_spatial_actions.shape[1:])
-
-            #minimaps, screens, hiddens, spatial_args, prev_spatial_actions = self.memory.batch_random_transform(minimaps, screens, hiddens, spatial_args, prev_spatial_actions)
-
-            minimaps = torch.from_numpy(minimaps.copy()).float().to(self.device)
-            screens = torch.from_numpy(screens.copy()).float().to(self.device)
-            players = torch.from_numpy(np.stack(states[:,2], axis=0).squeeze(2)).float().to(self.device)
-            avail_actions = torch.from_numpy(np.stack(states[:,3], axis=0)).byte().to(self.device)
-            hidden_states = torch.from_numpy(hiddens.copy()).float().to(self.device)
-            old_hidden_states = torch.from_numpy(np.concatenate(states[:,5], axis=0)).float().to(self.device)
-            #prev_base_actions = torch.from_numpy(prev_base_actions).long().to(self.device)
-            prev_spatial_actions = torch.from_numpy(prev_spatial_actions).long().to(self.device)
-            relevant_states = torch.from_numpy(np.stack(states[:,7], axis=0)).byte().to(self.device)
-
-            base_actions = np.stack(actions[:,0], 0).astype(np.int64).squeeze(1)
-            args = np.stack(actions[:,1], 0).astype(np.int64)
-
-            rewards = np.array(list(mini_batch[2]))
-            dones = mini_batch[3]
-            v_returns = mini_batch[5].astype(np.float32)
-            advantages = mini_batch[6].astype(np.float32)
-
-            rewards = torch.from_numpy(rewards).float().to(self.device)
-            advantages = torch.from_numpy(advantages).float().to(self.device)
-            advantages = (advantages - advantages.mean()) / advantages.std()
-            v_returns = torch.from_numpy(v_returns).float().to(self.device)
-            dones = torch.from_numpy(dones.astype(np.uint8)).byte().to(self.device)
-            base_actions = torch.from_numpy(base_actions).to(self.device)
-            t3 = time.time()
-
-            # minimaps, screens, players, avail_actions, last_actions, hiddens, curr_actions, relevant_frames
-            action_probs, arg_probs, spatial_probs, _, values, _ = self.model.simple_forward(
-                minimaps,
-                screens,
-                players,
-                avail_actions,
-                prev_base_actions,
-                prev_spatial_actions,
-                hidden_states,
-                base_actions,
-                relevant_states
-            )
+    """
+        Called once the agent will not train any more. In data-parallel mode
+        this tells the other ranks to stop training too.
+    """
+    def finish(self):
+        if self.learner is not None:
+            self.learner.finish()
 
-            old_action_probs, old_arg_probs, old_spatial_probs, _, _, _ = self.target_model.simple_forward(
-                minimaps,
-                screens,
-                players,
-                avail_actions,
-                prev_base_actions,
-                prev_spatial_actions,
-                old_hidden_states,
-                base_actions,
-                relevant_states
-            )
-            t4 = time.time()
+    """
+        Gathers the windows starting at indices (one minibatch of
+        memory.epoch), or the memory's next minibatch if None, and moves them
+        to the device through self.stager. Runs on the Prefetcher worker
+        thread during training.
+    """
+    def load_batch(self, indices=None):
+        if indices is None:
+            batch = self.memory.sample_mini_batch(self.frame_count)
+        else:
+            batch = self.memory.gather(indices)
+        stage = self.stager.stage
+        frame_index = stage("frame_index", batch["frame_index"], torch.long)
+
+        #batch["minimaps"], batch["screens"], batch["hiddens"], batch["spatial_args"], batch["prev_spatials"] = self.memory.batch_random_transform(batch["minimaps"], batch["screens"], batch["hiddens"], batch["spatial_args"], batch["prev_spatials"])
+
+        minimaps = [self.stager.stage_views("minimaps_%d" % g, views) for g, views in enumerate(batch["minimaps"])]
+        screens = [self.stager.stage_views("screens_%d" % g, views) for g, views in enumerate(batch["screens"])]
+        return {
+            "minimaps": widen_planes(minimaps, env_config["minimap_storage_groups"])[frame_index],
+            "screens": widen_planes(screens, env_config["screen_storage_groups"])[frame_index],
+            "players": stage("players", batch["players"], torch.float32),
+            "avail": self.mask_cache.lookup(batch["avail"]),
+            "hiddens": stage("hiddens", batch["hiddens"], torch.float32),
+            "prev_actions": stage("prev_actions", batch["prev_actions"], torch.long),
+            "prev_spatials": stage("prev_spatials", batch["prev_spatials"], torch.long),
+            "relevant": stage("relevant", batch["relevant"], torch.uint8),
+            "actions": stage("actions", batch["actions"]),
+            "args": batch["args"],
+            "spatial_args": batch["spatial_args"],
+            "advantages": stage("advantages", batch["advantages"], torch.float32),
+            "returns": stage("returns", batch["returns"], torch.float32),
+            "log_probs": stage("log_probs", batch["log_probs"], torch.float32)
+        }
 
-            gathered_actions = action_probs[range(n), base_actions]
-            old_gathered_actions = old_action_probs[range(n), base_actions]
+    """
+        batch: minibatch from load_batch, sampled here if None
+
+        With train_settings["micro_batch_size"] set, the minibatch goes
+        through the model in slices of that size and their gradients are
+        accumulated before the single optimizer step, so only one slice's
+        activations are alive at a time. Advantages are normalized over the
+        whole minibatch first, and the returned losses are those of the
+        whole minibatch. train_settings["verbose"] prints the ranges of the
+        gathered probabilities and ratios, and the step timings.
+
+        With train_settings["measure_activations"] set, the activation memory
+        of each slice is recorded and the peak is kept in
+        self.peak_activation_bytes and printed.
+    """
+    def train_step(self, batch_size, batch=None):
+        t1 = time.time()
+        verbose = self.train_settings.get("verbose", False)
 
-            gathered_args, old_gathered_args = self.index_args(arg_probs, old_arg_probs, args)
+        c1 = self.train_settings['c1']
+        c2 = self.train_settings['c2']
 
-            gathered_spatial_args, old_gathered_spatial_args = self.index_spatial(spatial_probs,
-                                                                                old_spatial_probs,
-                                                                                spatial_args)
-            action_args = batch_get_action_args(base_actions)
-            """
-            numerator = torch.zeros((n,)).float().to(self.device)
-            denominator = torch.zeros((n,)).float().to(self.device)
-            entropy = torch.zeros((n,)).float().to(self.device)
-            """
+        if batch is None:
+            batch = Prefetcher(self.load_batch, 1, self.stager).get()
+        t2 = time.time()
+        n = len(batch["actions"])
+        micro_batch_size = self.train_settings.get("micro_batch_size") or n
+
+        advantages = batch["advantages"]
+        batch = dict(batch, advantages=(advantages - advantages.mean()) / advantages.std())
 
-            numerator = torch.log(gathered_actions + eps_denom)
-            denominator = torch.log(old_gathered_actions + eps_denom)
-            scale_factor = avail_actions.shape[1] / torch.sum(avail_actions, dim=1, keepdim=True).float()
-            entropy = torch.mean(self.entropy(action_probs) * scale_factor, dim=1)
-            #entropy = self.entropy(gathered_args)
-            num_args = torch.ones(n,).to(self.device)
-
-            for i in range(n):
-                curr_args = action_args[i]
-                for j in curr_args:
-                    if is_spatial_arg(j):
-                        numerator[i] = numerator[i] + torch.log(gathered_spatial_args[i][j] + eps_denom)
-                        denominator[i] = denominator[i] + torch.log(old_gathered_spatial_args[i][j] + eps_denom)
-                        entropy[i] = entropy[i] + c3 * torch.mean(self.entropy(gathered_spatial_args[i][j]))
-                    else:
-                        numerator[i] = numerator[i] + torch.log(gathered_args[i][j-3] + eps_denom)
-                        denominator[i] = denominator[i] + torch.log(old_gathered_args[i][j-3] + eps_denom)
-                        entropy[i] = entropy[i] + c4 * torch.mean(self.entropy(gathered_args[i][j-3]))
-                num_args[i] += len(curr_args)
-
-            denominator = denominator.detach()
-            t5 = time.time()
-
-            #print(numerator, denominator)
-            denominator = torch.clamp(denominator, -27)
-
-
-            ratio = torch.exp((numerator - denominator))    # * (1 / num_args))
-            ratio_adv = ratio * advantages.detach()
-            bounded_adv = torch.clamp(ratio, 1-clip_param, 1+clip_param)
-            bounded_adv = bounded_adv * advantages.detach()
-
-            pol_avg = - ((torch.min(ratio_adv, bounded_adv)).mean())
-
-            #pol_avg = -(numerator * advantages.detach()).mean()
-            value_loss = self.loss(values.squeeze(1), v_returns.detach())
-            ent = entropy.mean()
-            t6 = time.time()
-
-            #total_loss = pol_avg + c1 * value_loss + c2 * ent
-            total_loss = pol_avg + c1 * value_loss + c2 * ent
-            #total_loss = value_loss
-            #total_loss = ent
-            self.optimizer.zero_grad()
+        self.optimizer.zero_grad()
+        pol_loss, vf_loss, ent_total = 0, 0, 0
+        measure = self.train_settings.get("measure_activations", False)
+        self.peak_activation_bytes = 0
+        diagnostics = []
+        for start in range(0, n, micro_batch_size):
+            micro_batch = {key: value[start:start+micro_batch_size] for key, value in batch.items()}
+            weight = len(micro_batch["actions"]) / n
+
+            meter = ActivationMeter(self.model) if measure else None
+            with meter or contextlib.nullcontext():
+                pol_avg, value_loss, ent, diagnostic = self.ppo_loss(micro_batch)
+            if meter is not None:
+                self.peak_activation_bytes = max(self.peak_activation_bytes, meter.nbytes())
+
+            total_loss = weight * (pol_avg + c1 * value_loss + c2 * ent)
             total_loss.backward()
 
+            pol_loss += weight * pol_avg.detach().item()
+            vf_loss += weight * value_loss.detach().item()
+            ent_total += weight * ent.detach().item()
+            if verbose:
+                diagnostics.append(diagnostic)
+        if self.learner is not None:
+            self.learner.all_reduce_gradients()
+            pol_loss, vf_loss, ent_total = self.learner.mean([pol_loss, vf_loss, ent_total])
+        t3 = time.time()
+
+        clip_grad_norm_(self.model.parameters(), 100.0)
+        self.optimizer.step()
+        t4 = time.time()
 
-            #print("actions: ", torch.max(gathered_actions).item(), torch.min(gathered_actions).item())
+        if verbose:
+            gathered_actions, gathered_args, gathered_spatial_args, ratio = [torch.cat(d) for d in zip(*diagnostics)]
+            print("actions: ", torch.max(gathered_actions).item(), torch.min(gathered_actions).item())
             print("args: ", torch.max(gathered_args).item(), torch.min(gathered_args).item())
-            print("actions: ", gathered_actions)
-            #print("args: ", gathered_args)
             print("spatial args: ", torch.max(gathered_spatial_args).item(), torch.min(gathered_spatial_args).item())
-            if len(gathered_spatial_args) == 0:
-                print("No spatial arguments chosen")
             print("ratio: ", torch.max(ratio).item(), torch.min(ratio).item())
+            print("load %f, forward/backward %f, step %f, total: %f" % (t2-t1, t3-t2, t4-t3, t4-t1))
+        if measure:
+            print("Peak activation memory: %.1f MB (micro-batch size %d)\n" % (self.peak_activation_bytes / 2**20, micro_batch_size))
+
+        return pol_loss, vf_loss, -ent_total
+
+    """
+        PPO losses of one (micro-)batch whose advantages are already
+        normalized. Also returns the gathered probabilities and ratios,
+        detached, for logging.
+    """
+    def ppo_loss(self, batch):
+        eps_denom = self.train_settings['eps_denom']
+        c3 = self.train_settings['c3']
+        c4 = self.train_settings['c4']
+        clip_param = self.train_settings['clip_param']
+
+        n = len(batch["actions"])
+        avail_actions = batch["avail"]
+        base_actions = batch["actions"]
+        advantages = batch["advantages"]
+        v_returns = batch["returns"]
+
+        # minimaps, screens, players, avail_actions, last_actions, hiddens, curr_actions, relevant_frames
+        with self.autocast():
+            action_probs, arg_probs, spatial_probs, _, values, _ = self.model.simple_forward(
+                batch["minimaps"],
+                batch["screens"],
+                batch["players"],
+                avail_actions,
+                batch["prev_actions"],
+                batch["prev_spatials"],
+                batch["hiddens"],
+                base_actions,
+                batch["relevant"]
+            )
+        values = values.float()
+
+        gathered_actions = action_probs[range(n), base_actions]
+        gathered_args = self.index_args(arg_probs, batch["args"])
+        gathered_spatial_args = self.index_spatial(spatial_probs, batch["spatial_args"])
+        arg_mask = self.action_tables["arg_type_mask"][base_actions].float()
+
+        numerator = torch.log(gathered_actions + eps_denom)
+        # Joint log-probability under the policy that collected the rollout
+        denominator = batch["log_probs"]
+        scale_factor = avail_actions.shape[1] / torch.sum(avail_actions, dim=1, keepdim=True).float()
+        entropy = torch.mean(self.entropy(action_probs) * scale_factor, dim=1)
 
+        # (N, num_arg_types), spatial argument types first as in action_tables
+        gathered_all = torch.cat([gathered_spatial_args, gathered_args], dim=1)
+        arg_entropy = torch.cat([c3 * self.entropy(gathered_spatial_args), c4 * self.entropy(gathered_args)], dim=1)
 
-            clip_grad_norm_(self.model.parameters(), 100.0)
-            #self.process_gradients(self.model)
-            self.optimizer.step()
-            t7 = time.time()
-            pol_loss = pol_avg.detach().item()
-            vf_loss = value_loss.detach().item()
-            ent_total = ent.detach().item()
-            print("Total train time: %f" % (t7-t1))
-            print("%f %f %f %f %f %f, total: %f\n" % (t2-t1, t3-t2, t4-t3, t5-t4, t6-t5, t7-t6, t7-t1))
+        numerator = numerator + (torch.log(gathered_all + eps_denom) * arg_mask).sum(dim=1)
+        entropy = entropy + (arg_entropy * arg_mask).sum(dim=1)
+
+        denominator = torch.clamp(denominator.detach(), -27)
+
+        ratio = torch.exp((numerator - denominator))
+        ratio_adv = ratio * advantages.detach()
+        bounded_adv = torch.clamp(ratio, 1-clip_param, 1+clip_param)
+        bounded_adv = bounded_adv * advantages.detach()
+
+        pol_avg = - ((torch.min(ratio_adv, bounded_adv)).mean())
+        value_loss = self.loss(values.squeeze(1), v_returns.detach())
+        ent = entropy.mean()
 
-            return pol_loss, vf_loss, -ent_total
+        diagnostic = [gathered_actions.detach(), gathered_args.detach(), gathered_spatial_args.detach(), ratio.detach()]
+        return pol_avg, value_loss, ent, diagnostic
 
+    """
+        For SequentialMemory, whose samples are already on the device, so
+        there is nothing for a Prefetcher to stage.
+    """
     def train_step_sequential(self, batch_size):
 
         t1 = time.time()
@@ -352,7 +427,6 @@ class BaseAgent(Agent):
         minimaps, screens, hiddens, spatial_args, prev_spatial_actions = self.memory.batch_random_transform(minimaps, screens, hiddens, spatial_args, prev_spatial_actions)
 
         avail_actions = states[3].byte()
-        old_hidden_states = hiddens[-batch_size:]
         relevant_states = torch.from_numpy(states[6]).byte().to(self.device)
         hidden_states = hiddens[:batch_size]
 
@@ -363,6 +437,7 @@ class BaseAgent(Agent):
         dones = mini_batch[2]
         v_returns = mini_batch[4].astype(np.float32)
         advantages = mini_batch[5].astype(np.float32)
+        log_probs = mini_batch[7].astype(np.float32)[-batch_size:]
 
         rewards = torch.from_numpy(rewards).float().to(self.device)
         advantages = torch.from_numpy(advantages).float().to(self.device)
@@ -373,82 +448,51 @@ class BaseAgent(Agent):
         base_actions = torch.from_numpy(base_actions).to(self.device)
 
         # minimaps, screens, players, avail_actions, last_actions, hiddens, curr_actions, relevant_frames
-        action_probs, arg_probs, spatial_probs, _, values, _ = self.model.unroll_forward_sequential(
-            minimaps,
-            screens,
-            players,
-            avail_actions,
-            prev_base_actions,
-            prev_spatial_actions,
-            hidden_states,
-            base_actions,
-            relevant_states,
-            batch_size=batch_size
-        )
-
-        with torch.no_grad():
-            old_action_probs, old_arg_probs, old_spatial_probs, _, _, _ = self.target_model.unroll_forward_sequential(
-                minimaps[-batch_size:],
-                screens[-batch_size:],
-                players[-batch_size:],
-                avail_actions[-batch_size:],
-                prev_base_actions[-batch_size:],
-                prev_spatial_actions[-batch_size:],
-                old_hidden_states,
-                base_actions[-batch_size:],
-                relevant_states[-batch_size:],
+        with self.autocast():
+            action_probs, arg_probs, spatial_probs, _, values, _ = self.model.unroll_forward_sequential(
+                minimaps,
+                screens,
+                players,
+                avail_actions,
+                prev_base_actions,
+                prev_spatial_actions,
+                hidden_states,
+                base_actions,
+                relevant_states,
                 batch_size=batch_size
             )
+        values = values.float()
+
         t4 = time.time()
 
         gathered_actions = action_probs[range(batch_size), base_actions[-batch_size:]]
-        old_gathered_actions = old_action_probs[range(batch_size), base_actions[-batch_size:]]
 
         args = args[-batch_size:]
         spatial_args = spatial_args[-batch_size:]
 
-        gathered_args, old_gathered_args = self.index_args(arg_probs, old_arg_probs, args)
-
-        gathered_spatial_args, old_gathered_spatial_args = self.index_spatial(spatial_probs,
-                                                                            old_spatial_probs,
-                                                                            spatial_args)
+        gathered_args = self.index_args(arg_probs, args)
+        gathered_spatial_args = self.index_spatial(spatial_probs, spatial_args)
 
-        action_args = batch_get_action_args(base_actions[-batch_size:])
-        """
-        numerator = torch.zeros((n,)).float().to(self.device)
-        denominator = torch.zeros((n,)).float().to(self.device)
-        entropy = torch.zeros((n,)).float().to(self.device)
-        """
+        arg_mask = self.action_tables["arg_type_mask"][base_actions[-batch_size:]].float()
 
-        numerator = torch.log(gathered_actions)
-        denominator = torch.log(torch.clamp(old_gathered_actions, eps_denom))
+        numerator = torch.log(gathered_actions + eps_denom)
+        # Joint log-probability under the policy that collected the rollout
+        denominator = torch.from_numpy(log_probs).to(self.device)
         entropy = torch.sum(self.entropy(action_probs), 1)
-        num_args = torch.ones(batch_size,).to(self.device)
-
-        spatial_inds = []
-
-        for i in range(batch_size):
-            curr_args = action_args[i]
-            for j in curr_args:
-                if i not in spatial_inds:
-                    spatial_inds.append(i)
-                if is_spatial_arg(j):
-                    numerator[i] = numerator[i] + torch.log(gathered_spatial_args[i][j])
-                    denominator[i] = denominator[i] + torch.log(torch.clamp(old_gathered_spatial_args[i][j], eps_denom))
-                    entropy[i] = entropy[i] + c3 * torch.sum(self.entropy(spatial_probs[i][j]))
-                else:
-                    numerator[i] = numerator[i] + torch.log(gathered_args[i][j-3])
-                    denominator[i] = denominator[i] + torch.log(torch.clamp(old_gathered_args[i][j-3], eps_denom))
-                    entropy[i] = entropy[i] + c4 * torch.sum(self.entropy(arg_probs[i][j-3]))
-            num_args[i] += len(curr_args)
-
-        denominator = denominator.detach()
-        t5 = time.time()
 
-        #print(numerator, denominator, num_args)
+        # (N, num_arg_types), spatial argument types first as in action_tables
+        gathered_all = torch.cat([gathered_spatial_args, gathered_args], dim=1)
+        arg_entropy = torch.cat([c3 * torch.sum(self.entropy(spatial_probs), dim=(2, 3)),
+                                    c4 * torch.sum(self.entropy(arg_probs), dim=2)], dim=1)
+
+        # Same formula as ppo_loss and behaviour_log_prob
+        numerator = numerator + (torch.log(gathered_all + eps_denom) * arg_mask).sum(dim=1)
+        entropy = entropy + (arg_entropy * arg_mask).sum(dim=1)
+
+        denominator = torch.clamp(denominator.detach(), -27)
+        t5 = time.time()
 
         ratio = torch.exp((numerator - denominator))
-        #ratio = torch.exp(numerator - denominator)
         ratio_adv = ratio * advantages.detach()[-batch_size:]
         bounded_adv = torch.clamp(ratio, 1-clip_param, 1+clip_param)
         bounded_adv = bounded_adv * advantages.detach()[-batch_size:]
@@ -459,45 +503,90 @@ class BaseAgent(Agent):
         t6 = time.time()
 
         total_loss = pol_avg + c1 * value_loss + c2 * ent
-        #total_loss = value_loss
-        #total_loss = ent
         self.optimizer.zero_grad()
         total_loss.backward()
-        #self.process_gradients(self.model)
-
-        print("actions: ", torch.max(gathered_actions).item(), torch.min(gathered_actions).item())
-        print("args: ", torch.max(gathered_args).item(), torch.min(gathered_args).item())
-        print("spatial args: ", torch.max(gathered_spatial_args).item(), torch.min(gathered_spatial_args).item())
-        print("ratio: ", torch.max(ratio).item(), torch.min(ratio).item())
-        print()
+        if self.learner is not None:
+            self.learner.all_reduce_gradients()
 
         clip_grad_norm_(self.model.parameters(), 100.0)
         self.optimizer.step()
-        #self.process_network(self.model)
         t7 = time.time()
         pol_loss = pol_avg.detach().item()
         vf_loss = value_loss.detach().item()
         ent_total = ent.detach().item()
-        print("%f %f %f %f %f %f, total: %f" % (t2-t1, t3-t2, t4-t3, t5-t4, t6-t5, t7-t6, t7-t1))
-        #print(values, v_returns, advantages)
+        if self.learner is not None:
+            pol_loss, vf_loss, ent_total = self.learner.mean([pol_loss, vf_loss, ent_total])
+        if self.train_settings.get("verbose", False):
+            print("actions: ", torch.max(gathered_actions).item(), torch.min(gathered_actions).item())
+            print("args: ", torch.max(gathered_args).item(), torch.min(gathered_args).item())
+            print("spatial args: ", torch.max(gathered_spatial_args).item(), torch.min(gathered_spatial_args).item())
+            print("ratio: ", torch.max(ratio).item(), torch.min(ratio).item())
+            print("%f %f %f %f %f %f, total: %f" % (t2-t1, t3-t2, t4-t3, t5-t4, t6-t5, t7-t6, t7-t1))
         return pol_loss, vf_loss, -ent_total
 
 
 
 
 
+    def model_path(self):
+        return "save_model/Starcraft2" + self.map + "RRL.pth"
+
     def load(self):
-        self.model.load_state_dict(torch.load("save_model/Starcraft2" + self.map + "RRL.pth"))
-        self.update_target_net()
+        self.model.load_state_dict(torch.load(self.model_path()))
+        self.update_policy()
 
+    """
+        Rebuilds the traced inference graphs, whose weights are constants,
+        after the model's parameters changed
+    """
+    def update_policy(self):
+        if self.policy is not None:
+            self.policy.update()
+
+    """
+        Queues a checkpoint of the full training state. The write happens on
+        a background thread, so this does not stall environment stepping.
+        In data-parallel mode only rank 0 writes.
+    """
     def save(self):
-        torch.save(self.model.state_dict(), "save_model/Starcraft2" + self.map + "RRL.pth")
+        if self.learner is not None and not self.learner.is_main:
+            return
+        self.checkpointer.save(self.frame_count, {
+            "model": self.model.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "frame_count": self.frame_count,
+            "step": self.step,
+            "epochs_trained": self.epochs_trained,
+            "train_settings": self.train_settings,
+            "rng": rng_state()
+        })
+
+    """
+        Restores the newest checkpoint written by save: weights, optimizer,
+        counters (which drive the epsilon, entropy and clip schedules) and
+        RNG states. Returns False if there is no checkpoint. In data-parallel
+        mode every rank loads rank 0's checkpoint but keeps its own RNG
+        states, so the workers do not explore in lockstep.
+    """
+    def resume(self):
+        state = self.checkpointer.resume(self.device)
+        if state is None:
+            return False
+        self.model.load_state_dict(state["model"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        self.frame_count = state["frame_count"]
+        self.step = state["step"]
+        self.epochs_trained = state["epochs_trained"]
+        if self.learner is None or self.learner.is_main:
+            set_rng_state(state["rng"])
+        self.update_policy()
+        return True
 
     def push_memory(self, state, action, reward, done):
         push_state = list(state) + [self.prev_hidden_state]
         if done:
             self.value = 0
-        self.memory.push(push_state, action, reward, done, self.value, 0, 0, self.step)
+        self.memory.push(push_state, action, reward, done, self.value, 0, 0, self.step, self.log_prob)
         if done:
             self.step = 0
             self.hidden_state = self.model.init_hidden(use_torch=False)
@@ -506,40 +595,45 @@ class BaseAgent(Agent):
 
     """
         arg_probs: (N, 10, 500)
-        old_arg_probs: ""
         args: (N, 10)
 
-        returns: (N, 10), (N, 10)
+        returns: (N, 10)
     """
-    def index_args(self, arg_probs, old_arg_probs, args):
+    def index_args(self, arg_probs, args):
         (N, D) = args.shape
         flattened = arg_probs.view(-1, arg_probs.shape[-1])
-        old_flattened = old_arg_probs.view(-1, old_arg_probs.shape[-1])
         gathered = flattened[range(len(flattened)), args.flatten()]
-        old_gathered = old_flattened[range(len(old_flattened)), args.flatten()]
-        return gathered.reshape((N, D)), old_gathered.reshape((N, D))
+        return gathered.reshape((N, D))
 
     """
         spatial_probs: (N, 3, 64, 64)
-        old_spatial_probs: ""
         spatial_args: (N, 3, 2)
 
-        returns: (N, 3), (N, 3)
+        returns: (N, 3)
     """
-    def index_spatial(self, spatial_probs, old_spatial_probs, spatial_args):
+    def index_spatial(self, spatial_probs, spatial_args):
         (N, D, H, W) = spatial_probs.shape
         flattened = spatial_probs.view(-1, H, W)
-        old_flattened = old_spatial_probs.view(-1, H, W)
         gathered = flattened[range(N*D), spatial_args[:,:,0].flatten(), spatial_args[:,:,1].flatten()]
-        old_gathered = old_flattened[range(N*D), spatial_args[:,:,0].flatten(), spatial_args[:,:,1].flatten()]
-        gathered = gathered.reshape((N, D))
-        old_gathered = old_gathered.reshape((N, D))
-        return gathered, old_gathered
-
+        return gathered.reshape((N, D))
 
-    def update_target_net(self):
-        self.target_model.load_state_dict(self.model.state_dict())
-        self.target_model.eval()
+    """
+        Joint log-probability of a sampled choice [base_action, args,
+        spatial_args] under the current policy, computed the same way as the
+        PPO numerator in train_step. Stored with the transition so training
+        needs no second (old policy) forward pass.
+    """
+    def behaviour_log_prob(self, action_probs, arg_probs, spatial_probs, choice):
+        base_action, args, spatial_args = choice
+        eps_denom = self.train_settings['eps_denom']
+        with torch.no_grad():
+            arg_mask = self.action_tables["arg_type_mask"][base_action].float()
+            gathered_args = self.index_args(arg_probs, np.reshape(args, (1, -1)))
+            gathered_spatial_args = self.index_spatial(spatial_probs, np.reshape(spatial_args, (1, -1, 2)))
+            gathered_all = torch.cat([gathered_spatial_args, gathered_args], dim=1)[0]
+            log_prob = torch.log(action_probs[0, base_action] + eps_denom)
+            log_prob = log_prob + (torch.log(gathered_all + eps_denom) * arg_mask).sum()
+        return log_prob.item()
 
     def entropy(self, x):
         output = torch.log(x + self.train_settings["eps_denom"]) * x
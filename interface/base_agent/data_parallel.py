@@ -0,0 +1,162 @@
+"""
+    Multi-process data-parallel training on the CPU.
+
+    On a large CPU box, intra-op threading of a single learner saturates at a
+    fraction of the cores for these model sizes. In data-parallel mode K
+    processes each run their own agent, environment and replay memory (their
+    shard of the rollouts). Every training step, each process computes
+    gradients on its own minibatch. The gradients are averaged through
+    torch.distributed with the gloo backend, so all replicas take the same
+    optimizer step and stay identical. Only rank 0 writes checkpoints.
+
+    Whether to train is decided collectively: every BaseAgent.train call
+    first votes through agree_to_train, and a rank that is done with its
+    episodes casts a last vote against it with finish. Once any rank has
+    voted against, no rank trains again, so a rank that runs out of
+    episodes early never leaves the others waiting in an all-reduce.
+
+    Worker processes are started with launch, e.g.
+
+        def worker(rank, world_size):
+            init_data_parallel(rank, world_size)
+            torch.set_num_threads(cores // world_size)
+            ...
+            agent = BaseAgent(model, settings, memory, dict(train_settings, data_parallel=True))
+
+        launch(worker, 4)
+
+    Everything runs on one Linux box with the default address; set
+    master_addr to spread the workers over several machines.
+"""
+
+import os
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+"""
+    Joins the gloo process group. The rendezvous address defaults to
+    MASTER_ADDR and MASTER_PORT from the environment, then to
+    127.0.0.1:29500.
+"""
+def init_data_parallel(rank, world_size, master_addr=None, master_port=None):
+    master_addr = master_addr or os.environ.get("MASTER_ADDR", "127.0.0.1")
+    master_port = master_port or os.environ.get("MASTER_PORT", 29500)
+    dist.init_process_group("gloo", init_method="tcp://%s:%s" % (master_addr, master_port),
+                            rank=rank, world_size=world_size)
+
+
+"""
+    Starts world_size processes running worker(rank, world_size, *args) and
+    waits for all of them. Raises if any worker fails.
+"""
+def launch(worker, world_size, *args):
+    mp.spawn(worker, args=(world_size,) + args, nprocs=world_size, join=True)
+
+
+"""
+    Gradient averaging for one model replica. The process group must already
+    be initialized, e.g. with init_data_parallel. Parameters are broadcast
+    from rank 0 on construction so every replica starts from the same
+    weights.
+
+    bucket_size: number of gradient elements flattened into each all-reduce
+"""
+class DataParallelLearner(object):
+    def __init__(self, model, bucket_size=2**22):
+        assert dist.is_initialized(), "call init_data_parallel before creating a DataParallelLearner"
+        self.model = model
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        self.bucket_size = bucket_size
+        self.stopped = False
+        self.broadcast_parameters()
+
+    @property
+    def is_main(self):
+        return self.rank == 0
+
+    def broadcast_parameters(self):
+        with torch.no_grad():
+            for tensor in list(self.model.parameters()) + list(self.model.buffers()):
+                dist.broadcast(tensor.data, 0)
+
+    def buckets(self, params):
+        bucket, size = [], 0
+        for param in params:
+            if bucket and size + param.numel() > self.bucket_size:
+                yield bucket
+                bucket, size = [], 0
+            bucket.append(param)
+            size += param.numel()
+        if bucket:
+            yield bucket
+
+    """
+        Averages the gradients of every trainable parameter over all ranks.
+        Gradients a rank did not produce count as zeros, and afterwards every
+        parameter holds a gradient, so all replicas apply the same update.
+    """
+    def all_reduce_gradients(self):
+        params = [p for p in self.model.parameters() if p.requires_grad]
+        for param in params:
+            if param.grad is None:
+                param.grad = torch.zeros_like(param)
+        with torch.no_grad():
+            for bucket in self.buckets(params):
+                flat = torch.cat([p.grad.reshape(-1) for p in bucket])
+                dist.all_reduce(flat)
+                flat /= self.world_size
+                offset = 0
+                for p in bucket:
+                    p.grad.copy_(flat[offset:offset + p.numel()].view_as(p.grad))
+                    offset += p.numel()
+
+    """
+        Mean of a list of floats over all ranks
+    """
+    def mean(self, values):
+        tensor = torch.tensor(values, dtype=torch.float64)
+        dist.all_reduce(tensor)
+        return (tensor / self.world_size).tolist()
+
+    """
+        Collective vote on starting a training round. Every rank has to call
+        this once per round, with ready False if it will not train any more.
+        Returns True if all ranks are ready. After a round some rank was not
+        ready for, this returns False without communicating.
+    """
+    def agree_to_train(self, ready=True):
+        if self.stopped:
+            return False
+        tensor = torch.tensor([int(ready)], dtype=torch.int64)
+        dist.all_reduce(tensor, op=dist.ReduceOp.MIN)
+        self.stopped = tensor.item() == 0
+        return not self.stopped
+
+    """
+        Casts this rank's last vote, against training, unless training has
+        already stopped. Call once the rank is done with its episodes.
+    """
+    def finish(self):
+        self.agree_to_train(False)
+
+    """
+        True if every rank holds the same parameters, compared through a
+        checksum of all of them
+    """
+    def replicas_identical(self):
+        checksum = torch.cat([p.detach().reshape(-1) for p in self.model.parameters()]).double().sum()
+        spread = torch.stack([checksum, -checksum])
+        dist.all_reduce(spread, op=dist.ReduceOp.MAX)
+        return (spread[0] + spread[1]).abs().item() == 0
+
+    """
+        Smallest n over all ranks. Every rank must run the same number of
+        training steps, or the all-reduces would never complete.
+    """
+    def agree_min(self, n):
+        tensor = torch.tensor([n], dtype=torch.int64)
+        dist.all_reduce(tensor, op=dist.ReduceOp.MIN)
+        return int(tensor.item())
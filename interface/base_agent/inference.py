@@ -0,0 +1,198 @@
+"""
+    Specialised inference path for action selection.
+
+    RRLModel.forward(choosing=True) turns every NumPy input into a fresh
+    tensor, embeds every frame of the history window again, and dispatches a
+    long chain of small ops from Python on every environment step.
+    InferencePolicy is specialised for a fixed number of environments:
+
+    - Inputs are copied into static buffers.
+    - The embedded history is kept between steps. When the new window is the
+      previous one shifted by a frame, only the newest frame is embedded.
+      Otherwise the whole window is embedded again, so the result is always
+      the same as embedding the window from scratch.
+    - The network runs as two graphs traced with torch.jit.trace, frozen and
+      optimised for inference. The first graph is the trunk, up to the action
+      probabilities and value. The second is the heads, conditioned on the
+      sampled base action. Weights and shape-dependent values (coordinate
+      grid, action space mask, expanded sizes) are folded into the graphs as
+      constants.
+
+    Because the weights are constants, the graphs have to be rebuilt with
+    update() after the model's parameters change. A model with lazy_heads
+    set computes only the heads the sampled actions take, which depends on
+    the data, so its heads run eagerly.
+"""
+
+import contextlib
+import numpy as np
+import torch
+import torch.nn as nn
+
+from base_agent.sc2env_utils import env_config
+
+
+class PolicyTrunk(nn.Module):
+    def __init__(self, model):
+        super(PolicyTrunk, self).__init__()
+        self.model = model
+
+    def forward(self, minimap, screen, player, last_action, avail_actions):
+        encoded = self.model.encode(minimap, screen, player, last_action)
+        shared_features, relational_spatial, value, action_logits_in = self.model.core(*encoded)
+        action_probs = self.model.action_policy(action_logits_in, avail_actions)
+        return action_probs, value, shared_features, relational_spatial
+
+
+class PolicyHeads(nn.Module):
+    def __init__(self, model):
+        super(PolicyHeads, self).__init__()
+        self.model = model
+
+    def forward(self, shared_features, relational_spatial, action):
+        return self.model.conditioned_heads(shared_features, relational_spatial, action)
+
+
+class InferencePolicy(object):
+    """
+        model: network providing process_states, encode, core, action_policy
+            and conditioned_heads, e.g. the DeepMind2018 RRLModel
+        num_envs: number of environments stepped together; the graphs are
+            specialised for this batch size
+        trace: if False, the same path runs eagerly
+        autocast: callable returning the context the graphs are traced and
+            run in, e.g. BaseAgent.autocast
+    """
+    def __init__(self, model, num_envs=1, trace=True, autocast=contextlib.nullcontext):
+        self.model = model
+        self.num_envs = num_envs
+        self.device = model.device
+        self.autocast = autocast
+        self.trace = trace
+
+        hist_size = model.hist_depth
+        self.minimap = torch.zeros((num_envs, hist_size) + env_config["minimap_shape"], device=self.device)
+        self.screen = torch.zeros((num_envs, hist_size) + env_config["screen_shape"], device=self.device)
+        self.player = torch.zeros((num_envs, env_config["raw_player"]), device=self.device)
+        self.last_action = torch.zeros((num_envs,), dtype=torch.long, device=self.device)
+        self.last_spatials = torch.zeros((num_envs, hist_size, env_config["spatial_action_depth"], 2), dtype=torch.long, device=self.device)
+        self.avail_actions = torch.ones((num_envs, env_config["action_space"]), dtype=torch.uint8, device=self.device)
+        self.action = torch.zeros((num_envs,), dtype=torch.long, device=self.device)
+
+        # Embedded history, (num_envs, hist_size * D, H, W), and a spare
+        # buffer of the same shape the shifted window is written into
+        self.embedded = None
+        self.spare = None
+        self.embed_all()
+
+        self.lazy_heads = getattr(model, "lazy_heads", False)
+        self.update()
+
+    """
+        Embeds frames (a slice of the history axis) of the input buffers,
+        returns (num_envs, frames * D, H, W) minimap and screen
+    """
+    def embed(self, frames=slice(None)):
+        with torch.no_grad(), self.autocast():
+            [minimap, screen, _] = self.model.process_states(self.minimap[:,frames], self.screen[:,frames], self.player,
+                                                                self.last_action, self.last_spatials[:,frames],
+                                                                sequential=False, embeddings_only=True)
+        return minimap, screen
+
+    def embed_all(self):
+        self.embedded = self.embed()
+        self.spare = [torch.empty_like(x) for x in self.embedded]
+
+    """
+        Drops the oldest frame of the embedded history and appends the
+        newest frame of the input buffers
+    """
+    def embed_newest(self):
+        newest = self.embed(slice(-1, None))
+        for x, spare, frame in zip(self.embedded, self.spare, newest):
+            depth = frame.shape[1]
+            spare[:,:-depth].copy_(x[:,depth:])
+            spare[:,-depth:].copy_(frame)
+        self.embedded, self.spare = self.spare, self.embedded
+
+    """
+        Rebuilds the graphs from the model's current parameters. Call after
+        training or loading a state dict.
+    """
+    def update(self):
+        self.trunk = PolicyTrunk(self.model)
+        self.heads = self.model.lazy_conditioned_heads if self.lazy_heads else PolicyHeads(self.model)
+        if self.trace:
+            training = self.model.training
+            self.model.eval()
+            with torch.no_grad(), self.autocast():
+                minimap, screen = self.embedded
+                trunk_inputs = (minimap, screen, self.player, self.last_action, self.avail_actions)
+                _, _, shared_features, relational_spatial = self.trunk(*trunk_inputs)
+                self.trunk = freeze(torch.jit.trace(self.trunk, trunk_inputs, check_trace=False))
+                if not self.lazy_heads:
+                    heads_inputs = (shared_features, relational_spatial, self.action)
+                    self.heads = freeze(torch.jit.trace(self.heads, heads_inputs, check_trace=False))
+            self.model.train(training)
+        self.warm_up()
+
+    """
+        Runs the graphs a few times so the JIT has profiled and optimised
+        them before the first real step. Draws no random numbers.
+    """
+    def warm_up(self, steps=3):
+        with torch.no_grad(), self.autocast():
+            minimap, screen = self.embedded
+            for _ in range(steps):
+                _, _, shared_features, relational_spatial = self.trunk(minimap, screen, self.player, self.last_action, self.avail_actions)
+                self.heads(shared_features, relational_spatial, self.action)
+
+    """
+        Same inputs and outputs as RRLModel.forward with choosing=True, for
+        num_envs environments. choice is a list of num_envs choices unless
+        num_envs is 1.
+    """
+    def __call__(self, minimap, screen, player, avail_actions, last_action, last_spatials, hidden):
+        with torch.no_grad():
+            minimap = torch.from_numpy(np.asarray(minimap, dtype=np.float32)).to(self.device)
+            screen = torch.from_numpy(np.asarray(screen, dtype=np.float32)).to(self.device)
+            last_spatials = torch.from_numpy(np.asarray(last_spatials, dtype=np.int64)).to(self.device)
+            shifted = (torch.equal(minimap[:,:-1], self.minimap[:,1:]) and
+                        torch.equal(screen[:,:-1], self.screen[:,1:]) and
+                        torch.equal(last_spatials[:,:-1], self.last_spatials[:,1:]))
+
+            self.minimap.copy_(minimap)
+            self.screen.copy_(screen)
+            self.last_spatials.copy_(last_spatials)
+            self.player.copy_(torch.from_numpy(np.asarray(player)))
+            self.last_action.copy_(torch.from_numpy(np.asarray(last_action)))
+            if torch.is_tensor(avail_actions):
+                self.avail_actions.copy_(avail_actions)
+            else:
+                self.avail_actions.copy_(torch.from_numpy(np.asarray(avail_actions)))
+
+            if shifted:
+                self.embed_newest()
+            else:
+                self.embed_all()
+
+            with self.autocast():
+                minimap, screen = self.embedded
+                action_probs, value, shared_features, relational_spatial = self.trunk(minimap, screen, self.player,
+                                                                                        self.last_action, self.avail_actions)
+                self.action.copy_(self.model.sample_actions(action_probs))
+                arg_probs, spatial_probs = self.heads(shared_features, relational_spatial, self.action)
+
+            args, spatial = self.model.sample_action_args(arg_probs, spatial_probs, self.action)
+            choices = self.model.choices_to_host(self.action, args, spatial)
+
+        choice = choices[0] if self.num_envs == 1 else choices
+        return action_probs, arg_probs, spatial_probs, torch.from_numpy(np.asarray(hidden)), value, choice
+
+
+"""
+    Folds the weights of a traced module into its graph as constants and
+    applies the inference-only graph rewrites
+"""
+def freeze(traced):
+    return torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
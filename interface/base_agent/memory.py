@@ -2,8 +2,11 @@ from collections import deque
 import numpy as np
 import random
 import copy
+import warnings
 import torch
 from base_agent.sc2env_utils import env_config
+from base_agent.advantage import vtargets_adv
+from base_agent.action_masks import pack_masks, unpack_masks, packed_mask_size
 import matplotlib.pyplot as plt
 
 
@@ -11,10 +14,14 @@ device = "cuda:0" if torch.cuda.is_available() else "cpu"
 
 class SequentialMemory(object):
     def __init__(self, mem_cap, batch_size, hist_size=1, hidden_shape=(96,8,8)):
-        self.minimaps = torch.zeros((mem_cap,) + env_config["minimap_shape"]).float().to(device)
-        self.screens = torch.zeros((mem_cap,) + env_config["screen_shape"]).float().to(device)
+        self.minimap_groups = env_config["minimap_storage_groups"]
+        self.screen_groups = env_config["screen_storage_groups"]
+        self.minimaps = [torch.zeros((mem_cap, len(planes)) + env_config["minimap_shape"][1:], dtype=torch_dtypes[dtype]).to(device)
+                            for dtype, planes in self.minimap_groups]
+        self.screens = [torch.zeros((mem_cap, len(planes)) + env_config["screen_shape"][1:], dtype=torch_dtypes[dtype]).to(device)
+                            for dtype, planes in self.screen_groups]
         self.players = torch.zeros((mem_cap,) + (env_config["raw_player"],)).float().to(device)
-        self.available = torch.zeros((mem_cap,) + (env_config["action_space"],)).float().to(device)
+        self.available = torch.zeros((mem_cap, packed_mask_size), dtype=torch.uint8).to(device)
         self.hiddens = torch.zeros((mem_cap, 2) + hidden_shape).float().to(device)
 
         self.memory = deque(maxlen=mem_cap)
@@ -27,37 +34,45 @@ class SequentialMemory(object):
         self.update_indices()
         self.push_index = 0
 
-    def push(self, state, action, reward, done, vtarg, ret, adv, step):
+    def push(self, state, action, reward, done, vtarg, ret, adv, step, log_prob=0.0):
         minimap, screen, player, avail, hidden = state
-        self.minimaps[self.push_index] = torch.from_numpy(minimap).to(device)
-        self.screens[self.push_index] = torch.from_numpy(screen).to(device)
+        for stored, planes in zip(self.minimaps, split_planes(minimap, self.minimap_groups)):
+            stored[self.push_index] = torch.from_numpy(planes).to(device)
+        for stored, planes in zip(self.screens, split_planes(screen, self.screen_groups)):
+            stored[self.push_index] = torch.from_numpy(planes).to(device)
         self.players[self.push_index] = torch.from_numpy(player).to(device)
-        self.available[self.push_index] = torch.from_numpy(avail).to(device)
+        self.available[self.push_index] = torch.from_numpy(pack_masks(avail)).to(device)
         self.hiddens[self.push_index] = torch.from_numpy(hidden).to(device)
-        self.memory.append([action, reward, done, vtarg, ret, adv, step])
+        self.memory.append([action, reward, done, vtarg, ret, adv, step, log_prob])
         self.push_index = (self.push_index + 1) % self.memory_capacity
 
+    """
+        Splits the targets after the first hist_size frames into disjoint
+        blocks of batch_size consecutive frames, in random order. When they
+        don't divide evenly the leftover frames move with a random offset,
+        so every frame is still trained on across epochs.
+    """
     def update_indices(self):
         last_index = self.memory_capacity - self.batch_size - self.history_size
-        self.indices = list(range(last_index))
+        offset = random.randint(0, max(last_index, 0) % self.batch_size)
+        self.indices = list(range(offset, last_index + 1, self.batch_size))
         random.shuffle(self.indices)
-        self.indices = self.indices[:self.batch_size]
+        self.reset_num = max(len(self.indices), 1)
 
     def __len__(self):
         return self.memory_capacity
 
     def sample_mini_batch(self, frame, hist_size=1):
 
-        frame = min(self.access_num, len(self.indices)-1)
-        index = self.indices[frame]
+        index = self.indices[self.access_num]
         upper = index + self.batch_size + hist_size
         idx_sample = range(index, upper)
         mini_batch = []
 
-        minimap = self.minimaps[index:upper]
-        screen = self.screens[index:upper]
+        minimap = widen_planes([stored[index:upper] for stored in self.minimaps], self.minimap_groups)
+        screen = widen_planes([stored[index:upper] for stored in self.screens], self.screen_groups)
         player = self.players[index:upper]
-        avail = self.available[upper-self.batch_size:upper]
+        avail = unpack_masks(self.available[upper-self.batch_size:upper])
         hidden = self.hiddens[index:upper]
 
         prev_action_sample = []
@@ -96,20 +111,14 @@ class SequentialMemory(object):
         return states, mini_batch
 
     def compute_vtargets_adv(self, gamma, lam):
-        N = len(self)
-
-        prev_gae_t = 0
-
+        rewards = np.array([row[1] for row in self.memory])
+        dones = np.array([row[2] for row in self.memory])
+        values = np.array([row[3] for row in self.memory])
+        advantages, returns = vtargets_adv(rewards, values, dones, gamma, lam)
 
-        for i in reversed(range(N-1)):
-
-            vnext = self.memory[i+1][3]
-            nonterminal = 1 - self.memory[i+1][2]    # 1 - done
-            delta = self.memory[i][1] + gamma * vnext * nonterminal - self.memory[i][3]
-            gae_t = delta + gamma * lam * nonterminal * prev_gae_t
-            self.memory[i][5] = gae_t    # advantage
-            self.memory[i][4] = gae_t + self.memory[i][3]  # advantage + value
-            prev_gae_t = gae_t
+        for row, adv, ret in zip(self.memory, advantages, returns):
+            row[5] = adv    # advantage
+            row[4] = ret    # advantage + value
 
     """
         Performs random equivalent reorientation of state
@@ -172,126 +181,232 @@ class SequentialMemory(object):
 
 
 
+"""
+    Preallocated ring buffer that keeps every field of a transition in its own
+    contiguous typed array. Minibatches are assembled with a single
+    fancy-indexing pass per field.
+
+    Minimap and screen planes are stored in the narrowest dtype their pysc2
+    scale allows (see storage_groups in sc2env_utils), one array per dtype,
+    and are only widened to float on the training device.
+
+    Minimap and screen histories are served as views of the distinct frames a
+    minibatch touches plus a (N, hist_size) frame_index into them, so frames
+    shared by overlapping windows are only copied once, by views_to_device.
+
+    Training walks epochs of disjoint minibatches (see epoch_minibatches) that
+    cover every valid window exactly once.
+
+    Every slot records its episode id and the push count at which its episode
+    started, so episode boundaries inside history windows are found for a
+    whole minibatch at once. Windows with fewer than min_relevant * hist_size
+    frames from the target's episode are skipped when sampling.
+
+    Arrays are allocated on the first push, once the shapes of the state and
+    hidden state are known.
+"""
 class ReplayMemory(object):
-    def __init__(self, mem_cap, batch_size, hist_size=1):
-        self.memory = deque(maxlen=mem_cap)
-        self.nonspatial_action_space = 84
-        self.spatial_action_width = 84
+    def __init__(self, mem_cap, batch_size, hist_size=1, min_relevant=0.0):
         self.access_num = 0
         self.batch_size = batch_size
-        self.reset_num = int(mem_cap / batch_size)
         self.indices = []
         self.Memory_capacity = mem_cap
         self.history_size = hist_size
+        self.push_index = 0
+        self.num_stored = 0
+        self.push_count = 0
+        self.episode_start = 0
+        self.min_relevant = min_relevant
+        self.minimap_groups = env_config["minimap_storage_groups"]
+        self.screen_groups = env_config["screen_storage_groups"]
+        self.episode_count = 0
+        self.allocated = False
         self.update_indices()
 
-    def push(self, history, action, reward, done, vtarg, ret, adv, step):
-        # history, action, reward, done, vtarg, adv
-        self.memory.append([history, action, reward, done, vtarg, ret, adv, step])
-
+    def allocate(self, history):
+        minimap, screen, player, avail, hidden = history
+        cap = self.Memory_capacity
+
+        self.minimaps = [self.new_array("minimaps_%d" % g, (cap, len(planes)) + np.shape(minimap)[-2:], dtype)
+                            for g, (dtype, planes) in enumerate(self.minimap_groups)]
+        self.screens = [self.new_array("screens_%d" % g, (cap, len(planes)) + np.shape(screen)[-2:], dtype)
+                            for g, (dtype, planes) in enumerate(self.screen_groups)]
+        self.players = self.new_array("players", (cap, np.size(player)), np.int32)
+        self.available = self.new_array("available", (cap, packed_mask_size), np.uint8)
+        self.hiddens = self.new_array("hiddens", (cap,) + np.shape(hidden)[1:], np.float32)
+
+        self.actions = self.new_array("actions", (cap,), np.int64)
+        self.args = self.new_array("args", (cap, env_config["arg_depth"]), np.int64)
+        self.spatial_args = self.new_array("spatial_args", (cap, env_config["spatial_action_depth"], 2), np.int64)
+        self.rewards = self.new_array("rewards", (cap,), np.float32)
+        self.dones = self.new_array("dones", (cap,), np.bool_)
+        self.values = self.new_array("values", (cap,), np.float32)
+        self.returns = self.new_array("returns", (cap,), np.float32)
+        self.advantages = self.new_array("advantages", (cap,), np.float32)
+        self.log_probs = self.new_array("log_probs", (cap,), np.float32)
+        self.steps = self.new_array("steps", (cap,), np.int64)
+        self.episode_ids = self.new_array("episode_ids", (cap,), np.int64)
+        self.episode_starts = self.new_array("episode_starts", (cap,), np.int64)
+        self.allocated = True
 
-    def update_indices(self):
-        self.indices = list(range(1, self.Memory_capacity - (self.history_size)))
-        random.shuffle(self.indices)
-
-    def sample_mini_batch(self, frame, hist_size=1):
-
-        if frame >= self.Memory_capacity:
-            sample_range = self.Memory_capacity-1
-        else:
-            sample_range = frame
-
-
-
-
-        # history size
+    """
+        Storage for one field. Subclasses override this to change where
+        transitions are kept.
+    """
+    def new_array(self, name, shape, dtype):
+        return np.zeros(shape, dtype=dtype)
 
-        lower = self.batch_size*self.access_num
-        upper = min((self.batch_size*(self.access_num+1)), sample_range)
+    """
+        log_prob: joint log-probability of action under the policy that
+            chose it, see BaseAgent.behaviour_log_prob
+    """
+    def push(self, history, action, reward, done, vtarg, ret, adv, step, log_prob=0.0):
+        # history, action, reward, done, vtarg, adv
+        if not self.allocated:
+            self.allocate(history)
+        minimap, screen, player, avail, hidden = history
+        base_action, args, spatial_args = action
+        i = self.push_index
+
+        minimap_planes = split_planes(np.reshape(minimap, np.shape(minimap)[-3:]), self.minimap_groups)
+        screen_planes = split_planes(np.reshape(screen, np.shape(screen)[-3:]), self.screen_groups)
+        for stored, planes in zip(self.minimaps + self.screens, minimap_planes + screen_planes):
+            stored[i] = planes
+        self.players[i] = np.reshape(player, self.players.shape[1:])
+        self.available[i] = pack_masks(np.reshape(avail, -1))
+        self.hiddens[i] = np.reshape(hidden, self.hiddens.shape[1:])
+
+        self.actions[i] = base_action
+        self.args[i] = args
+        self.spatial_args[i] = spatial_args
+        self.rewards[i] = reward
+        self.dones[i] = done
+        self.values[i] = vtarg
+        self.returns[i] = ret
+        self.advantages[i] = adv
+        self.log_probs[i] = log_prob
+        self.steps[i] = step
+        self.episode_ids[i] = self.episode_count
+        self.episode_starts[i] = self.episode_start
+        self.push_count += 1
+        if done:
+            self.episode_count += 1
+            self.episode_start = self.push_count
+
+        self.push_index = (self.push_index + 1) % self.Memory_capacity
+        self.num_stored = min(self.num_stored + 1, self.Memory_capacity)
 
-        idx_sample = self.indices[lower:upper]
-        mini_batch = []
-        """
-        for i in idx_sample:
+    """
+        Maps chronological indices (0 is the oldest stored transition) to
+        slots in the ring buffer.
+    """
+    def physical_index(self, logical):
+        oldest = self.push_index - self.num_stored
+        return (oldest + logical) % self.Memory_capacity
 
-            if (i == 0):
-                prev_action = 0
-            else:
-                prev_action = np.array([self.memory[i-1][1][0]])
-            row = np.array(copy.deepcopy(self.memory[i]))
-            (minimap, screen, player, avail, hidden) = row[0]
-            row[0] = np.array([np.array(minimap), np.array(screen), np.array(player), np.array(avail), np.array(hidden), np.array(prev_action)])
-            row[1][0] = np.array([row[1][0]])
-            row[1] = np.array(row[1])
-            mini_batch.append(row)
-        """
-        for i in idx_sample:
-            sample = []
-            minimap_sample = []
-            screen_sample = []
-            player_sample = []
-            avail_sample = []
-            hidden_sample = []
-            prev_action_sample = []
-            relevant_frame = []
-
-            for j in range(self.history_size):
-                sample.append(self.memory[i+j])
-
-                # if done
-                if (self.memory[i+1][-1]):
-                    relevant_frame = [0 for k in relevant_frame]
-
-                state = self.memory[i+j][0]
-                prev_action = self.memory[i+j-1][1]
-
-                minimap_sample.append(state[0])
-                screen_sample.append(state[1])
-                player_sample.append(state[2])
-                avail_sample.append(state[3])
-                hidden_sample.append(state[4])
-                prev_action_sample.append(prev_action)
-                relevant_frame.append(1)
+    """
+        Number of frames in each window ending at the given chronological
+        indices that belong to the same episode as its last frame.
+    """
+    def relevant_counts(self, targets):
+        first = self.push_count - self.num_stored
+        starts = self.episode_starts[self.physical_index(targets)]
+        return np.minimum(first + targets - starts + 1, self.history_size)
 
-            minimap_sample = np.array(minimap_sample)
-            screen_sample = np.array(screen_sample)
-            player_sample = np.array(player_sample)
-            avail_sample = np.array(avail_sample)
-            hidden_sample = np.array(hidden_sample)
-            prev_action_sample = np.array([prev_action_sample])
-            relevant_frame = np.array(relevant_frame)
-
-            row = copy.deepcopy(sample[self.history_size-1])
-            row[0] = np.array([minimap_sample, screen_sample, player_sample, avail_sample[-1], hidden_sample[0], hidden_sample[-1], prev_action_sample, relevant_frame])
-            row[1][0] = np.array([row[1][0]])
-            row[1] = np.array(row[1])
-            #state, action, _, _, _, _, _, _ = row
-            #print(state[0].shape, state[1].shape, state[2].shape)
-            mini_batch.append(row)
+    def update_indices(self):
+        self.indices = []
+        self.access_num = 0
 
+    """
+        Chronological start indices of every window that can be trained on:
+        complete, with a previous frame, and with at least
+        min_relevant * hist_size frames from the target's episode.
+    """
+    def valid_starts(self):
+        H = self.history_size
+        starts = np.arange(1, len(self) - H + 1, dtype=np.int64)
+        counts = self.relevant_counts(starts + H - 1)
+        return starts[counts >= self.min_relevant * H]
 
+    """
+        One epoch of disjoint minibatches of window starts covering every
+        valid window once, see epoch_minibatches. Pass them to gather.
+    """
+    def epoch(self, batch_size=None, num_minibatches=None):
+        if batch_size is None:
+            batch_size = self.batch_size
+        return epoch_minibatches(self.valid_starts(), batch_size, num_minibatches)
 
-        self.access_num = (self.access_num + 1) % self.reset_num
-        if (self.access_num == 0):
-            self.update_indices()
+    """
+        Next minibatch of the current epoch; a new epoch is drawn once the
+        previous one has been walked.
+    """
+    def sample_mini_batch(self, frame, hist_size=1):
+        if self.access_num == 0:
+            self.indices = self.epoch()
+        batch = self.gather(self.indices[self.access_num])
+        self.access_num = (self.access_num + 1) % len(self.indices)
+        return batch
 
-        return mini_batch
+    """
+        Returns a dict of stacked arrays for the windows starting at the
+        chronological indices idx_sample:
+
+        minimaps, screens: one list per storage group of U views of shape
+            (D, H, W), one per distinct frame in the minibatch
+        frame_index: (N, hist_size) positions of each window's frames in
+            those lists
+        players: (N, hist_size, D)
+        avail: (N, packed_mask_size) bit-packed masks for the last frame of
+            each window, see action_masks
+        hiddens: (N, 2, D, H, W), for the first frame
+        prev_actions: (N, hist_size), prev_spatials: (N, hist_size, 3, 2)
+        relevant: (N, hist_size), 0 for frames from an earlier episode
+        actions: (N,), args: (N, 10), spatial_args: (N, 3, 2)
+        returns, advantages, log_probs: (N,)
+    """
+    def gather(self, idx_sample):
+        H = self.history_size
+        idx_sample = np.asarray(idx_sample, dtype=np.int64)
+        counts = self.relevant_counts(idx_sample + H - 1)
+
+        window = idx_sample[:,None] + np.arange(H)
+        frames = self.physical_index(window)
+        prev_frames = self.physical_index(window - 1)
+        targets = frames[:,-1]
+        unique_frames, frame_index = np.unique(frames, return_inverse=True)
+
+        relevant = (np.arange(H) >= H - counts[:,None]).astype(np.uint8)
+
+        batch = {
+            "minimaps": [[stored[f] for f in unique_frames] for stored in self.minimaps],
+            "screens": [[stored[f] for f in unique_frames] for stored in self.screens],
+            "frame_index": frame_index.reshape(frames.shape),
+            "players": self.players[frames],
+            "avail": self.available[targets],
+            "hiddens": self.hiddens[frames[:,0]],
+            "prev_actions": self.actions[prev_frames],
+            "prev_spatials": self.spatial_args[prev_frames],
+            "relevant": relevant,
+            "actions": self.actions[targets],
+            "args": self.args[targets],
+            "spatial_args": self.spatial_args[targets],
+            "returns": self.returns[targets],
+            "advantages": self.advantages[targets],
+            "log_probs": self.log_probs[targets]
+        }
+
+        return batch
 
     def compute_vtargets_adv(self, gamma, lam):
-        N = len(self)
-
-        prev_gae_t = 0
-
-
-        for i in reversed(range(N-1)):
-
-            vnext = self.memory[i+1][4]
-            nonterminal = 1 - self.memory[i+1][3]    # 1 - done
-            delta = self.memory[i][2] + gamma * vnext * nonterminal - self.memory[i][4]
-            gae_t = delta + gamma * lam * nonterminal * prev_gae_t
-            self.memory[i][6] = gae_t    # advantage
-            self.memory[i][5] = gae_t + self.memory[i][4]  # advantage + value
-            prev_gae_t = gae_t
+        order = self.physical_index(np.arange(len(self)))
+        advantages, returns = vtargets_adv(self.rewards[order],
+                                            self.values[order],
+                                            self.dones[order],
+                                            gamma,
+                                            lam)
+        self.advantages[order] = advantages
+        self.returns[order] = returns    # advantage + value
 
     """
         Performs random equivalent reorientation of state
@@ -361,4 +476,73 @@ class ReplayMemory(object):
 
 
     def __len__(self):
-        return len(self.memory)
+        return self.num_stored
+
+
+torch_dtypes = {
+    np.uint8: torch.uint8,
+    np.int16: torch.int16,
+    np.int32: torch.int32
+}
+
+"""
+    Splits a random permutation of items into disjoint minibatches that
+    together contain every item exactly once. Their number is
+    num_minibatches if given, else enough to keep them at most batch_size
+    long; sizes differ by at most one.
+"""
+def epoch_minibatches(items, batch_size, num_minibatches=None):
+    if num_minibatches is None:
+        num_minibatches = int(np.ceil(len(items) / batch_size))
+    num_minibatches = max(1, min(num_minibatches, len(items)))
+    return np.array_split(np.random.permutation(items), num_minibatches)
+
+"""
+    Splits feature planes (..., D, H, W) into one array per storage group,
+    clipped to and cast to the group dtype. Warns (once, by the default
+    warnings filter) if any value had to be clipped.
+"""
+def split_planes(x, groups):
+    out = []
+    for dtype, planes in groups:
+        group = x[..., planes, :, :]
+        high = np.iinfo(dtype).max
+        if group.size > 0 and (group.min() < 0 or group.max() > high):
+            warnings.warn("feature plane values outside [0, %d] are clipped to fit %s storage"
+                            % (high, np.dtype(dtype).name))
+        out.append(np.clip(group, 0, high).astype(dtype))
+    return out
+
+"""
+    Inverse of split_planes for tensors already on the device: scatters every
+    group back into its plane positions as float.
+"""
+def widen_planes(tensors, groups):
+    shape = tensors[0].shape
+    depth = sum([len(planes) for _, planes in groups])
+    out = torch.empty(shape[:-3] + (depth,) + shape[-2:], dtype=torch.float32, device=tensors[0].device)
+    for tensor, (_, planes) in zip(tensors, groups):
+        out[..., planes, :, :] = tensor.float()
+    return out
+
+"""
+    Copies a list of equally shaped host arrays (usually frame views from
+    ReplayMemory) into one newly allocated tensor on device. This is the
+    only copy the frames go through. dtype=None keeps the storage dtype.
+"""
+def views_to_device(views, device, dtype=torch.float32):
+    if dtype is None:
+        dtype = torch.from_numpy(views[0][:0]).dtype
+    out = torch.empty((len(views),) + views[0].shape, dtype=dtype, device=device)
+    for i in range(len(views)):
+        out[i].copy_(torch.from_numpy(views[i]))
+    return out
+
+"""
+    Moves grouped frame views (as returned by ReplayMemory) to the device in
+    their storage dtypes and widens them to float there. Index the result
+    with the batch's frame_index to get (N, hist_size, D, H, W) windows.
+"""
+def planes_to_device(group_views, groups, device):
+    tensors = [views_to_device(views, device, dtype=None) for views in group_views]
+    return widen_planes(tensors, groups)
@@ -1,7 +1,6 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
 torch.backends.cudnn.benchmarks = True
 import numpy as np
 import math
@@ -10,37 +9,31 @@ import math
 """
     Convolutional implementation of LSTM.
     Check https://pytorch.org/docs/stable/nn.html#lstm to see reference information
+
+    The four input-to-gate convolutions are fused into one convolution, and
+    so are the four hidden-to-gate convolutions. Gates are ordered input,
+    forget, cell, output. forward_sequence runs the input convolution for
+    all timesteps at once, so only the hidden convolution is left in the
+    recurrence.
 """
 class ConvLSTM(nn.Module):
-    def __init__(self, input_size, hidden_size, width=8, device="cuda:0"):
+    gate_names = ["input", "forget", "gate", "output"]
+
+    def __init__(self, input_size, hidden_size, width=8):
         super(ConvLSTM, self).__init__()
 
         self.input_size, self.hidden_size = input_size, hidden_size
 
-        self.input_to_input = nn.Conv2d(input_size, hidden_size, kernel_size=3, stride=1, padding=0)
-        self.hidden_to_input = nn.Conv2d(hidden_size, hidden_size, kernel_size=3, stride=1, padding=0)
-
-        self.input_to_forget = nn.Conv2d(input_size, hidden_size, kernel_size=3, stride=1, padding=0)
-        self.hidden_to_forget = nn.Conv2d(hidden_size, hidden_size, kernel_size=3, stride=1, padding=0)
-
-        self.input_to_gate = nn.Conv2d(input_size, hidden_size, kernel_size=3, stride=1, padding=0)
-        self.hidden_to_gate = nn.Conv2d(hidden_size, hidden_size, kernel_size=3, stride=1, padding=0)
-
-        self.input_to_output = nn.Conv2d(input_size, hidden_size, kernel_size=3, stride=1, padding=0)
-        self.hidden_to_output = nn.Conv2d(hidden_size, hidden_size, kernel_size=3, stride=1, padding=0)
+        self.input_gates = nn.Conv2d(input_size, 4 * hidden_size, kernel_size=3, stride=1, padding=0)
+        self.hidden_gates = nn.Conv2d(hidden_size, 4 * hidden_size, kernel_size=3, stride=1, padding=0)
 
         self.inpad = nn.ReflectionPad2d(1)
         self.hpad = nn.ReflectionPad2d(1)
 
-        self.Wc_input = Variable(torch.zeros(1, hidden_size, width, width)).to(device)
-        self.Wc_forget = Variable(torch.zeros(1, hidden_size, width, width)).to(device)
-        self.Wc_output = Variable(torch.zeros(1, hidden_size, width, width)).to(device)
-
-        self.Wc_input.requires_grad = True
-        self.Wc_forget.requires_grad = True
-        self.Wc_output.requires_grad = True
-
-
+        # Peephole weights
+        self.Wc_input = nn.Parameter(torch.zeros(1, hidden_size, width, width))
+        self.Wc_forget = nn.Parameter(torch.zeros(1, hidden_size, width, width))
+        self.Wc_output = nn.Parameter(torch.zeros(1, hidden_size, width, width))
 
     """
         input: torch tensor of shape (N, D, H, W)
@@ -49,20 +42,47 @@ class ConvLSTM(nn.Module):
         D is placeholder as usual
     """
     def forward(self, input, hidden_state):
+        return self.step(self.input_gates(self.inpad(input)), hidden_state)
 
+    """
+        inputs: (N, T, D, H, W)
+        hidden_state: (N, 2, D, H, W) state before the first timestep
+        resets: optional (N, T) mask, the state is reset to zeros after
+            timestep t wherever resets[:,t] is set
+
+        Returns the outputs of every timestep (N, T, D, H, W) and the final
+        hidden state.
+    """
+    def forward_sequence(self, inputs, hidden_state, resets=None):
+        (N, T) = inputs.shape[:2]
+        input_gates = self.input_gates(self.inpad(inputs.flatten(0, 1)))
+        input_gates = input_gates.view((N, T) + input_gates.shape[1:])
+        if resets is not None:
+            keep = (resets == 0).to(hidden_state.dtype).view(N, T, 1, 1, 1, 1)
+
+        outputs = []
+        for t in range(T):
+            output, hidden_state = self.step(input_gates[:,t], hidden_state)
+            if resets is not None:
+                hidden_state = hidden_state * keep[:,t]
+            outputs.append(output)
+        return torch.stack(outputs, dim=1), hidden_state
+
+    def step(self, input_gates, hidden_state):
         h_0 = hidden_state[:,0]
         c_0 = hidden_state[:,1]
-        input = self.inpad(input)
-        h_0 = self.hpad(h_0)
 
-        i = F.sigmoid(self.input_to_input(input) + self.hidden_to_input(h_0) + c_0 * self.Wc_input)
-        f = F.sigmoid(self.input_to_forget(input) + self.hidden_to_forget(h_0) + c_0 * self.Wc_forget)
-        g = F.tanh(self.input_to_gate(input) + self.hidden_to_gate(h_0))
+        gates = input_gates + self.hidden_gates(self.hpad(h_0))
+        (i, f, g, o) = gates.chunk(4, dim=1)
+
+        i = torch.sigmoid(i + c_0 * self.Wc_input)
+        f = torch.sigmoid(f + c_0 * self.Wc_forget)
+        g = torch.tanh(g)
         c_t = f * c_0 + i * g
-        o = F.sigmoid(self.input_to_output(input) + self.hidden_to_output(h_0) + c_t * self.Wc_output)
-        h_t = o * F.tanh(c_t)
+        o = torch.sigmoid(o + c_t * self.Wc_output)
+        h_t = o * torch.tanh(c_t)
 
-        hidden_state_out = torch.cat([h_t.unsqueeze(1), c_t.unsqueeze(1)], dim=1)
+        hidden_state_out = torch.stack([h_t, c_t], dim=1)
 
         return o, hidden_state_out
 
@@ -72,6 +92,20 @@ class ConvLSTM(nn.Module):
         else:
             return np.zeros((batch_size, 2, self.hidden_size, width, width)).astype(np.float32)
 
+    """
+        Loads checkpoints written with one convolution per gate and without
+        peephole weights
+    """
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        for side in ["input", "hidden"]:
+            for param in ["weight", "bias"]:
+                old_keys = [prefix + "%s_to_%s.%s" % (side, gate, param) for gate in self.gate_names]
+                if all(key in state_dict for key in old_keys):
+                    state_dict[prefix + "%s_gates.%s" % (side, param)] = torch.cat([state_dict.pop(key) for key in old_keys])
+                    for gate in ["input", "forget", "output"]:
+                        state_dict.setdefault(prefix + "Wc_" + gate, torch.zeros_like(getattr(self, "Wc_" + gate)))
+        super(ConvLSTM, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 
 
 
@@ -95,64 +129,49 @@ class ResnetBlock(nn.Module):
         out = self.residuals(x)
         return x + out
 
-class RelationalProjection(nn.Module):
-    def __init__(self, in_size, num_features):
-
-        super(RelationalProjection, self).__init__()
-        self.layer = nn.Sequential(
-            nn.Linear(in_size, num_features),
-            nn.InstanceNorm1d(num_features),
-            nn.ReLU()
-        )
+"""
+    Multi-head dot-product self-attention over the positions of a (N, D, H, W)
+    feature map, e.g. the 8x8 map of RRLModel. Drop-in alternative to
+    RelationalModule with the same input and output shapes.
 
-    def forward(self, x):
-        return self.layer(x)
+    One packed projection produces the queries, keys and values of all
+    heads. Each projection is normalized over its features and passed through
+    a ReLU. All heads attend in one batched (N, heads, HW, HW) product, and
+    the concatenated heads go through a residual MLP and a final
+    normalization.
 
+    Output depth is num_heads * num_features.
+"""
 class SelfAttentionBlock(nn.Module):
-    def __init__(self, in_size, num_features, num_heads, device="cuda:0"):
+    def __init__(self, in_size, num_features, num_heads):
 
         super(SelfAttentionBlock, self).__init__()
-        self.device = device
         self.in_size = in_size
         self.num_features = num_features
         self.num_heads = num_heads
-        self.QueryLayers = []
-        self.KeyLayers = []
-        self.ValueLayers = []
-
-        for i in range(in_size):
-            self.QueryLayers.append(RelationalProjection(in_size, num_features).to(self.device))
-            self.KeyLayers.append(RelationalProjection(in_size, num_features).to(self.device))
-            self.ValueLayers.append(RelationalProjection(in_size, num_features).to(self.device))
+
+        self.qkv = nn.Linear(in_size, 3 * num_heads * num_features)
         self.MLP = nn.Sequential(
             nn.Linear(self.num_heads * self.num_features, self.num_heads * self.num_features),
             nn.ReLU(),
             nn.Linear(self.num_heads * self.num_features, self.num_heads * self.num_features),
             nn.ReLU()
-        ).to(self.device)
-
-        self.output_norm = nn.InstanceNorm1d(num_features)
+        )
 
     def forward(self, x):
         (N, D, H, W) = x.shape
-        new_x = x.permute(0, 2, 3, 1)
-        flattened = new_x.flatten(start_dim=1, end_dim=-2)
-
-        heads_out = []
-
-        for i in range(self.num_heads):
-            Q = self.QueryLayers[i](flattened)
-            K = self.KeyLayers[i](flattened)
-            V = self.ValueLayers[i](flattened)
-            numerator = torch.matmul(Q, K.permute(0,2,1))
-            scaled = numerator / math.sqrt(self.num_features)
-            attention_weights = F.softmax(scaled)
-            A = torch.matmul(attention_weights, V)
-            heads_out.append(A)
-
-        heads_out = torch.cat(heads_out, dim=-1)
-        output = self.output_norm(self.MLP(heads_out) + heads_out)
-        output = output.permute(0,2,1).contiguous().view((N, -1, H, W))
+        flattened = x.flatten(2, 3).transpose(1, 2)
+
+        # (3, N, heads, HW, features)
+        qkv = self.qkv(flattened).view(N, H * W, 3, self.num_heads, self.num_features).permute(2, 0, 3, 1, 4)
+        (Q, K, V) = F.relu(F.layer_norm(qkv, (self.num_features,)))
+
+        attention_weights = F.softmax(torch.matmul(Q, K.transpose(-1, -2)) / math.sqrt(self.num_features), dim=-1)
+        heads_out = torch.matmul(attention_weights, V).transpose(1, 2).flatten(2, 3)
+
+        output = self.MLP(heads_out) + heads_out
+        output = F.layer_norm(output, output.shape[-1:])
+        output = output.transpose(1, 2).reshape((N, -1, H, W))
 
         return output
 
@@ -167,7 +186,7 @@ class RelationalModule(nn.Module):
         self.num_heads=num_heads
         self.encode = encode
         self.net_encoding = nn.Conv2d(in_size, num_heads*num_features, kernel_size=3, stride=1, padding=1)
-        self.mhdpa = nn.TransformerEncoderLayer(num_heads*num_features, num_heads, dim_feedforward=num_features)
+        self.mhdpa = nn.TransformerEncoderLayer(num_heads*num_features, num_heads, dim_feedforward=num_features, batch_first=True)
 
     def forward(self, x):
         if (self.encode and self.in_size != self.num_heads*self.num_features):
@@ -259,10 +278,17 @@ class SpatialUpsampler(nn.Module):
             )
         )
 
-    def forward(self, x):
+    """
+        channels: optional int64 tensor of output channels; only those are
+        computed by the last convolution, in that order
+    """
+    def forward(self, x, channels=None):
 
         h1 = self.tconv1(x)
         h2 = self.tconv2(h1)
+        if channels is not None:
+            conv = self.conv_out[0]
+            return F.conv2d(h2, conv.weight[channels], conv.bias[channels], padding=conv.padding)
         h3 = self.conv_out(h2)
 
         return h3
@@ -292,6 +318,96 @@ class FastEmbedding(nn.Module):
         super(FastEmbedding, self)._save_to_state_dict(destination, prefix, keep_vars)
 
 
+"""
+    Embeds all planes of a feature layer stack (N, D, H, W) at once.
+
+    The categorical planes share one table: each plane's ids are offset into
+    its own rows, so all of them are looked up with a single gather. Scalar
+    planes are log transformed and scaled by precomputed 1 / log(scale). Both
+    are written into one output (N, output_dim, H, W), where each categorical
+    plane becomes embedding_dim channels in its original position. Runs of
+    adjacent planes of the same kind are copied as one block.
+
+    scales: scale of each plane (number of categories or value range)
+    categorical: whether each plane is categorical
+    chunk_size: frames gathered at a time, which bounds the size of the
+        temporary lookup result
+"""
+class PlaneEmbedding(nn.Module):
+    def __init__(self, scales, categorical, embedding_dim, chunk_size=8):
+        super(PlaneEmbedding, self).__init__()
+        self.embedding_dim = embedding_dim
+        self.chunk_size = chunk_size
+        self.num_planes = len(scales)
+        categorical_planes = [i for i in range(self.num_planes) if categorical[i]]
+        scalar_planes = [i for i in range(self.num_planes) if not categorical[i]]
+        self.num_categorical = len(categorical_planes)
+        self.output_dim = self.num_planes + self.num_categorical * (embedding_dim - 1)
+
+        # Rows per categorical plane, initialized like the nn.Linear of FastEmbedding
+        self.rows = [scales[i] + 1 for i in categorical_planes]
+        self.weight = nn.Parameter(torch.cat([torch.empty(rows, embedding_dim).uniform_(-1, 1) / math.sqrt(rows)
+                                                for rows in self.rows]))
+        offsets = np.cumsum([0] + self.rows[:-1])
+        inv_log_scales = [1.0 / math.log(scales[i]) if scales[i] > 1 else 1.0 for i in range(self.num_planes)]
+
+        # (first plane, last plane + 1, first output channel) of each run
+        self.categorical_runs, self.scalar_runs = [], []
+        channel = 0
+        for i in range(self.num_planes):
+            runs = self.categorical_runs if categorical[i] else self.scalar_runs
+            if runs and runs[-1][1] == i:
+                runs[-1][1] = i + 1
+            else:
+                runs.append([i, i + 1, channel])
+            channel += embedding_dim if categorical[i] else 1
+        # Categorical runs index the looked up planes, not the input planes
+        for run in self.categorical_runs:
+            run[0], run[1] = categorical_planes.index(run[0]), categorical_planes.index(run[1] - 1) + 1
+
+        self.register_buffer("categorical_planes", torch.tensor(categorical_planes, dtype=torch.long), persistent=False)
+        self.register_buffer("offsets", torch.tensor(offsets, dtype=torch.long).view(1, -1, 1, 1), persistent=False)
+        # Last valid id of each plane, so out of range ids never reach the next plane's rows
+        self.register_buffer("max_ids", torch.tensor(self.rows, dtype=torch.long).view(1, -1, 1, 1) - 1, persistent=False)
+        self.register_buffer("inv_log_scales", torch.tensor(inv_log_scales).view(1, -1, 1, 1), persistent=False)
+
+    """
+        x: (N, num_planes, H, W) raw feature values
+        out: optional preallocated (N, output_dim, H, W) output
+    """
+    def forward(self, x, out=None):
+        x = x.to(self.weight.device)
+        (N, _, H, W) = x.shape
+        E = self.embedding_dim
+        if out is None:
+            out = torch.empty((N, self.output_dim, H, W), dtype=self.weight.dtype, device=x.device)
+
+        for start in range(0, N, self.chunk_size):
+            end = min(start + self.chunk_size, N)
+            ids = x[start:end].index_select(1, self.categorical_planes).long().clamp_(min=0)
+            ids = torch.minimum(ids, self.max_ids, out=ids).add_(self.offsets)
+            embedded = self.weight.index_select(0, ids.view(-1)).view(ids.shape + (E,)).permute(0, 1, 4, 2, 3)
+            for first, last, channel in self.categorical_runs:
+                block = out[start:end, channel:channel + (last - first) * E]
+                block.view(end - start, last - first, E, H, W).copy_(embedded[:, first:last])
+
+        for first, last, channel in self.scalar_runs:
+            scalars = torch.log1p(x[:, first:last].float()) * self.inv_log_scales[:, first:last]
+            out[:, channel:channel + last - first] = scalars
+        return out
+
+    """
+        Loads checkpoints written with one FastEmbedding per categorical plane
+    """
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        old_keys = [prefix + "%d.layer.weight" % j for j in range(self.num_categorical)]
+        if prefix + "weight" not in state_dict and all(key in state_dict for key in old_keys):
+            state_dict[prefix + "weight"] = torch.cat([state_dict.pop(key).t() for key in old_keys])
+            for j in range(self.num_categorical):
+                state_dict.pop(prefix + "%d.layer.bias" % j, None)
+        super(PlaneEmbedding, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
 class Unsqueeze(nn.Module):
     def forward(self, x):
         return x.unsqueeze(-1)
@@ -0,0 +1,162 @@
+"""
+    Background minibatch prefetching.
+
+    Training used to sample a minibatch, convert it and copy it to the device
+    before every forward pass, with the GPU idle in between. Prefetcher runs
+    that work for the next minibatches on a worker thread while the current
+    one trains.
+
+    On CUDA devices PinnedStager copies every field into reusable page-locked
+    host buffers and issues non-blocking copies on a side stream, so the
+    host-to-device transfer overlaps with compute as well. On the CPU it
+    degrades to plain conversions.
+"""
+
+import threading
+import contextlib
+from queue import Queue
+import numpy as np
+import torch
+
+
+class PinnedStager(object):
+    def __init__(self, device, num_slots):
+        self.device = torch.device(device)
+        self.pinned = self.device.type == "cuda"
+        self.buffers = [{} for _ in range(num_slots)]
+        self.events = [None] * num_slots
+        self.slot = 0
+        self.stream = torch.cuda.Stream(self.device) if self.pinned else None
+
+    """
+        Moves to the next set of buffers. Waits until the copies previously
+        issued from that set have finished so its buffers can be overwritten.
+    """
+    def next_slot(self):
+        self.slot = (self.slot + 1) % len(self.buffers)
+        if self.events[self.slot] is not None:
+            self.events[self.slot].synchronize()
+            self.events[self.slot] = None
+
+    def buffer(self, name, shape, dtype):
+        buf = self.buffers[self.slot].get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = torch.empty(shape, dtype=dtype, pin_memory=True)
+            self.buffers[self.slot][name] = buf
+        return buf
+
+    """
+        Copies one host array to the device as dtype (the array's own dtype
+        if None).
+    """
+    def stage(self, name, array, dtype=None):
+        src = torch.from_numpy(np.ascontiguousarray(array))
+        dtype = src.dtype if dtype is None else dtype
+        if not self.pinned:
+            return src.to(self.device, dtype)
+        buf = self.buffer(name, src.shape, dtype)
+        buf.copy_(src)
+        return buf.to(self.device, non_blocking=True)
+
+    """
+        Stacks a list of equally shaped host arrays (e.g. history window
+        views) straight into one staging buffer and copies it to the device,
+        keeping their dtype.
+    """
+    def stage_views(self, name, views):
+        src = [torch.from_numpy(v) for v in views]
+        shape = (len(src),) + src[0].shape
+        if not self.pinned:
+            out = torch.empty(shape, dtype=src[0].dtype, device=self.device)
+        else:
+            out = self.buffer(name, shape, src[0].dtype)
+        for i in range(len(src)):
+            out[i].copy_(src[i])
+        if not self.pinned:
+            return out
+        return out.to(self.device, non_blocking=True)
+
+    """
+        Context the whole minibatch is loaded in, so that staged copies and
+        any device work done on them are ordered on the staging stream.
+    """
+    def context(self):
+        if not self.pinned:
+            return contextlib.nullcontext()
+        return torch.cuda.stream(self.stream)
+
+    """
+        Marks the end of a minibatch: returns an event the consumer has to
+        wait on before using the staged tensors (None on the CPU).
+    """
+    def finish(self):
+        if not self.pinned:
+            return None
+        event = torch.cuda.Event()
+        event.record(self.stream)
+        self.events[self.slot] = event
+        return event
+
+
+class Prefetcher(object):
+    """
+        load_batch: callable returning the next ready-to-train minibatch,
+            typically sampling from a memory and staging through stager
+        num_batches: number of minibatches to produce
+        depth: how many minibatches may be prepared ahead of the consumer
+    """
+    def __init__(self, load_batch, num_batches, stager=None, depth=2):
+        self.load_batch = load_batch
+        self.num_batches = num_batches
+        self.stager = stager
+        self.queue = Queue(maxsize=depth)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        for _ in range(self.num_batches):
+            try:
+                event = None
+                if self.stager is None:
+                    batch = self.load_batch()
+                else:
+                    self.stager.next_slot()
+                    with self.stager.context():
+                        batch = self.load_batch()
+                    event = self.stager.finish()
+                self.queue.put((batch, event, None))
+            except Exception as e:
+                self.queue.put((None, None, e))
+                return
+
+    """
+        Blocks until the next minibatch is ready. Errors raised while loading
+        are re-raised here.
+    """
+    def get(self):
+        batch, event, error = self.queue.get()
+        if error is not None:
+            raise error
+        if event is not None:
+            torch.cuda.current_stream().wait_event(event)
+            for tensor in iter_tensors(batch):
+                if tensor.is_cuda:
+                    tensor.record_stream(torch.cuda.current_stream())
+        return batch
+
+    def __iter__(self):
+        for _ in range(self.num_batches):
+            yield self.get()
+
+
+def iter_tensors(batch):
+    if torch.is_tensor(batch):
+        yield batch
+    elif isinstance(batch, dict):
+        for value in batch.values():
+            for tensor in iter_tensors(value):
+                yield tensor
+    elif isinstance(batch, (list, tuple)):
+        for value in batch:
+            for tensor in iter_tensors(value):
+                yield tensor
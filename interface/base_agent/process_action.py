@@ -1,4 +1,5 @@
-from pysc2.lib.actions import FUNCTIONS, TYPES, FunctionCall
+from pysc2.lib.actions import TYPES, FunctionCall
+from .action_tables import arg_ids
 
 
 """
@@ -14,14 +15,9 @@ def action_to_pysc2(agent_action):
 
     [[base_action, args, spatial_args]] = agent_action
 
-    base_action_func = FUNCTIONS._func_list[base_action]
-    arg_types = base_action_func.args
-    arg_ids = [arg_types[i].id for i in range(len(arg_types))]
-
     arg_inputs = []
     spatial_arg_inputs = []
-    for i in range(len(arg_ids)):
-        id = arg_ids[i]
+    for id in arg_ids[base_action]:
         if is_spatial_arg(id):
             spatial_arg_inputs.append(spatial_args[id])
         elif TYPES[id].values is not None:
@@ -29,7 +25,7 @@ def action_to_pysc2(agent_action):
         else:
             arg_inputs.append([args[id-3]])
 
-    function = FunctionCall(base_action_func.id, arg_inputs + spatial_arg_inputs)
+    function = FunctionCall(base_action, arg_inputs + spatial_arg_inputs)
     return function
 
 def is_spatial_arg(id):
@@ -9,7 +9,7 @@ def state_processor(obs):
     screen = obs.observation.feature_screen
     player = obs.observation.player
 
-    avail_actions = np.zeros(ACTION_SPACE)
+    avail_actions = np.zeros(ACTION_SPACE, dtype=np.uint8)
     avail_actions[obs.observation.available_actions] = 1
 
     minimap = minimap.reshape((1,) + minimap.shape)
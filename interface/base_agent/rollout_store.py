@@ -0,0 +1,208 @@
+"""
+    Segmented on-disk rollout store for replay memories larger than RAM.
+
+    Each field of ReplayMemory is split into fixed-size shards, every shard
+    being its own .npy file opened with np.memmap. Reads go through the OS page
+    cache, so random minibatch access only touches the pages it needs. Shards
+    are flushed to disk on a background thread as soon as they are filled, and
+    a small JSON index records field shapes and ring buffer counters so a store
+    can be reopened later, e.g. for offline training. The index is written
+    when the shards are allocated and again whenever a shard is completed,
+    so a crashed run can be reopened up to its last completed shard.
+"""
+
+import os
+import json
+import threading
+from queue import Queue
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from base_agent.memory import ReplayMemory
+
+
+"""
+    Array-like view over a list of memmapped shards. Supports the indexing
+    ReplayMemory needs: integers, contiguous slices (wrapping around the end
+    of the ring) and integer arrays. Slices that stay inside one shard are
+    returned as views, everything else is gathered into a new array.
+"""
+class ShardedMemmap(object):
+    def __init__(self, prefix, shape, dtype, shard_size, mode="w+"):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.capacity = self.shape[0]
+        self.item_shape = self.shape[1:]
+        self.shard_size = shard_size
+
+        self.shards = []
+        num_shards = int(np.ceil(self.capacity / shard_size))
+        for s in range(num_shards):
+            path = "%s_%04d.npy" % (prefix, s)
+            if mode == "w+":
+                rows = min(shard_size, self.capacity - s * shard_size)
+                shard = open_memmap(path, mode="w+", dtype=self.dtype, shape=(rows,) + self.item_shape)
+            else:
+                shard = np.load(path, mmap_mode=mode)
+            self.shards.append(shard)
+
+    def __len__(self):
+        return self.capacity
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            shard, offset = divmod(int(key) % self.capacity, self.shard_size)
+            return self.shards[shard][offset]
+
+        if isinstance(key, slice):
+            start, stop = key.start or 0, key.stop
+            shard, offset = divmod(start, self.shard_size)
+            if stop <= self.capacity and (stop - 1) // self.shard_size == shard:
+                return self.shards[shard][offset:offset + stop - start]
+            key = np.arange(start, stop)
+
+        key = np.asarray(key)
+        flat = key.reshape(-1) % self.capacity
+        shard_ids = flat // self.shard_size
+        out = np.empty((len(flat),) + self.item_shape, dtype=self.dtype)
+        for s in np.unique(shard_ids):
+            mask = shard_ids == s
+            out[mask] = self.shards[s][flat[mask] - s * self.shard_size]
+        return out.reshape(key.shape + self.item_shape)
+
+    def __setitem__(self, key, value):
+        if isinstance(key, (int, np.integer)):
+            shard, offset = divmod(int(key) % self.capacity, self.shard_size)
+            self.shards[shard][offset] = value
+            return
+
+        flat = np.asarray(key).reshape(-1) % self.capacity
+        value = np.asarray(value).reshape((len(flat),) + self.item_shape)
+        shard_ids = flat // self.shard_size
+        for s in np.unique(shard_ids):
+            mask = shard_ids == s
+            self.shards[s][flat[mask] - s * self.shard_size] = value[mask]
+
+    def flush_shard(self, shard):
+        self.shards[shard].flush()
+
+    def flush(self):
+        for shard in self.shards:
+            shard.flush()
+
+
+"""
+    Background thread that writes completed shards to disk so that pushing
+    transitions never waits on I/O.
+"""
+class ShardFlusher(object):
+    def __init__(self):
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            arrays, shard = self.queue.get()
+            for array in arrays:
+                array.flush_shard(shard)
+            self.queue.task_done()
+
+    def submit(self, arrays, shard):
+        self.queue.put((arrays, shard))
+
+    def wait(self):
+        self.queue.join()
+
+
+"""
+    ReplayMemory whose fields live in a sharded on-disk store instead of RAM.
+    Same push/sample_mini_batch/compute_vtargets_adv API, so it can be handed
+    to BaseAgent directly.
+
+    If directory already holds an index, the store is reopened with its
+    contents and counters.
+"""
+class MemmapReplayMemory(ReplayMemory):
+    def __init__(self, mem_cap, batch_size, hist_size=1, directory="rollouts", shard_size=4096, min_relevant=0.0):
+        super(MemmapReplayMemory, self).__init__(mem_cap, batch_size, hist_size, min_relevant)
+        self.directory = directory
+        self.shard_size = shard_size
+        self.fields = {}
+        self.history_shapes = None
+        self.open_mode = "w+"
+        self.flusher = ShardFlusher()
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if os.path.exists(self.index_path()):
+            self.load_index()
+
+    def index_path(self):
+        return os.path.join(self.directory, "index.json")
+
+    def allocate(self, history):
+        self.history_shapes = [list(np.shape(x)) for x in history]
+        super(MemmapReplayMemory, self).allocate(history)
+        self.write_index()
+
+    def new_array(self, name, shape, dtype):
+        array = ShardedMemmap(os.path.join(self.directory, name), shape, dtype, self.shard_size, mode=self.open_mode)
+        self.fields[name] = array
+        return array
+
+    def push(self, history, action, reward, done, vtarg, ret, adv, step, log_prob=0.0):
+        super(MemmapReplayMemory, self).push(history, action, reward, done, vtarg, ret, adv, step, log_prob)
+        if self.push_index % self.shard_size == 0:
+            completed = (self.push_index - 1) % self.Memory_capacity // self.shard_size
+            self.flusher.submit(list(self.fields.values()), completed)
+            self.write_index()
+
+    """
+        Waits for pending background flushes, writes every shard and updates
+        the index. Call before reopening the store from another process.
+    """
+    def flush(self):
+        self.flusher.wait()
+        for array in self.fields.values():
+            array.flush()
+        self.write_index()
+
+    def write_index(self):
+        index = {
+            "capacity": self.Memory_capacity,
+            "shard_size": self.shard_size,
+            "push_index": self.push_index,
+            "num_stored": self.num_stored,
+            "episode_count": self.episode_count,
+            "push_count": self.push_count,
+            "episode_start": self.episode_start,
+            "history_shapes": self.history_shapes,
+            "fields": {name: {"shape": list(array.shape), "dtype": array.dtype.str}
+                        for name, array in self.fields.items()}
+        }
+        tmp_path = self.index_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path())
+
+    """
+        Restores the counters and reopens the shards. An index written before
+        anything was pushed describes an empty store and is ignored.
+    """
+    def load_index(self):
+        with open(self.index_path()) as f:
+            index = json.load(f)
+        if index["history_shapes"] is None:
+            return
+        assert index["capacity"] == self.Memory_capacity
+        self.shard_size = index["shard_size"]
+        self.push_index = index["push_index"]
+        self.num_stored = index["num_stored"]
+        self.episode_count = index["episode_count"]
+        self.push_count = index["push_count"]
+        self.episode_start = index["episode_start"]
+        # Reopen the existing shards through the regular allocation path
+        self.open_mode = "r+"
+        self.allocate([np.zeros(shape) for shape in index["history_shapes"]])
+        self.open_mode = "w+"
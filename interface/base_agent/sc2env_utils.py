@@ -2,25 +2,18 @@ from pysc2.lib.features import SCREEN_FEATURES, MINIMAP_FEATURES, FeatureType, P
 CATEGORICAL = FeatureType.CATEGORICAL
 SCALAR = FeatureType.SCALAR
 from pysc2.lib.actions import FUNCTIONS, TYPES
-from .net_utils import FastEmbedding
+from .net_utils import PlaneEmbedding
 import torch
-import torch.nn as nn
 torch.backends.cudnn.benchmarks = True
 import numpy as np
 from .process_action import action_to_pysc2
+from .action_tables import arg_ids
 
 def get_action_args(action):
-    base_action_func = FUNCTIONS._func_list[action]
-    arg_types = base_action_func.args
-    arg_ids = np.array([arg_types[i].id for i in range(len(arg_types))])
-
-    return arg_ids
+    return arg_ids[action]
 
 def batch_get_action_args(actions):
-    base_action_funcs = [FUNCTIONS._func_list[i] for i in actions]
-    arg_types = [base_action_funcs[i].args for i in range(len(base_action_funcs))]
-    arg_ids = np.array([[arg_types[i][j].id for j in range(len(arg_types[i]))] for i in range(len(arg_types))])
-    return arg_ids
+    return [arg_ids[a] for a in actions]
 
 def is_spatial_arg(action_id):
     return action_id < 3
@@ -39,6 +32,28 @@ def print_action(action):
     action = action_to_pysc2(action)
     print(action)
 
+"""
+    Smallest dtype that holds every value of a feature with the given pysc2
+    scale (categorical ids or bounded scalars are always below scale).
+"""
+def storage_dtype(scale):
+    if scale <= np.iinfo(np.uint8).max + 1:
+        return np.uint8
+    if scale <= np.iinfo(np.int16).max + 1:
+        return np.int16
+    return np.int32
+
+"""
+    Groups feature planes by storage dtype.
+    Returns a list of (dtype, plane indices), narrowest dtype first.
+"""
+def storage_groups(features):
+    groups = {}
+    for i in range(len(features)):
+        dtype = storage_dtype(features[i].scale)
+        groups.setdefault(dtype, []).append(i)
+    return [(dtype, groups[dtype]) for dtype in sorted(groups, key=lambda d: np.dtype(d).itemsize)]
+
 minimap_categorical_indices, minimap_categorical_sizes = categorical_mask(MINIMAP_FEATURES)
 screen_categorical_indices, screen_categorical_sizes = categorical_mask(SCREEN_FEATURES)
 full_action_space = np.ones(len(FUNCTIONS))
@@ -61,6 +76,9 @@ env_config = {
     "screen_categorical_size": screen_categorical_sizes,
     "minimap_categorical_size": minimap_categorical_sizes,
 
+    "screen_storage_groups": storage_groups(SCREEN_FEATURES),
+    "minimap_storage_groups": storage_groups(MINIMAP_FEATURES),
+
     "action_space": len(FUNCTIONS),
     "num_arg_types": 13, #int, number of sets of arguments to choose from
     "arg_depth": 10,
@@ -76,56 +94,43 @@ for i in range(10):
     size = type.sizes[0]
     valid_args[0,i,:size] = 1
 
-def generate_embeddings(config):
+"""
+    One-hot planes marking the spatial arguments of the last actions.
 
-    embeddings = [minimap_embeddings, screen_embeddings] = [nn.ModuleList(), nn.ModuleList()]
-    input_names = ["minimap", "screen"]
-    for i in range(len(input_names)):
-        base = input_names[i]
-        cat_indices = env_config[base + "_categorical_indices"]
-        cat_sizes = env_config[base + "_categorical_size"]
-        embed_size = config['state_embedding_size']
+    last_spatials: (N, spatial_action_depth, 2) coordinates, negative where
+        the argument was not used
+    shape: (H, W) of the planes
+    scale: factor from action coordinates to plane coordinates
 
-        for j in range(len(cat_indices)):
-            #embeddings[i].append(nn.Embedding(cat_sizes[j]+1, embed_size).to(config["device"]))
-            embeddings[i].append(FastEmbedding(cat_sizes[j]+1, embed_size).to(config["device"]))
-    return embeddings
+    Returns a fresh (N, spatial_action_depth, H, W) tensor in which plane k of
+    sample n is set at coordinate k of sample n, built with one scatter.
+"""
+def spatial_action_planes(last_spatials, shape, scale=1, dtype=torch.float32):
+    (N, D, _) = last_spatials.shape
+    (H, W) = shape
+    valid = last_spatials[:,:,0] >= 0
+    coords = scale * last_spatials.clamp(min=0)
+    pixels = coords[:,:,0] * W + coords[:,:,1]
+    planes = torch.zeros((N, D, H * W), dtype=dtype, device=last_spatials.device)
+    planes.scatter_(2, pixels.unsqueeze(-1), valid.unsqueeze(-1).to(dtype))
+    return planes.view(N, D, H, W)
 
 """
-    Performs log transform for scalar features
-    Performs FastEmbedding for categorical features
+    One PlaneEmbedding for the minimap and one for the screen features
 """
-def embed(x, embedding_list, embedding_indices):
-    s = x.shape
-    feature_dim = s[1]
-    embedding_size = embedding_list[0].embedding_dim
-    output_dim = feature_dim + sum([e.embedding_dim for e in embedding_list]) - len(embedding_list)
-
-    output = torch.zeros((s[0],) + (output_dim,) + s[2:], dtype=x.dtype, device=x.device)
-    lower = 0
-    upper = 0
-    embed_count = 0
-    for i in range(feature_dim):
-        if (i in embedding_indices):
-            upper += embedding_size
-            output[:,lower:upper] = embedding_list[embed_count](x[:,i].long()).permute((0,3,1,2))
-            #output[:,lower:upper] = torch.log(output[:,lower:upper]+1.0)
-            embed_count += 1
-        else:
-            upper += 1
-            output[:,lower] = torch.log(x[:,i] - torch.min(x[:,i]) + 1.0)
-        lower = upper
-
-    return output
-
-def processed_feature_dim(feature_size, embedding_list):
-    return feature_size + sum([e.embedding_dim for e in embedding_list]) - len(embedding_list)
+def generate_embeddings(config):
+    return [PlaneEmbedding([f.scale for f in features],
+                            [f.type == CATEGORICAL for f in features],
+                            config['state_embedding_size']).to(config["device"])
+            for features in [MINIMAP_FEATURES, SCREEN_FEATURES]]
+
+def processed_feature_dim(feature_size, embedding):
+    return feature_size + embedding.num_categorical * (embedding.embedding_dim - 1)
 
 """
 
     Performs simultaneous embeddings for each input
 
 """
-def multi_embed(inputs, embedding_lists, embedding_indices):
-    outputs = [embed(inputs[i], embedding_lists[i], embedding_indices[i]) for i in range(len(inputs))]
-    return outputs
+def multi_embed(inputs, embeddings):
+    return [embedding(x) for x, embedding in zip(inputs, embeddings)]
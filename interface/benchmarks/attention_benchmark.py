@@ -0,0 +1,99 @@
+"""
+    Relational block cost at the 8x8 spatial resolution of RRLModel: the
+    packed multi-head SelfAttentionBlock against a per-head loop over the
+    same weights (the previous formulation, one projection, matmul and
+    softmax per head) and against RelationalModule, the
+    TransformerEncoderLayer block RRLModel uses by default. The per-head
+    loop must give the same output as the packed block.
+
+    Run from this directory:
+        python attention_benchmark.py
+"""
+
+import sys
+sys.path.insert(0, "../../interface/")
+
+import math
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+
+from base_agent.net_utils import SelfAttentionBlock, RelationalModule
+
+
+def per_head_attention(block, x):
+    (N, D, H, W) = x.shape
+    flattened = x.flatten(2, 3).transpose(1, 2)
+    size = block.num_heads * block.num_features
+    weights = block.qkv.weight.split(block.num_features)
+    biases = block.qkv.bias.split(block.num_features)
+
+    def project(k):
+        return F.relu(F.layer_norm(F.linear(flattened, weights[k], biases[k]), (block.num_features,)))
+
+    heads_out = []
+    for i in range(block.num_heads):
+        Q = project(i)
+        K = project(block.num_heads + i)
+        V = project(2 * block.num_heads + i)
+        attention_weights = F.softmax(torch.matmul(Q, K.transpose(1, 2)) / math.sqrt(block.num_features), dim=-1)
+        heads_out.append(torch.matmul(attention_weights, V))
+    heads_out = torch.cat(heads_out, dim=-1)
+
+    output = F.layer_norm(block.MLP(heads_out) + heads_out, (size,))
+    return output.transpose(1, 2).reshape((N, -1, H, W))
+
+
+def timed(func, repeats):
+    func()
+    best = float("inf")
+    for _ in range(repeats):
+        t1 = time.time()
+        func()
+        best = min(best, time.time() - t1)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=32)
+    # LSTM_in_size and relational settings of experiments/DeepMind2018/run.py
+    parser.add_argument("--in_size", type=int, default=578)
+    parser.add_argument("--features", type=int, default=32)
+    parser.add_argument("--heads", type=int, default=3)
+    parser.add_argument("--width", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    torch.manual_seed(0)
+    attention = SelfAttentionBlock(args.in_size, args.features, args.heads).to(device)
+    transformer = RelationalModule(args.in_size, args.features, args.heads).to(device).eval()
+    x = torch.randn(args.batch_size, args.in_size, args.width, args.width, device=device)
+
+    with torch.no_grad():
+        error = (attention(x) - per_head_attention(attention, x)).abs().max().item()
+    print("packed vs per-head max error: %.2e\n" % error)
+
+    runs = [
+        ("per-head loop", attention, lambda: per_head_attention(attention, x)),
+        ("packed", attention, lambda: attention(x)),
+        ("RelationalModule", transformer, lambda: transformer(x))
+    ]
+
+    print("%18s %14s %14s %12s" % ("", "forward (ms)", "f+b (ms)", "parameters"))
+    for name, module, run in runs:
+        with torch.no_grad():
+            forward_time = timed(run, args.repeats)
+
+        def forward_backward():
+            module.zero_grad()
+            run().sum().backward()
+        backward_time = timed(forward_backward, args.repeats)
+        parameters = sum(p.numel() for p in module.parameters())
+        print("%18s %14.2f %14.2f %12d" % (name, 1000 * forward_time, 1000 * backward_time, parameters))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+    Compares BaseAgent training steps and action sampling with the bfloat16
+    autocast path (train_settings["bf16"]) against plain float32, using the
+    DeepMind2018 RRLModel on a replay memory filled from the random
+    environment.
+
+    Both agents start from the same weights and train on the same minibatch,
+    so the losses returned by the first step should agree up to bf16
+    precision.
+
+    Run from this directory:
+        python bf16_benchmark.py
+"""
+
+import sys
+sys.path.insert(0, "../../interface/")
+sys.path.insert(0, "../../experiments/DeepMind2018/")
+
+import io
+import copy
+import time
+import argparse
+import contextlib
+import numpy as np
+import torch
+
+from RRLNetwork import RRLModel
+from base_agent.base_agent import BaseAgent
+from base_agent.memory import ReplayMemory
+from base_agent.custom_env import RandomEnvironment
+from base_agent.sc2env_utils import full_action_space
+from agent import AgentSettings
+
+
+def make_agent(model, memory, history_size, bf16):
+    settings = AgentSettings(torch.optim.Adam, 1e-4, 0.3, 0.05, 2e4, 1e-8)
+    train_settings = {
+        "discount_factor": 0.99,
+        "lambda": 0.95,
+        "hist_size": history_size,
+        "device": "cpu",
+        "eps_denom": 1e-5,
+        "c1": 0.1,
+        "c2": 0.01,
+        "c3": 1.0,
+        "c4": 1.0,
+        "minc2": 0.01,
+        "clip_param": 0.1,
+        "min_clip_param": 0.01,
+        "clip_decay": 10000,
+        "c2_decay": 10000,
+        "map": "benchmark",
+        "history_size": history_size,
+        "bf16": bf16
+    }
+    return BaseAgent(model, settings, memory, train_settings)
+
+
+def fill(agent, steps):
+    env = RandomEnvironment(max_episode_len=50, max_state_value=1)
+    states, _, done, _ = env.reset()
+    for _ in range(steps):
+        state = agent.state_space_converter(states[0])
+        action = agent.sample(state)
+        states, reward, done, _ = env.step([action])
+        agent.push_memory(state, action, reward[0], done)
+        if done:
+            states, _, done, _ = env.reset()
+
+
+def timed(func, repeats):
+    best = float("inf")
+    out = None
+    for _ in range(repeats):
+        t1 = time.time()
+        out = func()
+        best = min(best, time.time() - t1)
+    return best, out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--history_size", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    # Same network as experiments/DeepMind2018/run.py
+    net_config = {
+        "state_embedding_size": 10,
+        "action_embedding_size": 16,
+        "down_conv_features": 128,
+        "down_residual_depth": 2,
+        "up_features": 32,
+        "up_conv_features": 128,
+        "resnet_features": 128,
+        "LSTM_in_size": 64,
+        "LSTM_hidden_size": 96,
+        "inputs2d_size": 64,
+        "inputs3d_width": 8,
+        "relational_features": 32,
+        "relational_depth": 3,
+        "relational_heads": 3,
+        "spatial_out_depth": 64,
+        "channels3": 16,
+        "history_size": args.history_size,
+        "device": "cpu"
+    }
+    model = RRLModel(net_config, device="cpu", action_space=np.ones(full_action_space.shape))
+    memory = ReplayMemory(4 * args.batch_size, args.batch_size, hist_size=args.history_size)
+
+    agents = {
+        "fp32": make_agent(model, memory, args.history_size, False),
+        "bf16": make_agent(copy.deepcopy(model), memory, args.history_size, True)
+    }
+    fill(agents["fp32"], 4 * args.batch_size)
+    memory.compute_vtargets_adv(0.99, 0.95)
+    batch = agents["fp32"].load_batch()
+    state = agents["fp32"].state_space_converter(RandomEnvironment(max_state_value=1).reset()[0][0])
+
+    results = {}
+    for name, agent in agents.items():
+        with contextlib.redirect_stdout(io.StringIO()):
+            losses = agent.train_step(args.batch_size, batch)
+            train_time, _ = timed(lambda: agent.train_step(args.batch_size, batch), args.repeats)
+        sample_time, _ = timed(lambda: agent.sample(state), args.repeats)
+        results[name] = (train_time, sample_time, losses)
+
+    print("%6s %16s %16s %12s %12s %12s" % ("", "train step (s)", "sample (s)", "policy", "value", "entropy"))
+    for name, (train_time, sample_time, losses) in results.items():
+        print("%6s %16.4f %16.4f %12.5f %12.5f %12.5f" % ((name, train_time, sample_time) + tuple(losses)))
+
+    fp32, bf16 = results["fp32"], results["bf16"]
+    print("\nspeedup: train %.2fx, sample %.2fx" % (fp32[0] / bf16[0], fp32[1] / bf16[1]))
+    print("relative loss error: %s" % ", ".join(
+        "%.2e" % (abs(a - b) / max(abs(a), 1e-8)) for a, b in zip(fp32[2], bf16[2])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+    ConvLSTM unroll cost: the previous cell with eight separate convolutions
+    per step, against the fused cell stepped one timestep at a time and the
+    fused forward_sequence, which runs the input convolutions for all
+    timesteps in one batched convolution. The eight-convolution reference
+    uses slices of the fused weights, so all three must produce the same
+    outputs and hidden states.
+
+    Run from this directory:
+        python convlstm_benchmark.py
+"""
+
+import sys
+sys.path.insert(0, "../../interface/")
+
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+
+from base_agent.net_utils import ConvLSTM
+
+
+def reference_step(lstm, input, hidden_state):
+    H = lstm.hidden_size
+    input_weights = lstm.input_gates.weight.split(H)
+    input_biases = lstm.input_gates.bias.split(H)
+    hidden_weights = lstm.hidden_gates.weight.split(H)
+    hidden_biases = lstm.hidden_gates.bias.split(H)
+
+    def gate(k, x, h):
+        return F.conv2d(x, input_weights[k], input_biases[k]) + F.conv2d(h, hidden_weights[k], hidden_biases[k])
+
+    h_0 = hidden_state[:,0]
+    c_0 = hidden_state[:,1]
+    x = lstm.inpad(input)
+    h = lstm.hpad(h_0)
+    i = torch.sigmoid(gate(0, x, h) + c_0 * lstm.Wc_input)
+    f = torch.sigmoid(gate(1, x, h) + c_0 * lstm.Wc_forget)
+    g = torch.tanh(gate(2, x, h))
+    c_t = f * c_0 + i * g
+    o = torch.sigmoid(gate(3, x, h) + c_t * lstm.Wc_output)
+    h_t = o * torch.tanh(c_t)
+    return o, torch.cat([h_t.unsqueeze(1), c_t.unsqueeze(1)], dim=1)
+
+
+def unroll(step, lstm, inputs, hidden_state):
+    outputs = []
+    for t in range(inputs.shape[1]):
+        output, hidden_state = step(lstm, inputs[:,t], hidden_state)
+        outputs.append(output)
+    return torch.stack(outputs, dim=1), hidden_state
+
+
+def timed(func, repeats):
+    func()
+    best = float("inf")
+    for _ in range(repeats):
+        t1 = time.time()
+        func()
+        best = min(best, time.time() - t1)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--history_size", type=int, default=20)
+    # LSTM_in_size and LSTM_hidden_size of experiments/DeepMind2018/run.py
+    parser.add_argument("--input_size", type=int, default=578)
+    parser.add_argument("--hidden_size", type=int, default=96)
+    parser.add_argument("--width", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    torch.manual_seed(0)
+    lstm = ConvLSTM(args.input_size, args.hidden_size, width=args.width).to(device)
+    with torch.no_grad():
+        for peephole in [lstm.Wc_input, lstm.Wc_forget, lstm.Wc_output]:
+            peephole.normal_(0, 0.1)
+
+    inputs = torch.randn(args.batch_size, args.history_size, args.input_size, args.width, args.width, device=device)
+    hidden_state = torch.randn(args.batch_size, 2, args.hidden_size, args.width, args.width, device=device)
+
+    runs = [
+        ("eight convolutions", lambda: unroll(reference_step, lstm, inputs, hidden_state)),
+        ("fused, per step", lambda: unroll(ConvLSTM.forward, lstm, inputs, hidden_state)),
+        ("fused, sequence", lambda: lstm.forward_sequence(inputs, hidden_state))
+    ]
+
+    print("%20s %12s %12s %10s %12s" % ("", "forward (ms)", "f+b (ms)", "speedup", "max error"))
+    reference_outputs, reference_time = None, None
+    for name, run in runs:
+        with torch.no_grad():
+            outputs, final = run()
+            forward_time = timed(run, args.repeats)
+
+        def forward_backward():
+            lstm.zero_grad()
+            outputs, final = run()
+            (outputs.sum() + final.sum()).backward()
+        backward_time = timed(forward_backward, args.repeats)
+
+        if reference_outputs is None:
+            reference_outputs, reference_final, reference_time = outputs, final, backward_time
+        error = max((outputs - reference_outputs).abs().max().item(), (final - reference_final).abs().max().item())
+        print("%20s %12.2f %12.2f %9.2fx %12.2e" % (name, 1000 * forward_time, 1000 * backward_time,
+                                                    reference_time / backward_time, error))
+
+
+if __name__ == "__main__":
+    main()
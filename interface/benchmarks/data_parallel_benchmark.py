@@ -0,0 +1,147 @@
+"""
+    Training throughput of the data-parallel learner (train_settings
+    ["data_parallel"]) on one box. For each number of workers, K processes
+    fill their own replay memory from the random environment and run
+    BaseAgent.train with gradients averaged over gloo. The intra-op threads
+    are split evenly between the workers.
+
+    After training, the script checks that every replica ended with the same
+    weights.
+
+    Run from this directory:
+        python data_parallel_benchmark.py --workers 1 2 4
+"""
+
+import sys
+sys.path.insert(0, "../../interface/")
+sys.path.insert(0, "../../experiments/DeepMind2018/")
+
+import io
+import time
+import argparse
+import contextlib
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from RRLNetwork import RRLModel
+from base_agent.base_agent import BaseAgent
+from base_agent.memory import ReplayMemory
+from base_agent.custom_env import RandomEnvironment
+from base_agent.sc2env_utils import full_action_space
+from base_agent.data_parallel import init_data_parallel, launch
+from agent import AgentSettings
+from abstract_core import RunSettings
+
+
+def make_agent(args, world_size):
+    net_config = {
+        "state_embedding_size": 10,
+        "action_embedding_size": 16,
+        "down_conv_features": args.features,
+        "down_residual_depth": 2,
+        "up_features": 32,
+        "up_conv_features": args.features,
+        "resnet_features": args.features,
+        "LSTM_in_size": 64,
+        "LSTM_hidden_size": 96,
+        "inputs2d_size": 64,
+        "inputs3d_width": 8,
+        "relational_features": 32,
+        "relational_depth": 3,
+        "relational_heads": 3,
+        "spatial_out_depth": 64,
+        "channels3": 16,
+        "history_size": args.history_size,
+        "device": "cpu"
+    }
+    model = RRLModel(net_config, device="cpu", action_space=np.ones(full_action_space.shape))
+    memory = ReplayMemory(args.memory_size, args.batch_size, hist_size=args.history_size)
+    settings = AgentSettings(torch.optim.Adam, 1e-4, 0.3, 0.05, 2e4, 1e-8)
+    train_settings = {
+        "discount_factor": 0.99,
+        "lambda": 0.95,
+        "hist_size": args.history_size,
+        "device": "cpu",
+        "eps_denom": 1e-5,
+        "c1": 0.1,
+        "c2": 0.01,
+        "c3": 1.0,
+        "c4": 1.0,
+        "minc2": 0.01,
+        "clip_param": 0.1,
+        "min_clip_param": 0.01,
+        "clip_decay": 10000,
+        "c2_decay": 10000,
+        "map": "benchmark",
+        "history_size": args.history_size,
+        "data_parallel": world_size > 1
+    }
+    return BaseAgent(model, settings, memory, train_settings)
+
+
+def fill(agent, steps):
+    env = RandomEnvironment(max_episode_len=50, max_state_value=1)
+    states, _, done, _ = env.reset()
+    for _ in range(steps):
+        state = agent.state_space_converter(states[0])
+        action = agent.sample(state)
+        states, reward, done, _ = env.step([action])
+        agent.push_memory(state, action, reward[0], done)
+        if done:
+            states, _, done, _ = env.reset()
+
+
+def worker(rank, world_size, args, threads, results):
+    if world_size > 1:
+        init_data_parallel(rank, world_size, master_port=args.port)
+    torch.set_num_threads(max(1, threads // world_size))
+    torch.manual_seed(0)
+    np.random.seed(rank)
+
+    agent = make_agent(args, world_size)
+    fill(agent, args.memory_size)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        t1 = time.time()
+        agent.train(RunSettings(1, args.epochs, args.batch_size, args.memory_size, 0, 0, 1))
+        elapsed = time.time() - t1
+
+    if world_size > 1:
+        consistent = agent.learner.replicas_identical()
+        dist.destroy_process_group()
+    else:
+        consistent = True
+    windows = args.epochs * len(agent.memory.valid_starts())
+    results.put((rank, elapsed, windows, consistent))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--memory_size", type=int, default=128)
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--history_size", type=int, default=5)
+    parser.add_argument("--features", type=int, default=64)
+    parser.add_argument("--port", type=int, default=29500)
+    args = parser.parse_args()
+
+    threads = torch.get_num_threads()
+    context = torch.multiprocessing.get_context("spawn")
+
+    print("%8s %12s %16s %12s" % ("workers", "train (s)", "windows / s", "replicas"))
+    for world_size in args.workers:
+        results = context.Queue()
+        launch(worker, world_size, args, threads, results)
+        results = [results.get() for _ in range(world_size)]
+        elapsed = max(r[1] for r in results)
+        windows = sum(r[2] for r in results)
+        consistent = all(r[3] for r in results)
+        print("%8d %12.2f %16.1f %12s" % (world_size, elapsed, windows / elapsed,
+                                            "identical" if consistent else "DIVERGED"))
+        args.port += 1
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+    Feature layer embedding throughput: the fused PlaneEmbedding built by
+    sc2env_utils.generate_embeddings against the previous per-plane loop
+    (one FastEmbedding call and one slice write per categorical plane, a
+    batch minimum per scalar plane). The categorical channels of both must
+    agree exactly when the per-plane tables hold the same weights.
+
+    Run from this directory:
+        python embedding_benchmark.py
+"""
+
+import sys
+sys.path.insert(0, "../../interface/")
+
+import time
+import argparse
+import torch
+
+from base_agent.net_utils import FastEmbedding
+from base_agent.sc2env_utils import generate_embeddings, env_config, MINIMAP_FEATURES, SCREEN_FEATURES
+
+
+def per_plane_embed(x, embedding_list, embedding_indices):
+    s = x.shape
+    embedding_size = embedding_list[0].embedding_dim
+    output_dim = s[1] + len(embedding_list) * (embedding_size - 1)
+    output = torch.zeros((s[0], output_dim) + s[2:], dtype=x.dtype, device=x.device)
+    lower = 0
+    embed_count = 0
+    for i in range(s[1]):
+        if i in embedding_indices:
+            output[:, lower:lower+embedding_size] = embedding_list[embed_count](x[:, i].long()).permute((0, 3, 1, 2))
+            lower += embedding_size
+            embed_count += 1
+        else:
+            output[:, lower] = torch.log(x[:, i] - torch.min(x[:, i]) + 1.0)
+            lower += 1
+    return output
+
+
+def per_plane_tables(embedding, device):
+    tables = []
+    for j, rows in enumerate(embedding.rows):
+        table = FastEmbedding(rows, embedding.embedding_dim, device=device)
+        start = sum(embedding.rows[:j])
+        table.weight = embedding.weight.detach()[start:start+rows]
+        tables.append(table)
+    return tables
+
+
+def timed(func, repeats):
+    func()
+    best = float("inf")
+    for _ in range(repeats):
+        t1 = time.time()
+        func()
+        best = min(best, time.time() - t1)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 5, 32, 160])
+    parser.add_argument("--embedding_size", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    embeddings = generate_embeddings({"state_embedding_size": args.embedding_size, "device": device})
+
+    print("%8s %6s %16s %16s %10s" % ("input", "N", "per-plane (ms)", "fused (ms)", "speedup"))
+    for name, features, embedding in [("minimap", MINIMAP_FEATURES, embeddings[0]), ("screen", SCREEN_FEATURES, embeddings[1])]:
+        tables = per_plane_tables(embedding, device)
+        indices = env_config[name + "_categorical_indices"]
+        for N in args.batch_sizes:
+            x = torch.stack([torch.randint(0, f.scale, (N,) + env_config[name + "_shape"][1:]) for f in features], 1)
+            x = x.float().to(device)
+
+            with torch.no_grad():
+                reference = per_plane_embed(x, tables, indices)
+                fused = embedding(x)
+                for first, last, channel in embedding.categorical_runs:
+                    block = slice(channel, channel + (last - first) * embedding.embedding_dim)
+                    assert torch.equal(reference[:, block], fused[:, block])
+
+                per_plane_time = timed(lambda: per_plane_embed(x, tables, indices), args.repeats)
+                fused_time = timed(lambda: embedding(x), args.repeats)
+            print("%8s %6d %16.2f %16.2f %9.2fx" % (name, N, 1000 * per_plane_time, 1000 * fused_time,
+                                                    per_plane_time / fused_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+    Compares the vectorized advantage estimation in base_agent/advantage.py
+    against the per-row Python loop the replay memories used to run.
+
+    Run from this directory:
+        python gae_benchmark.py
+"""
+
+import sys
+sys.path.insert(0, "../../interface/")
+
+from collections import deque
+import time
+import numpy as np
+import torch
+
+from base_agent.advantage import vtargets_adv
+
+
+def loop_vtargets_adv(memory, gamma, lam):
+    N = len(memory)
+
+    prev_gae_t = 0
+
+    for i in reversed(range(N-1)):
+
+        vnext = memory[i+1][4]
+        nonterminal = 1 - memory[i+1][3]    # 1 - done
+        delta = memory[i][2] + gamma * vnext * nonterminal - memory[i][4]
+        gae_t = delta + gamma * lam * nonterminal * prev_gae_t
+        memory[i][6] = gae_t    # advantage
+        memory[i][5] = gae_t + memory[i][4]  # advantage + value
+        prev_gae_t = gae_t
+
+
+def timed(func, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        t1 = time.time()
+        out = func()
+        best = min(best, time.time() - t1)
+    return best, out
+
+
+def main():
+    gamma, lam = 0.99, 0.95
+    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    num_envs = 16
+
+    print("%10s %12s %12s %12s %12s %12s" % ("T", "loop (s)", "numpy (s)", "torch (s)", "speedup", "max err"))
+    for T in [2048, 32768, 1048576]:
+        rewards = np.random.randn(T).astype(np.float32)
+        values = np.random.randn(T).astype(np.float32)
+        dones = np.random.random(T) < 0.01
+
+        memory = deque(maxlen=T)
+        for i in range(T):
+            memory.append([None, None, float(rewards[i]), bool(dones[i]), float(values[i]), 0, 0, 0])
+
+        repeats = 1 if T > 100000 else 3
+        loop_time, _ = timed(lambda: loop_vtargets_adv(memory, gamma, lam), repeats)
+        np_time, (adv, ret) = timed(lambda: vtargets_adv(rewards, values, dones, gamma, lam), 3)
+
+        t_rewards = torch.from_numpy(rewards).to(device)
+        t_values = torch.from_numpy(values).to(device)
+        t_dones = torch.from_numpy(dones).to(device)
+        torch_time, _ = timed(lambda: vtargets_adv(t_rewards, t_values, t_dones, gamma, lam), 3)
+
+        expected = np.array([row[6] for row in memory])
+        err = np.max(np.abs(adv[:-1] - expected[:-1]))
+        print("%10d %12.5f %12.5f %12.5f %11.1fx %12.2e" % (T, loop_time, np_time, torch_time, loop_time / np_time, err))
+
+    print("\nBatched (T, N) layout with N = %d environments" % num_envs)
+    print("%10s %12s %12s" % ("T", "numpy (s)", "torch (s)"))
+    for T in [2048, 32768, 65536]:
+        rewards = np.random.randn(T, num_envs).astype(np.float32)
+        values = np.random.randn(T, num_envs).astype(np.float32)
+        dones = np.random.random((T, num_envs)) < 0.01
+        np_time, _ = timed(lambda: vtargets_adv(rewards, values, dones, gamma, lam), 3)
+        t_rewards = torch.from_numpy(rewards).to(device)
+        t_values = torch.from_numpy(values).to(device)
+        t_dones = torch.from_numpy(dones).to(device)
+        torch_time, _ = timed(lambda: vtargets_adv(t_rewards, t_values, t_dones, gamma, lam), 3)
+        print("%10d %12.5f %12.5f" % (T, np_time, torch_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+    Argument and spatial head latency during action selection for the
+    DeepMind2018 RRLModel: conditioned_heads, which always computes all 10
+    argument rows and all 3 spatial maps, against lazy_conditioned_heads,
+    which computes only what the sampled actions take. Shared features come
+    from random inputs; the heads do not depend on their values.
+
+    Run from this directory:
+        python heads_benchmark.py
+"""
+
+import sys
+sys.path.insert(0, "../../interface/")
+sys.path.insert(0, "../../experiments/DeepMind2018/")
+
+import time
+import argparse
+import numpy as np
+import torch
+from pysc2.lib.actions import FUNCTIONS
+
+from RRLNetwork import RRLModel
+from base_agent.sc2env_utils import full_action_space
+
+
+def timed(func, repeats):
+    func()
+    best = float("inf")
+    for _ in range(repeats):
+        t1 = time.time()
+        func()
+        best = min(best, time.time() - t1)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_envs", type=int, default=16)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    # Same network as experiments/DeepMind2018/run.py
+    net_config = {
+        "state_embedding_size": 10,
+        "action_embedding_size": 16,
+        "down_conv_features": 128,
+        "down_residual_depth": 2,
+        "up_features": 32,
+        "up_conv_features": 128,
+        "resnet_features": 128,
+        "LSTM_in_size": 64,
+        "LSTM_hidden_size": 96,
+        "inputs2d_size": 64,
+        "inputs3d_width": 8,
+        "relational_features": 32,
+        "relational_depth": 3,
+        "relational_heads": 3,
+        "spatial_out_depth": 64,
+        "channels3": 16,
+        "history_size": 1,
+        "device": device
+    }
+    model = RRLModel(net_config, device=device, action_space=np.ones(full_action_space.shape)).to(device)
+    model.eval()
+
+    width = net_config["inputs3d_width"]
+    shared_size = model.arg_MLP.in_features - net_config["action_embedding_size"]
+    spatial_size = model.spatial_upsampler.tconv1[0].in_channels - net_config["action_embedding_size"]
+
+    # no_op, select_army (one non-spatial arg), Move_screen (queued and one
+    # spatial arg), and a mix in which most environments pick no_op
+    names = ["no_op", "select_army", "Move_screen"]
+    cases = [(name, [FUNCTIONS[name].id]) for name in names]
+    mix = np.random.choice([FUNCTIONS[name].id for name in names], args.num_envs, p=[0.5, 0.2, 0.3])
+    cases.append(("mixed x%d" % args.num_envs, list(mix)))
+
+    print("%18s %16s %16s %10s" % ("actions", "full (ms)", "lazy (ms)", "speedup"))
+    for name, actions in cases:
+        N = len(actions)
+        action = torch.tensor(actions, dtype=torch.long, device=device)
+        shared_features = torch.randn(N, shared_size, device=device)
+        relational_spatial = torch.randn(N, spatial_size, width, width, device=device)
+        with torch.no_grad():
+            full_time = timed(lambda: model.conditioned_heads(shared_features, relational_spatial, action), args.repeats)
+            lazy_time = timed(lambda: model.lazy_conditioned_heads(shared_features, relational_spatial, action), args.repeats)
+        print("%18s %16.2f %16.2f %9.2fx" % (name, 1000 * full_time, 1000 * lazy_time, full_time / lazy_time))
+
+
+if __name__ == "__main__":
+    main()
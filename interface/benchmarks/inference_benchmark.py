@@ -0,0 +1,123 @@
+"""
+    Per-step action selection latency of the DeepMind2018 RRLModel: the
+    eager RRLModel.forward(choosing=True) path against InferencePolicy, for
+    one environment and for several stepped together. Both paths get the
+    same rolling history windows, as in a rollout, so InferencePolicy embeds
+    only the newest frame of each window. A final check compares the action
+    probabilities of the two paths on one window.
+
+    Run from this directory:
+        python inference_benchmark.py
+"""
+
+import sys
+sys.path.insert(0, "../../interface/")
+sys.path.insert(0, "../../experiments/DeepMind2018/")
+
+import time
+import argparse
+import numpy as np
+import torch
+
+from RRLNetwork import RRLModel
+from base_agent.inference import InferencePolicy
+from base_agent.sc2env_utils import env_config, full_action_space
+
+
+def timed(func, repeats):
+    func()
+    t1 = time.time()
+    for _ in range(repeats):
+        func()
+    return (time.time() - t1) / repeats
+
+
+def random_frames(num_envs, num_frames):
+    minimap = np.random.randint(0, 2, (num_envs, num_frames) + env_config["minimap_shape"]).astype(np.float32)
+    screen = np.random.randint(0, 2, (num_envs, num_frames) + env_config["screen_shape"]).astype(np.float32)
+    last_spatials = np.random.randint(-1, env_config["spatial_action_size"], (num_envs, num_frames, env_config["spatial_action_depth"], 2))
+    return minimap, screen, last_spatials
+
+
+"""
+    Returns a callable producing the inputs of consecutive steps: each
+    window is the previous one shifted by a frame
+"""
+def rollout_inputs(num_envs, history_size, num_steps):
+    minimap, screen, last_spatials = random_frames(num_envs, history_size + num_steps)
+    player = np.random.randint(0, 100, (num_envs, env_config["raw_player"])).astype(np.float32)
+    avail_actions = (np.random.random((num_envs, env_config["action_space"])) < 0.1).astype(np.uint8)
+    avail_actions[:, 0] = 1
+    last_action = np.zeros(num_envs, dtype=np.int64)
+    step = [0]
+
+    def next_inputs():
+        t = step[0] % num_steps
+        step[0] += 1
+        window = slice(t, t + history_size)
+        return (minimap[:, window], screen[:, window], player, avail_actions,
+                last_action, last_spatials[:, window].astype(np.int64))
+    return next_inputs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--history_size", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    # Same network as experiments/DeepMind2018/run.py
+    net_config = {
+        "state_embedding_size": 10,
+        "action_embedding_size": 16,
+        "down_conv_features": 128,
+        "down_residual_depth": 2,
+        "up_features": 32,
+        "up_conv_features": 128,
+        "resnet_features": 128,
+        "LSTM_in_size": 64,
+        "LSTM_hidden_size": 96,
+        "inputs2d_size": 64,
+        "inputs3d_width": 8,
+        "relational_features": 32,
+        "relational_depth": 3,
+        "relational_heads": 3,
+        "spatial_out_depth": 64,
+        "channels3": 16,
+        "history_size": args.history_size,
+        "device": device
+    }
+    model = RRLModel(net_config, device=device, action_space=np.ones(full_action_space.shape)).to(device)
+    model.eval()
+    hidden = model.init_hidden(use_torch=False)
+
+    print("%8s %16s %16s %10s" % ("envs", "eager (ms/env)", "policy (ms/env)", "speedup"))
+    for num_envs in [1, 4, 16]:
+        policy = InferencePolicy(model, num_envs=num_envs)
+        eager_inputs = rollout_inputs(num_envs, args.history_size, args.repeats + 1)
+        policy_inputs = rollout_inputs(num_envs, args.history_size, args.repeats + 1)
+
+        def eager():
+            inputs = eager_inputs()
+            for i in range(num_envs):
+                minimap, screen, player, avail_actions, last_action, last_spatials = [x[i:i+1] for x in inputs]
+                with torch.no_grad():
+                    model(minimap, screen, player, avail_actions, last_action, last_spatials, hidden, choosing=True)
+
+        eager_time = timed(eager, args.repeats) / num_envs
+        policy_time = timed(lambda: policy(*(policy_inputs() + (hidden,))), args.repeats) / num_envs
+        print("%8d %16.2f %16.2f %9.2fx" % (num_envs, 1000 * eager_time, 1000 * policy_time, eager_time / policy_time))
+
+    inputs = rollout_inputs(1, args.history_size, 1)()
+    with torch.no_grad():
+        eager_probs = model(*(inputs + (hidden,)), choosing=True)[0]
+    policy_probs = InferencePolicy(model)(*(inputs + (hidden,)))[0]
+    print("max action probability difference: %.2e" % (eager_probs - policy_probs).abs().max().item())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+    Action sampling time for N environments: the per-environment host loop
+    (BaseNetwork.sample_action, sample_arg and sample_spatial, one NumPy
+    multinomial per base action, argument and spatial map) against the
+    batched device sampler (sample_actions, sample_action_args and
+    choices_to_host, one transfer for all N choices). Both draw from the
+    same probabilities; only the time to produce the choices is measured.
+
+    Run from this directory:
+        python sampling_benchmark.py --batch_sizes 1 8 32
+"""
+
+import sys
+sys.path.insert(0, "../../interface/")
+
+import time
+import argparse
+import torch
+
+from base_agent.Network import BaseNetwork
+from base_agent.sc2env_utils import env_config, valid_args
+
+
+def make_sampler():
+    net = BaseNetwork({})
+    net.arg_depth = env_config["arg_depth"]
+    net.spatial_depth = env_config["spatial_action_depth"]
+    net.spatial_size = env_config["spatial_action_size"]
+    net.valid_args = torch.from_numpy(valid_args).float()
+    return net
+
+
+def host_loop(net, action_probs, arg_probs, spatial_probs):
+    choices = []
+    for i in range(action_probs.shape[0]):
+        action = net.sample_action(action_probs[i:i+1])
+        choices.append([action, net.sample_arg(arg_probs[i:i+1], action),
+                        net.sample_spatial(spatial_probs[i:i+1], action)])
+    return choices
+
+
+def batched(net, action_probs, arg_probs, spatial_probs):
+    actions = net.sample_actions(action_probs)
+    args, spatial = net.sample_action_args(arg_probs, spatial_probs, actions)
+    return net.choices_to_host(actions, args, spatial)
+
+
+def timed(func, repeats):
+    func()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    best = float("inf")
+    for _ in range(repeats):
+        t1 = time.time()
+        func()
+        best = min(best, time.time() - t1)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    net = make_sampler().to(device)
+    S = env_config["spatial_action_size"]
+
+    print("%6s %16s %16s %10s" % ("N", "host loop (ms)", "batched (ms)", "speedup"))
+    for N in args.batch_sizes:
+        action_probs = torch.softmax(torch.randn(N, env_config["action_space"], device=device), dim=-1)
+        arg_probs = net.generate_arg_logits(torch.randn(N, env_config["arg_depth"], env_config["max_arg_size"], device=device))
+        spatial_probs = net.generate_spatial_logits(torch.randn(N, env_config["spatial_action_depth"], S, S, device=device))
+
+        host_time = timed(lambda: host_loop(net, action_probs, arg_probs, spatial_probs), args.repeats)
+        batched_time = timed(lambda: batched(net, action_probs, arg_probs, spatial_probs), args.repeats)
+        print("%6d %16.2f %16.2f %9.2fx" % (N, 1000 * host_time, 1000 * batched_time, host_time / batched_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+
+Asynchronous, atomic checkpoints of the full training state.
+
+Agents used to call torch.save on their state dict inside Experiment.train,
+which stalls environment stepping for the duration of the write and leaves
+a truncated file behind if the process dies mid-write.
+
+Checkpointer.save snapshots the given state to host memory on the calling
+thread (cheap), then serializes it on a background thread to a temporary
+file that is atomically renamed into place. Only the last keep_last
+numbered checkpoints are kept. Checkpointer.resume loads the newest one.
+Queued checkpoints are written before the interpreter exits, or earlier
+with Checkpointer.close.
+
+"""
+
+import os
+import re
+import atexit
+import glob
+import copy
+import random
+import threading
+from queue import Queue
+import numpy as np
+import torch
+
+
+def cpu_snapshot(obj):
+    """
+    Deep copy of obj with every tensor detached and copied to host memory,
+    so training can keep updating the originals while the copy is written.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, cpu_snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def rng_state():
+    """
+    States of every random number generator training draws from
+    """
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def atomic_save(obj, path):
+    """
+    torch.save to a temporary file next to path, then rename over path.
+    Readers see either the previous file or the complete new one.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class Checkpointer:
+    def __init__(self, path, keep_last=3):
+        """
+        :param path: Model file of the agent. Full checkpoints are written
+            next to it as <path>.<step>.ckpt, and path itself keeps holding
+            the latest model state dict so load() keeps working.
+        :param keep_last: Number of full checkpoints to keep, at least 1
+        """
+        if keep_last < 1:
+            raise ValueError("keep_last must be at least 1, got %s" % keep_last)
+        self.path = path
+        self.keep_last = keep_last
+        self.queue = Queue()
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def checkpoint_path(self, step):
+        return "%s.%010d.ckpt" % (self.path, step)
+
+    def checkpoints(self):
+        """
+        Existing checkpoint files, oldest first
+        """
+        pattern = re.compile(re.escape(self.path) + r"\.(\d+)\.ckpt$")
+        found = []
+        for path in glob.glob(glob.escape(self.path) + ".*.ckpt"):
+            match = pattern.match(path)
+            if match:
+                found.append((int(match.group(1)), path))
+        return [path for _, path in sorted(found)]
+
+    def save(self, step, state):
+        """
+        Queues state (a dict, expected to hold the model state dict under
+        "model") to be written as the checkpoint for step. Returns as soon
+        as the snapshot is taken.
+        """
+        assert not self.closed, "save called on a closed Checkpointer"
+        self.raise_error()
+        self.queue.put((step, cpu_snapshot(state)))
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            step, state = item
+            try:
+                atomic_save(state, self.checkpoint_path(step))
+                if "model" in state:
+                    atomic_save(state["model"], self.path)
+                for old in self.checkpoints()[:-self.keep_last]:
+                    os.remove(old)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def wait(self):
+        """
+        Blocks until every queued checkpoint is on disk
+        """
+        self.queue.join()
+
+    def close(self):
+        """
+        Writes every queued checkpoint and stops the writer thread. Raises
+        the error of a failed write. Called automatically at exit.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        atexit.unregister(self.close)
+        self.raise_error()
+
+    def resume(self, map_location="cpu"):
+        """
+        Returns the newest checkpoint, or None if there is none
+        """
+        self.wait()
+        checkpoints = self.checkpoints()
+        if len(checkpoints) == 0:
+            return None
+        return torch.load(checkpoints[-1], map_location=map_location, weights_only=False)
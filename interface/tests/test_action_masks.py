@@ -0,0 +1,29 @@
+import numpy as np
+import torch
+
+from base_agent.action_masks import pack_masks, unpack_masks, packed_mask_size, MaskCache
+from base_agent.sc2env_utils import env_config
+
+
+def random_masks(n, seed=0):
+    rng = np.random.RandomState(seed)
+    return (rng.rand(n, env_config["action_space"]) < 0.1).astype(np.float32)
+
+
+def test_pack_unpack_round_trip():
+    avail = random_masks(16)
+    packed = pack_masks(avail)
+    assert packed.shape == (16, packed_mask_size)
+    assert packed.dtype == np.uint8
+    unpacked = unpack_masks(torch.from_numpy(packed))
+    assert np.array_equal(unpacked.numpy(), avail.astype(np.uint8))
+
+
+def test_mask_cache_lookup_matches_unpack():
+    avail = random_masks(4)
+    cache = MaskCache("cpu", capacity=3)
+    for rows in [[0, 1, 0, 2], [3, 1, 3], [0, 1, 2, 3, 1]]:
+        masks = cache.lookup(pack_masks(avail[rows]))
+        assert np.array_equal(masks.numpy(), avail[rows].astype(np.uint8))
+        assert len(cache.ids) <= cache.capacity
+        assert len(cache.table) == len(cache.ids)
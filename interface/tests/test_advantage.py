@@ -0,0 +1,60 @@
+import numpy as np
+import torch
+
+from base_agent.advantage import reverse_scan, vtargets_adv
+
+
+def loop_scan(coeffs, values):
+    x = np.zeros_like(values)
+    carry = 0
+    for t in reversed(range(len(values))):
+        carry = values[t] + coeffs[t] * carry
+        x[t] = carry
+    return x
+
+
+def loop_vtargets_adv(rewards, values, dones, gamma, lam, last_value=None):
+    T = len(rewards)
+    advantages = np.zeros(T, dtype=np.float64)
+    adv = 0.0
+    for t in reversed(range(T)):
+        if t == T - 1:
+            adv = 0.0 if last_value is None else rewards[t] + gamma * last_value - values[t]
+        else:
+            nonterminal = 1.0 - dones[t + 1]
+            delta = rewards[t] + gamma * values[t + 1] * nonterminal - values[t]
+            adv = delta + gamma * lam * nonterminal * adv
+        advantages[t] = adv
+    return advantages, advantages + values
+
+
+def test_reverse_scan_matches_loop():
+    rng = np.random.RandomState(0)
+    for T in [1, 2, 7, 64]:
+        coeffs = rng.rand(T, 3)
+        values = rng.randn(T, 3)
+        assert np.allclose(reverse_scan(coeffs, values), loop_scan(coeffs, values))
+        scanned = reverse_scan(torch.from_numpy(coeffs), torch.from_numpy(values))
+        assert np.allclose(scanned.numpy(), loop_scan(coeffs, values))
+
+
+def test_reverse_scan_does_not_modify_inputs():
+    coeffs, values = np.full(5, 0.5), np.ones(5)
+    reverse_scan(coeffs, values)
+    assert np.array_equal(coeffs, np.full(5, 0.5)) and np.array_equal(values, np.ones(5))
+
+
+def test_vtargets_adv_matches_loop_gae():
+    rng = np.random.RandomState(1)
+    T = 50
+    rewards, values = rng.randn(T), rng.randn(T)
+    dones = rng.rand(T) < 0.1
+    for last_value in [None, 0.7]:
+        expected = loop_vtargets_adv(rewards, values, dones, 0.99, 0.95, last_value)
+        result = vtargets_adv(rewards, values, dones, 0.99, 0.95, last_value)
+        for r, e in zip(result, expected):
+            assert np.allclose(r, e)
+        result = vtargets_adv(torch.from_numpy(rewards), torch.from_numpy(values),
+                                torch.from_numpy(dones), 0.99, 0.95, last_value)
+        for r, e in zip(result, expected):
+            assert np.allclose(r.numpy(), e, atol=1e-5)
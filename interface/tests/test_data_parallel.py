@@ -0,0 +1,131 @@
+import os
+import socket
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../experiments/DeepMind2018"))
+
+from RRLNetwork import RRLModel
+from base_agent.base_agent import BaseAgent
+from base_agent.memory import ReplayMemory
+from base_agent.custom_env import RandomEnvironment
+from base_agent.sc2env_utils import full_action_space
+from base_agent.data_parallel import init_data_parallel
+from agent import AgentSettings
+from abstract_core import RunSettings
+
+
+HIST_SIZE = 2
+MEMORY_SIZE = 16
+BATCH_SIZE = 8
+
+
+def make_agent():
+    net_config = {
+        "state_embedding_size": 4,
+        "action_embedding_size": 8,
+        "down_conv_features": 8,
+        "down_residual_depth": 1,
+        "up_features": 8,
+        "up_conv_features": 16,
+        "resnet_features": 8,
+        "LSTM_in_size": 16,
+        "LSTM_hidden_size": 8,
+        "inputs2d_size": 16,
+        "inputs3d_width": 8,
+        "relational_features": 8,
+        "relational_depth": 2,
+        "relational_heads": 2,
+        "spatial_out_depth": 8,
+        "channels3": 8,
+        "history_size": HIST_SIZE,
+        "device": "cpu"
+    }
+    model = RRLModel(net_config, device="cpu", action_space=np.ones(full_action_space.shape))
+    memory = ReplayMemory(MEMORY_SIZE, BATCH_SIZE, hist_size=HIST_SIZE)
+    settings = AgentSettings(torch.optim.Adam, 1e-4, 0.3, 0.05, 2e4, 1e-8)
+    train_settings = {
+        "discount_factor": 0.99,
+        "lambda": 0.95,
+        "hist_size": HIST_SIZE,
+        "device": "cpu",
+        "eps_denom": 1e-5,
+        "c1": 0.1,
+        "c2": 0.01,
+        "c3": 1.0,
+        "c4": 1.0,
+        "minc2": 0.01,
+        "clip_param": 0.1,
+        "min_clip_param": 0.01,
+        "clip_decay": 10000,
+        "c2_decay": 10000,
+        "map": "test",
+        "history_size": HIST_SIZE,
+        "data_parallel": True
+    }
+    return BaseAgent(model, settings, memory, train_settings)
+
+
+def fill(agent, steps):
+    env = RandomEnvironment(max_episode_len=10, max_state_value=1)
+    states, _, done, _ = env.reset()
+    for _ in range(steps):
+        state = agent.state_space_converter(states[0])
+        action = agent.sample(state)
+        states, reward, done, _ = env.step([action])
+        agent.push_memory(state, action, reward[0], done)
+        if done:
+            states, _, done, _ = env.reset()
+
+
+def worker(rank, world_size, port, rounds, results):
+    init_data_parallel(rank, world_size, master_port=port)
+    torch.set_num_threads(1)
+    # Different initial weights per rank; the learner broadcasts rank 0's
+    torch.manual_seed(rank)
+    np.random.seed(rank)
+    agent = make_agent()
+    run_settings = RunSettings(1, 1, BATCH_SIZE, MEMORY_SIZE, 0, 0, 1)
+    for _ in range(rounds[rank]):
+        fill(agent, MEMORY_SIZE)
+        agent.train(run_settings)
+    agent.finish()
+    results.put((rank, agent.epochs_trained, agent.learner.replicas_identical()))
+    dist.destroy_process_group()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run(rounds, timeout=300):
+    world_size = len(rounds)
+    results = mp.get_context("spawn").SimpleQueue()
+    context = mp.spawn(worker, args=(world_size, free_port(), rounds, results), nprocs=world_size, join=False)
+    deadline = time.time() + timeout
+    while not context.join(max(0, deadline - time.time())) and time.time() < deadline:
+        pass
+    for process in context.processes:
+        if process.is_alive():
+            process.terminate()
+    assert all(process.exitcode == 0 for process in context.processes), "workers hung or failed"
+    return sorted(results.get() for _ in range(world_size))
+
+
+def test_train_leaves_identical_replicas():
+    results = run([2, 2])
+    assert [epochs for _, epochs, _ in results] == [2, 2]
+    assert all(identical for _, _, identical in results)
+
+
+def test_rank_that_stops_early_does_not_deadlock():
+    results = run([2, 1])
+    assert [epochs for _, epochs, _ in results] == [1, 1]
+    assert all(identical for _, _, identical in results)
@@ -0,0 +1,47 @@
+import torch
+
+from base_agent.net_utils import ConvLSTM, PlaneEmbedding
+
+
+def test_conv_lstm_loads_per_gate_checkpoints():
+    torch.manual_seed(0)
+    lstm = ConvLSTM(3, 4, width=5)
+    old_state = {}
+    for side in ["input", "hidden"]:
+        for param in ["weight", "bias"]:
+            fused = getattr(lstm, side + "_gates").state_dict()[param]
+            for gate, chunk in zip(ConvLSTM.gate_names, fused.chunk(4)):
+                old_state["%s_to_%s.%s" % (side, gate, param)] = chunk.clone()
+
+    loaded = ConvLSTM(3, 4, width=5)
+    loaded.load_state_dict(old_state)
+    for gate in ["input", "forget", "output"]:
+        assert torch.equal(getattr(loaded, "Wc_" + gate), torch.zeros(1, 4, 5, 5))
+
+    x, hidden = torch.randn(2, 3, 5, 5), torch.randn(2, 2, 4, 5, 5)
+    with torch.no_grad():
+        for p in ["Wc_input", "Wc_forget", "Wc_output"]:
+            getattr(lstm, p).zero_()
+        expected, loaded_out = lstm(x, hidden), loaded(x, hidden)
+    assert torch.allclose(expected[0], loaded_out[0]) and torch.allclose(expected[1], loaded_out[1])
+
+
+def test_plane_embedding_loads_per_plane_checkpoints():
+    torch.manual_seed(0)
+    embedding = PlaneEmbedding([3, 10, 4], [True, False, True], 5)
+    old_state = {}
+    for j, table in enumerate(embedding.weight.detach().split(embedding.rows)):
+        old_state["%d.layer.weight" % j] = table.t().clone()
+        old_state["%d.layer.bias" % j] = torch.zeros(5)
+
+    loaded = PlaneEmbedding([3, 10, 4], [True, False, True], 5)
+    loaded.load_state_dict(old_state)
+    assert torch.equal(loaded.weight, embedding.weight)
+
+
+def test_plane_embedding_clamps_ids_to_their_plane():
+    embedding = PlaneEmbedding([3, 5], [True, True], 4)
+    weight = embedding.weight.detach()
+    out = embedding(torch.tensor([9., -2.]).view(1, 2, 1, 1)).view(2, 4)
+    assert torch.equal(out[0], weight[3])
+    assert torch.equal(out[1], weight[4])
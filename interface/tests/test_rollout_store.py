@@ -0,0 +1,60 @@
+import json
+import os
+
+import numpy as np
+
+from base_agent.rollout_store import MemmapReplayMemory
+from base_agent.sc2env_utils import env_config
+
+
+def transition(rng, t):
+    minimap = rng.randint(0, 4, (1, env_config["raw_minimap"], 8, 8))
+    screen = rng.randint(0, 4, (1, env_config["raw_screen"], 8, 8))
+    player = rng.randint(0, 100, (1, env_config["raw_player"]))
+    avail = rng.rand(env_config["action_space"]) < 0.1
+    hidden = rng.randn(1, 2, 4, 4, 4).astype(np.float32)
+    action = (rng.randint(env_config["action_space"]), np.zeros(env_config["arg_depth"], dtype=np.int64),
+                -np.ones((env_config["spatial_action_depth"], 2), dtype=np.int64))
+    return (minimap, screen, player, avail, hidden), action, float(rng.randn()), t % 7 == 6
+
+
+def fill(memory, steps, seed=0):
+    rng = np.random.RandomState(seed)
+    for t in range(steps):
+        history, action, reward, done = transition(rng, t)
+        memory.push(history, action, reward, done, 0.0, 0.0, 0.0, t)
+
+
+def test_reopen_after_flush(tmp_path):
+    directory = str(tmp_path / "store")
+    memory = MemmapReplayMemory(32, 4, hist_size=2, directory=directory, shard_size=8)
+    fill(memory, 40)
+    memory.flush()
+
+    reopened = MemmapReplayMemory(32, 4, hist_size=2, directory=directory, shard_size=8)
+    assert len(reopened) == len(memory) == 32
+    assert reopened.push_index == memory.push_index
+    assert reopened.episode_count == memory.episode_count
+    for name, array in memory.fields.items():
+        assert np.array_equal(reopened.fields[name][0:32], array[0:32]), name
+
+
+def test_empty_index_is_ignored(tmp_path):
+    directory = str(tmp_path / "store")
+    MemmapReplayMemory(32, 4, directory=directory, shard_size=8).flush()
+    with open(os.path.join(directory, "index.json")) as f:
+        assert json.load(f)["history_shapes"] is None
+
+    reopened = MemmapReplayMemory(32, 4, directory=directory, shard_size=8)
+    assert len(reopened) == 0 and not reopened.allocated
+
+
+def test_reopen_without_flush_keeps_completed_shards(tmp_path):
+    directory = str(tmp_path / "store")
+    memory = MemmapReplayMemory(32, 4, directory=directory, shard_size=8)
+    fill(memory, 20)
+    memory.flusher.wait()
+
+    reopened = MemmapReplayMemory(32, 4, directory=directory, shard_size=8)
+    assert len(reopened) == 16
+    assert np.array_equal(reopened.rewards[0:16], memory.rewards[0:16])
@@ -0,0 +1,25 @@
+import torch
+
+from base_agent.Network import BaseNetwork
+
+
+def test_sample_categorical_skips_zero_probability_entries():
+    torch.manual_seed(0)
+    probs = torch.tensor([[0.0, 0.3, 0.0, 0.7, 0.0, 0.0],
+                            [1.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+                            [0.0, 0.0, 0.0, 0.0, 0.0, 1e-30]]).repeat(1000, 1)
+    picked = torch.gather(probs, 1, BaseNetwork.sample_categorical(probs).unsqueeze(1))
+    assert (picked > 0).all()
+
+
+def test_sample_categorical_when_draw_rounds_up_to_total(monkeypatch):
+    monkeypatch.setattr(torch, "rand_like", torch.ones_like)
+    probs = torch.tensor([[0.1, 0.2, 0.7, 0.0, 0.0]])
+    assert BaseNetwork.sample_categorical(probs).tolist() == [2]
+
+
+def test_sample_categorical_matches_distribution():
+    torch.manual_seed(0)
+    probs = torch.tensor([0.1, 0.0, 0.6, 0.3]).repeat(20000, 1)
+    counts = torch.bincount(BaseNetwork.sample_categorical(probs), minlength=4).float() / 20000
+    assert torch.allclose(counts, probs[0], atol=0.02)
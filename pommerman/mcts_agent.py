@@ -3,6 +3,7 @@ import sys
 sys.path.insert(0, "../interface/")
 
 from agent import Agent, Memory
+from checkpoint import Checkpointer, rng_state, set_rng_state
 
 import argparse
 import multiprocessing
@@ -117,6 +118,7 @@ class MCTSAgent(Agent, BaseAgent):
         self.tempsteps = tempsteps
 
         self.model_save_file = model_save_file
+        self.checkpointer = Checkpointer(model_save_file) if model_save_file else None
 
         self.train_count = 0
 
@@ -302,7 +304,24 @@ class MCTSAgent(Agent, BaseAgent):
         if self.model_save_file:
             if self.settings.verbose:
                 print('Saving policy network')
-            torch.save(self.model.state_dict(), self.model_save_file)
+            self.checkpointer.save(self.train_count, {
+                'model': self.model.state_dict(),
+                'optimizer': self.optimizer.state_dict(),
+                'train_count': self.train_count,
+                'rng': rng_state()
+            })
+
+    def resume(self):
+        if self.model_save_file:
+            state = self.checkpointer.resume()
+            if state is not None:
+                self.model.load_state_dict(state['model'])
+                self.optimizer.load_state_dict(state['optimizer'])
+                self.train_count = state['train_count']
+                set_rng_state(state['rng'])
+                return True
+            print('No checkpoint found')
+        return False
 
     def load(self):
         if self.model_save_file: